@@ -1,12 +1,7 @@
 import os
-import shutil
-import subprocess
 
+from collections import OrderedDict
 from collections import namedtuple
-from dateutil import parser as date_parser
-from json import loads
-
-from warnings import warn
 
 import numpy as np
 
@@ -19,12 +14,22 @@ from astropy.time import Time
 
 from ccdproc import CCDData
 from skimage.feature import register_translation
-from skimage.util import view_as_blocks
 
 
 from pocs import PanBase
-from pocs.utils import current_time
-from pocs.utils import error
+from pocs.utils.calibration import get_calibration_library
+from pocs.utils.images import bin_data
+from pocs.utils.images import cr2_to_fits
+from pocs.utils.images import cr2_to_pgm
+from pocs.utils.images import get_rggb_channels
+from pocs.utils.images import get_solve_field
+from pocs.utils.images import get_wcsinfo
+from pocs.utils.images import make_pretty_image
+from pocs.utils.images import read_cr2
+from pocs.utils.images import read_exif
+from pocs.utils.images import read_pgm
+from pocs.utils.photometry import aperture_photometry
+from pocs.utils.photometry import get_positions
 
 PointingError = namedtuple('PointingError', ['delta_ra', 'delta_dec', 'magnitude'])
 
@@ -51,15 +56,17 @@ class Image(PanBase):
         else:
             self.wcs_file = fits_file
 
-        with fits.open(self.fits_file, 'readonly') as hdu:
-            self.header = hdu[0].header
-            self.data = hdu[0].data
+        # Only the header is read here, see `data`
+        self.header = fits.getheader(self.fits_file)
 
         self._check_headers()
 
-        self.RGGB = CCDData(data=self.data, unit='adu',
-                            meta=self.header,
-                            mask=np.zeros(self.data.shape))
+        self._data = None
+        self._mask = None
+        self._RGGB = None
+
+        # Calibration steps applied to `data`, see `calibrate`
+        self.calibration = list()
 
         # Location
         cfg_loc = self.config['location']
@@ -87,6 +94,63 @@ class Image(PanBase):
         self._pointing = None
         self._pointing_error = None
 
+    @property
+    def data(self):
+        """ Pixel data for the image
+
+        The data is not read when the `Image` is created but the first time it
+        is accessed. The file is memory-mapped, although data that has to be
+        scaled (e.g. unsigned 16-bit data stored with BZERO) is loaded into memory.
+        """
+        if self._data is None:
+            with fits.open(self.fits_file, 'readonly') as hdu:
+                self._data = hdu[0].data
+
+        return self._data
+
+    @data.setter
+    def data(self, new_data):
+        assert new_data.shape == self.shape, \
+            self.logger.warning("Data must have shape {}".format(self.shape))
+
+        self._data = new_data
+
+        # Clear anything derived from the old data
+        self._RGGB = None
+        self._luminance = None
+
+    @property
+    def shape(self):
+        """ Shape of the pixel data, taken from the header """
+        return (self.header['NAXIS2'], self.header['NAXIS1'])
+
+    @property
+    def mask(self):
+        """ Boolean mask for the pixel data
+
+        The mask is only allocated the first time it is accessed.
+        """
+        if self._mask is None:
+            self._mask = np.zeros(self.shape, dtype=bool)
+
+            if self._RGGB is not None:
+                self._RGGB.mask = self._mask
+
+        return self._mask
+
+    @property
+    def RGGB(self):
+        """ `~ccdproc.CCDData` for the image
+
+        Created on first access. The `mask` is only attached if it has already been created.
+        """
+        if self._RGGB is None:
+            self._RGGB = CCDData(data=self.data, unit='adu',
+                                 meta=self.header,
+                                 mask=self._mask)
+
+        return self._RGGB
+
     @property
     def wcs_file(self):
         return self._wcs_file
@@ -111,22 +175,36 @@ class Image(PanBase):
         luminance value.
         '''
         if self._luminance is None:
-            block_size = (2, 2)
-            image_out = view_as_blocks(self.RGGB.data, block_size)
+            self._luminance = bin_data(self.data, binning=2, dtype=np.float32, average=True)
 
-            for i in range(len(image_out.shape) // 2):
-                image_out = np.average(image_out, axis=-1)
+        return self._luminance
 
-            self._luminance = image_out
+    @property
+    def R(self):
+        """ Red pixels of the Bayer array (a view, not a copy) """
+        return get_rggb_channels(self.data)['R']
 
-        return self._luminance
+    @property
+    def G1(self):
+        """ Green pixels in the red rows of the Bayer array (a view, not a copy) """
+        return get_rggb_channels(self.data)['G1']
+
+    @property
+    def G2(self):
+        """ Green pixels in the blue rows of the Bayer array (a view, not a copy) """
+        return get_rggb_channels(self.data)['G2']
+
+    @property
+    def B(self):
+        """ Blue pixels of the Bayer array (a view, not a copy) """
+        return get_rggb_channels(self.data)['B']
 
     @property
     def pointing(self):
         """ Pointing information """
         if self._pointing is None:
             if self.wcs:
-                ny, nx = self.RGGB.data.shape
+                ny, nx = self.shape
                 decimals = self.wcs.all_pix2world([ny // 2], [nx // 2], 1)
 
                 self._pointing = SkyCoord(ra=decimals[0] * u.degree,
@@ -166,6 +244,62 @@ class Image(PanBase):
 
         self.wcs_file = solve_info['solved_fits_file']
 
+    def calibrate(self, library=None):
+        """ Calibrate the pixel data with the master frames for the camera
+
+        The masters are looked up by the camera, ISO and exposure time in the header
+        and applied to a single float32 copy of the data, which then replaces `data`.
+        Nothing is done if the image has already been calibrated.
+
+        Args:
+            library (pocs.utils.calibration.CalibrationLibrary, optional): Library of
+                master frames, defaults to the shared library in `$PANDIR/calibration`
+
+        Returns:
+            list: The calibration steps applied
+        """
+        if self.calibration:
+            return self.calibration
+
+        if library is None:
+            library = get_calibration_library()
+
+        data = self.data
+        if data.dtype != np.float32 or not data.flags.writeable:
+            data = data.astype(np.float32)
+
+        data, steps = library.calibrate(data, self.header, out=data)
+
+        if steps:
+            self.data = data
+            self.calibration = steps
+            self.logger.debug("Calibrated {}: {}".format(self.fits_file, ', '.join(steps)))
+
+        return self.calibration
+
+    def photometry(self, positions=None, coords=None, **kwargs):
+        """ Aperture photometry of stars on each Bayer channel
+
+        Stars are given either as pixel `positions` or as sky `coords`, which
+        need the WCS of the image. Calibrate the image first (see `calibrate`) to
+        measure calibrated fluxes.
+
+        Args:
+            positions (numpy.ndarray, optional): N x 2 array of 0-based (x, y) pixel positions
+            coords (astropy.coordinates.SkyCoord, optional): Positions of the stars on the sky
+            **kwargs: Options for `pocs.utils.photometry.aperture_photometry`
+
+        Returns:
+            astropy.table.Table: Fluxes for each star, see `aperture_photometry`
+        """
+        assert (positions is None) != (coords is None), \
+            self.logger.warning("Need either positions or coords")
+
+        if coords is not None:
+            positions = get_positions(self.wcs, coords)
+
+        return aperture_photometry(self.data, positions, **kwargs)
+
     def compute_offset(self, ref, units='arcsec', rotation=True):
         if isinstance(units, (u.Unit, u.Quantity, u.IrreducibleUnit)):
             units = units.name
@@ -176,8 +310,11 @@ class Image(PanBase):
             ref = Image(ref)
         assert isinstance(ref, Image), self.logger.warning("Not an Image: {}".format(ref))
 
-        offset_pix = compute_offset_rotation(ref.luminance, self.luminance,
-                                             rotation=rotation, upsample_factor=20)
+        # The reference is usually the same for a whole observation so its
+        # registration is cached and its data only read the first time
+        registration = get_registration(lambda: ref.luminance,
+                                        cache_key=(ref.fits_file, os.path.getmtime(ref.fits_file)))
+        offset_pix = registration.offset_rotation(self.luminance, upsample_factor=20)
         offset_pix['X'] *= 2
         offset_pix['Y'] *= 2
 
@@ -236,523 +373,201 @@ class Image(PanBase):
             assert key in self.header, self.logger.warning("Missing required header: {}".format(key))
 
 
-def compute_offset_rotation(im, imref, rotation=True, upsample_factor=20, subframe_size=200):
-    assert im.shape == imref.shape
-    ny, nx = im.shape
-
-    subframe_half = int(subframe_size / 2)
-
-    # Create the center point for each of our regions
-    regions = {
-        'center': (int(nx / 2), int(ny / 2)),
-        'upper_right': (int(nx - subframe_half), int(ny - subframe_half)),
-        'upper_left': (int(subframe_half), int(ny - subframe_half)),
-        'lower_right': (int(nx - subframe_half), int(subframe_half)),
-        'lower_left': (int(subframe_half), int(subframe_half)),
-    }
-
-    offsets = {
-        'center': None,
-        'upper_right': None,
-        'upper_left': None,
-        'lower_right': None,
-        'lower_left': None,
-    }
-
-    # Get im/imref offsets for each region
-    for region, midpoint in regions.items():
-        imarr = crop_data(im, center=midpoint, box_width=subframe_size)
-        imrefarr = crop_data(imref, center=midpoint, box_width=subframe_size)
-
-        shifts, err, h = register_translation(imrefarr, imarr, upsample_factor=upsample_factor)
-        offsets[region] = shifts
-
-    # Rotate the offsets according to region
-    angles = []
-    for region in regions.keys():
-        if region != 'center':
-            offsets[region] -= offsets['center']
-
-            relpos = (regions[region][0] - regions['center'][0],
-                      regions[region][1] - regions['center'][1])
-
-            theta1 = np.arctan(relpos[1] / relpos[0])
-            theta2 = np.arctan((relpos[1] + offsets[region][1]) / (relpos[0] + offsets[region][0]))
-            angles.append(theta2 - theta1)
-
-    angle = np.mean(angles)
-
-    result = {'X': offsets['center'][0] * u.pix,
-              'Y': offsets['center'][1] * u.pix,
-              'angle': (angle * u.radian).to(u.degree)}
-
-    return result
-
-
-# ---------------------------------------------------------------------
-# IO Functions
-# ---------------------------------------------------------------------
-def cr2_to_fits(
-        cr2_fname,
-        fits_fname=None,
-        clobber=False,
-        headers={},
-        fits_headers={},
-        remove_cr2=False,
-        **kwargs):  # pragma: no cover
-    """ Convert a CR2 file to FITS
-
-    This is a convenience function that first converts the CR2 to PGM via `cr2_to_pgm`. Also adds keyword headers
-    to the FITS file.
-
-    Note:
-        The intermediate PGM file is automatically removed
-
-    Arguments:
-        cr2_fname {str} -- Name of CR2 file to be converted
-        **kwargs {dict} -- Additional keywords to be used
-
-    Keyword Arguments:
-        fits_fname {str} -- Name of FITS file to output. If None (default), the `cr2_fname` is used
-            as base (default: {None})
-        clobber {bool} -- A bool indicating if existing FITS should be clobbered (default: {False})
-        headers {dict} -- Header data that is filtered and added to the FITS header.
-        fits_headers {dict} -- Header data that is added to the FITS header without filtering.
-        remove_cr2 {bool} -- A bool indicating if the CR2 should be removed (default: {False})
-
-    """
-
-    verbose = kwargs.get('verbose', False)
-
-    if fits_fname is None:
-        fits_fname = cr2_fname.replace('.cr2', '.fits')
-
-    if not os.path.exists(fits_fname) or clobber:
-        if verbose:
-            print("Converting CR2 to PGM: {}".format(cr2_fname))
-
-        # Convert the CR2 to a PGM file then delete PGM
-        pgm = read_pgm(cr2_to_pgm(cr2_fname), remove_after=True)
-
-        # Add the EXIF information from the CR2 file
-        exif = read_exif(cr2_fname)
-
-        # Set the PGM as the primary data for the FITS file
-        hdu = fits.PrimaryHDU(pgm)
-
-        # Set some default headers
-        hdu.header.set('FILTER', 'RGGB')
-        hdu.header.set('ISO', exif.get('ISO', ''))
-        hdu.header.set('EXPTIME', exif.get('ExposureTime', 'Seconds'))
-        hdu.header.set('CAMTEMP', exif.get('CameraTemperature', ''), 'Celsius - From CR2')
-        hdu.header.set('CIRCCONF', exif.get('CircleOfConfusion', ''), 'From CR2')
-        hdu.header.set('COLORTMP', exif.get('ColorTempMeasured', ''), 'From CR2')
-        hdu.header.set('DATE-OBS', date_parser.parse(exif.get('DateTimeOriginal', '').replace(':', '-', 2)).isoformat())
-        hdu.header.set('FILENAME', exif.get('FileName', ''), 'From CR2')
-        hdu.header.set('INTSN', exif.get('InternalSerialNumber', ''), 'From CR2')
-        hdu.header.set('CAMSN', exif.get('SerialNumber', ''), 'From CR2')
-        hdu.header.set('MEASEV', exif.get('MeasuredEV', ''), 'From CR2')
-        hdu.header.set('MEASEV2', exif.get('MeasuredEV2', ''), 'From CR2')
-        hdu.header.set('MEASRGGB', exif.get('MeasuredRGGB', ''), 'From CR2')
-        hdu.header.set('WHTLVLN', exif.get('NormalWhiteLevel', ''), 'From CR2')
-        hdu.header.set('WHTLVLS', exif.get('SpecularWhiteLevel', ''), 'From CR2')
-        hdu.header.set('REDBAL', exif.get('RedBalance', ''), 'From CR2')
-        hdu.header.set('BLUEBAL', exif.get('BlueBalance', ''), 'From CR2')
-        hdu.header.set('WBRGGB', exif.get('WB_RGGBLevelAsShot', ''), 'From CR2')
-
-        hdu.header.set('IMAGEID', headers.get('image_id', ''))
-        hdu.header.set('SEQID', headers.get('sequence_id', ''))
-        hdu.header.set('FIELD', headers.get('field_name', ''))
-        hdu.header.set('RA-MNT', headers.get('ra_mnt', ''), 'Degrees')
-        hdu.header.set('HA-MNT', headers.get('ha_mnt', ''), 'Degrees')
-        hdu.header.set('DEC-MNT', headers.get('dec_mnt', ''), 'Degrees')
-        hdu.header.set('EQUINOX', headers.get('equinox', ''))
-        hdu.header.set('AIRMASS', headers.get('airmass', ''), 'Sec(z)')
-        hdu.header.set('FILTER', headers.get('filter', ''))
-        hdu.header.set('LAT-OBS', headers.get('latitude', ''), 'Degrees')
-        hdu.header.set('LONG-OBS', headers.get('longitude', ''), 'Degrees')
-        hdu.header.set('ELEV-OBS', headers.get('elevation', ''), 'Meters')
-        hdu.header.set('MOONSEP', headers.get('moon_separation', ''), 'Degrees')
-        hdu.header.set('MOONFRAC', headers.get('moon_fraction', ''))
-        hdu.header.set('CREATOR', headers.get('creator', ''), 'POCS Software version')
-        hdu.header.set('INSTRUME', headers.get('camera_uid', ''), 'Camera ID')
-        hdu.header.set('OBSERVER', headers.get('observer', ''), 'PANOPTES Unit ID')
-        hdu.header.set('ORIGIN', headers.get('origin', ''))
-
-        if verbose:
-            print("Adding provided FITS header")
-
-        for key, value in fits_headers.items():
-            try:
-                hdu.header.set(key.upper()[0: 8], value)
-            except:
-                pass
-
-        try:
-            if verbose:
-                print("Saving fits file to: {}".format(fits_fname))
-
-            hdu.writeto(fits_fname, output_verify='silentfix', clobber=clobber)
-        except Exception as e:
-            warn("Problem writing FITS file: {}".format(e))
-        else:
-            if remove_cr2:
-                os.unlink(cr2_fname)
-
-    return fits_fname
-
-
-def cr2_to_pgm(cr2_fname, pgm_fname=None, dcraw='dcraw', clobber=True, **kwargs):  # pragma: no cover
-    """ Convert CR2 file to PGM
-
-    Converts a raw Canon CR2 file to a netpbm PGM file via `dcraw`. Assumes
-    `dcraw` is installed on the system
-
-    Note:
-        This is a blocking call
-
-    Arguments:
-        cr2_fname {str} -- Name of CR2 file to convert
-        **kwargs {dict} -- Additional keywords to pass to script
-
-    Keyword Arguments:
-        pgm_fname {str} -- Name of PGM file to output, if None (default) then
-                           use same name as CR2 (default: {None})
-        dcraw {str} -- Path to installed `dcraw` (default: {'dcraw'})
-        clobber {bool} -- A bool indicating if existing PGM should be clobbered
-                         (default: {True})
-
-    Returns:
-        str -- Filename of PGM that was created
-
-    """
-
-    assert subprocess.call('dcraw', stdout=subprocess.PIPE),\
-        "could not execute dcraw in path: {}".format(dcraw)
-    assert os.path.exists(cr2_fname), "cr2 file does not exist at {}".format(
-                                      cr2_fname)
-
-    verbose = kwargs.get('verbose', False)
-
-    if pgm_fname is None:
-        pgm_fname = cr2_fname.replace('.cr2', '.pgm')
-
-    if os.path.exists(pgm_fname) and not clobber:
-        if verbose:
-            print("PGM file exists, returning existing file: {}".format(
-                  pgm_fname))
-    else:
-        try:
-            # Build the command for this file
-            command = '{} -t 0 -D -4 {}'.format(dcraw, cr2_fname)
-            cmd_list = command.split()
-            if verbose:
-                print("PGM Conversion command: \n {}".format(cmd_list))
-
-            # Run the command
-            if subprocess.check_call(cmd_list) == 0:
-                if verbose:
-                    print("PGM Conversion command successful")
-
-        except subprocess.CalledProcessError as err:
-            raise error.InvalidSystemCommand(msg="File: {} \n err: {}".format(
-                cr2_fname, err))
-
-    return pgm_fname
-
-
-def read_exif(fname, exiftool='exiftool'):  # pragma: no cover
-    """ Read the EXIF information
+def compute_offset_rotation(im, imref, rotation=True, upsample_factor=20, subframe_size=200,
+                            regions=None, cache_key=None):
+    """ Compute the offset and rotation of `imref` relative to `im`
 
-    Gets the EXIF information using exiftool
-
-    Note:
-        Assumes the `exiftool` is installed
+    Sub-frames at each of the `regions` are registered separately (see
+    `SubframeRegistration`). The offset of the center region gives the
+    translation and the offsets of the others relative to it give the rotation.
 
     Args:
-        fname {str} -- Name of file (CR2) to read
-
-    Keyword Args:
-        exiftool {str} -- Location of exiftool (default: {'/usr/bin/exiftool'})
+        im(np.array):           The fixed image. The Fourier transforms of its
+                                sub-frames are cached if `cache_key` is given.
+        imref(np.array):        The image to compare to `im`.
+        upsample_factor(int):   Registration precision is 1 / `upsample_factor` pixels,
+                                defaults to 20.
+        subframe_size(int):     Size of the regions in pixels, defaults to 200.
+        regions(dict):          Name and (x, y) center of the regions to register, must
+                                include a `center` region. Defaults to `get_regions`.
+        cache_key(hashable):    Key under which the registration for `im` is cached,
+                                defaults to None (no caching).
 
     Returns:
-        dict -- Dictonary of EXIF information
-
+        dict:                   The `X` and `Y` offset and rotation `angle`
     """
-    assert os.path.exists(fname), warn("File does not exist: {}".format(fname))
-    exif = {}
-
-    try:
-        # Build the command for this file
-        command = '{} -j {}'.format(exiftool, fname)
-        cmd_list = command.split()
+    registration = get_registration(im, cache_key=cache_key, regions=regions, subframe_size=subframe_size)
+    assert registration.shape == imref.shape
 
-        # Run the command
-        exif = loads(subprocess.check_output(cmd_list).decode('utf-8'))
-    except subprocess.CalledProcessError as err:
-        raise error.InvalidSystemCommand(msg="File: {} \n err: {}".format(fname, err))
+    return registration.offset_rotation(imref, upsample_factor=upsample_factor)
 
-    return exif[0]
 
+def get_regions(shape, subframe_size=200, grid=None):
+    """ Center points of the regions used for registration
 
-def read_pgm(fname, byteorder='>', remove_after=False):  # pragma: no cover
-    """Return image data from a raw PGM file as numpy array.
-
-    Note:
-        Format Spec: http://netpbm.sourceforge.net/doc/pgm.html
-        Source: http://stackoverflow.com/questions/7368739/numpy-and-16-bit-pgm
-
-    Note:
-        This is correctly processed as a Big endian even though the CR2 itself
-        marks it as a Little endian. See the notes in Source page above as well
-        as the comment about significant bit in the Format Spec
+    By default these are the center and the four corners of the image. A `grid`
+    of regions spread evenly over the image can be used instead, in which case
+    a `center` region is always included.
 
     Args:
-        fname(str):         Filename of PGM to be converted
-        byteorder(str):     Big endian
-        remove_after(bool): Delete fname file after reading, defaults to False.
-        clobber(bool):      Clobber existing PGM or not, defaults to True
+        shape(tuple):           Shape of the image
+        subframe_size(int):     Size of each region in pixels, defaults to 200.
+        grid(tuple):            Number of regions along (x, y), defaults to None.
 
     Returns:
-        numpy.array:        The raw data from the PGMx
-
+        OrderedDict:            Name and (x, y) center of each region
     """
+    ny, nx = shape
 
-    with open(fname, 'rb') as f:
-        buffer = f.read()
-
-    # We know our header info is 19 chars long
-    header_offset = 19
-
-    img_type, img_size, img_max_value, _ = buffer[0:header_offset].decode().split('\n')
+    subframe_half = int(subframe_size / 2)
 
-    assert img_type == 'P5', warn("No a PGM file")
+    regions = OrderedDict()
+    regions['center'] = (int(nx / 2), int(ny / 2))
 
-    # Get the width and height (as strings)
-    width, height = img_size.split(' ')
+    if grid is None:
+        regions['upper_right'] = (int(nx - subframe_half), int(ny - subframe_half))
+        regions['upper_left'] = (int(subframe_half), int(ny - subframe_half))
+        regions['lower_right'] = (int(nx - subframe_half), int(subframe_half))
+        regions['lower_left'] = (int(subframe_half), int(subframe_half))
+    else:
+        grid_x, grid_y = grid
+        for row, y in enumerate(np.linspace(subframe_half, ny - subframe_half, grid_y).astype(int)):
+            for col, x in enumerate(np.linspace(subframe_half, nx - subframe_half, grid_x).astype(int)):
+                if (x, y) != regions['center']:
+                    regions['row{}_col{}'.format(row, col)] = (int(x), int(y))
 
-    data = np.flipud(np.frombuffer(buffer[header_offset:],
-                                   dtype=byteorder + 'u2',
-                                   ).reshape((int(height), int(width))))
+    return regions
 
-    if remove_after:
-        os.remove(fname)
 
-    return data
+class SubframeRegistration(object):
 
+    """ Registration of sub-frames against a fixed image
 
-def solve_field(fname, timeout=15, solve_opts=[], **kwargs):
-    """ Plate solves an image.
+    The Fourier transforms of the sub-frames of the fixed image are computed
+    once when the object is created. Each call to `register` then only needs the
+    transforms of the new image, which are done for all regions in one batched
+    call. See `get_registration` for a cached instance.
 
     Args:
-        fname(str, required):       Filename to solve in either .cr2 or .fits
-                                    extension.
-        timeout(int, optional):     Timeout for the solve-field command,
-                                    defaults to 60 seconds.
-        solve_opts(list, optional): List of options for solve-field.
-        verbose(bool, optional):    Show output, defaults to False.
+        data(np.array):         The fixed image
+        regions(dict):          Name and (x, y) center of the regions to register,
+                                defaults to `get_regions`
+        subframe_size(int):     Size of the regions in pixels, defaults to 200.
     """
-    verbose = kwargs.get('verbose', False)
-    if verbose:
-        print("Entering solve_field")
 
-    solve_field_script = "{}/scripts/solve_field.sh".format(os.getenv('POCS'), '/var/panoptes/POCS')
+    def __init__(self, data, regions=None, subframe_size=200):
+        if regions is None:
+            regions = get_regions(data.shape, subframe_size=subframe_size)
 
-    if not os.path.exists(solve_field_script):  # pragma: no cover
-        raise error.InvalidSystemCommand("Can't find solve-field: {}".format(solve_field_script))
-
-    # Add the options for solving the field
-    if solve_opts:
-        options = solve_opts
-    else:
-        options = [
-            '--guess-scale',
-            '--cpulimit', str(timeout),
-            '--no-verify',
-            '--no-plots',
-            '--no-fits2fits',
-            '--crpix-center',
-            '--temp-axy',
-            '--match', 'none',
-            '--corr', 'none',
-            '--wcs', 'none',
-            '--downsample', '4',
-        ]
-        if kwargs.get('clobber', True):
-            options.append('--overwrite')
-        if kwargs.get('skip_solved', True):
-            options.append('--skip-solved')
-
-        if 'ra' in kwargs:
-            options.append('--ra')
-            options.append(str(kwargs.get('ra')))
-        if 'dec' in kwargs:
-            options.append('--dec')
-            options.append(str(kwargs.get('dec')))
-        if 'radius' in kwargs:
-            options.append('--radius')
-            options.append(str(kwargs.get('radius')))
-
-        if os.getenv('PANTEMP'):
-            options.append('--temp-dir')
-            options.append(os.getenv('PANTEMP'))
-
-    cmd = [solve_field_script, ' '.join(options), fname]
-    if verbose:
-        print("Cmd: ", cmd)
-
-    try:
-        proc = subprocess.Popen(cmd, universal_newlines=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except OSError as e:
-        raise error.InvalidCommand("Can't send command to solve_field.sh: {} \t {}".format(e, cmd))
-    except ValueError as e:
-        raise error.InvalidCommand("Bad parameters to solve_field: {} \t {}".format(e, cmd))
-    except Exception as e:
-        raise error.PanError("Timeout on plate solving: {}".format(e))
-
-    return proc
+        assert 'center' in regions, "Regions must include a 'center' region"
 
+        self.shape = data.shape
+        self.subframe_size = subframe_size
+        self.regions = OrderedDict(regions)
 
-def get_solve_field(fname, replace=True, remove_extras=True, **kwargs):
-    """Convenience function to wait for `solve_field` to finish.
+        self._freq = np.fft.fft2(self._subframes(data))
 
-    This function merely passes the `fname` of the image to be solved along to `solve_field`,
-    which returns a subprocess.Popen object. This function then waits for that command
-    to complete, populates a dictonary with the EXIF informaiton and returns. This is often
-    more useful than the raw `solve_field` function
+    def register(self, data, upsample_factor=20):
+        """ Get the shift of each region of `data` relative to the fixed image
 
-    Args:
-        fname ({str}): Name of file to be solved, either a FITS or CR2
-        replace (bool, optional): Replace fname the solved file
-        remove_extras (bool, optional): Remove the files generated by solver
-        **kwargs ({dict}): Options to pass to `solve_field`
+        Args:
+            data(np.array):         The image to register
+            upsample_factor(int):   Registration precision is 1 / `upsample_factor`
+                                    pixels, defaults to 20.
 
-    Returns:
-        dict: Keyword information from the solved field
-    """
-    verbose = kwargs.get('verbose', False)
-    out_dict = {}
+        Returns:
+            OrderedDict:            The shift for each region
+        """
+        assert data.shape == self.shape, "Can't register data of shape {} to {}".format(data.shape, self.shape)
 
-    # Check for solved file
-    if kwargs.get('skip_solved', True) and os.path.exists(fname.replace('.fits', '.solved')):
-        if verbose:
-            print("Solved file exists, skipping (pass skip_solved=False to solve again): {}".format(fname))
+        data_freq = np.fft.fft2(self._subframes(data))
 
-        out_dict['solved_fits_file'] = fname
-        return out_dict
+        offsets = OrderedDict()
+        for i, region in enumerate(self.regions):
+            shifts, err, h = register_translation(data_freq[i], self._freq[i],
+                                                  upsample_factor=upsample_factor,
+                                                  space='fourier')
+            offsets[region] = shifts
 
-    if verbose:
-        print("Entering get_solve_field: {}".format(fname))
+        return offsets
 
-    # Set a default radius of 15
-    kwargs.setdefault('radius', 15)
+    def offset_rotation(self, data, upsample_factor=20):
+        """ Get the offset and rotation of `data` relative to the fixed image
 
-    proc = solve_field(fname, **kwargs)
-    try:
-        output, errs = proc.communicate(timeout=kwargs.get('timeout', 30))
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        output, errs = proc.communicate()
-    else:
-        if verbose:
-            print(output)
+        See `compute_offset_rotation`
+        """
+        offsets = self.register(data, upsample_factor=upsample_factor)
 
-        if not os.path.exists(fname.replace('.fits', '.solved')):
-            raise error.SolveError('File not solved')
+        center = self.regions['center']
 
-        try:
-            # Handle extra files created by astrometry.net
-            new = fname.replace('.fits', '.new')
-            rdls = fname.replace('.fits', '.rdls')
-            xyls = fname.replace('.fits', '-indx.xyls')
+        # Rotate the offsets according to region
+        angles = []
+        for region, midpoint in self.regions.items():
+            relpos = (midpoint[0] - center[0], midpoint[1] - center[1])
 
-            if replace and os.path.exists(new):
-                # Remove converted fits
-                os.remove(fname)
-                # Rename solved fits to proper extension
-                os.rename(new, fname)
+            if region == 'center' or relpos == (0, 0):
+                continue
 
-                out_dict['solved_fits_file'] = fname
-            else:
-                out_dict['solved_fits_file'] = new
+            offset = offsets[region] - offsets['center']
 
-            if remove_extras:
-                for f in [rdls, xyls]:
-                    if os.path.exists(f):
-                        os.remove(f)
+            theta1 = np.arctan2(relpos[1], relpos[0])
+            theta2 = np.arctan2(relpos[1] + offset[1], relpos[0] + offset[0])
 
-        except Exception as e:
-            warn('Cannot remove extra files: {}'.format(e))
+            # Wrap to [-pi, pi)
+            angles.append((theta2 - theta1 + np.pi) % (2 * np.pi) - np.pi)
 
-    if errs is not None:
-        warn("Error in solving: {}".format(errs))
-    else:
-        # Read the EXIF information from the CR2
-        if fname.endswith('cr2'):
-            out_dict.update(read_exif(fname))
+        angle = np.mean(angles)
 
-        try:
-            out_dict.update(fits.getheader(fname))
-        except OSError:
-            if verbose:
-                print("Can't read fits header for {}".format(fname))
+        result = {'X': offsets['center'][0] * u.pix,
+                  'Y': offsets['center'][1] * u.pix,
+                  'angle': (angle * u.radian).to(u.degree)}
 
-    return out_dict
+        return result
 
+    def _subframes(self, data):
+        return np.array([crop_data(data, center=midpoint, box_width=self.subframe_size)
+                         for midpoint in self.regions.values()])
 
-def make_pretty_image(fname, timeout=15, **kwargs):  # pragma: no cover
-    """ Make a pretty image
 
-    This calls out to an external script which will try to extract the JPG
-    directly from the CR2 file, otherwise will do an actual conversion
+_registration_cache = OrderedDict()
+_registration_cache_size = 8
 
-    Notes:
-        See `$POCS/scripts/cr2_to_jpg.sh`
 
-    Arguments:
-        fname {str} -- Name of CR2 file
-        **kwargs {dict} -- Additional arguments to be passed to external script
+def get_registration(data, cache_key=None, regions=None, subframe_size=200):
+    """ Get a `SubframeRegistration` for `data`, reusing a cached one if available
 
-    Keyword Arguments:
-        timeout {number} -- Process timeout (default: {15})
+    Args:
+        data(np.array or callable):     The fixed image, or a function returning it. A
+                                        function is only called if there is no cached
+                                        registration, so the data need not be read at all.
+        cache_key(hashable):            Key for the fixed image, e.g. the filename and
+                                        modification time. Defaults to None, in which
+                                        case nothing is cached.
+        regions(dict):                  See `SubframeRegistration`
+        subframe_size(int):             See `SubframeRegistration`
 
     Returns:
-        str -- Filename of image that was created
-
+        SubframeRegistration:           The registration for `data`
     """
-    assert os.path.exists(fname),\
-        warn("File doesn't exist, can't make pretty: {}".format(fname))
-
-    verbose = kwargs.get('verbose', False)
+    key = None
+    if cache_key is not None:
+        key = (cache_key, subframe_size, None if regions is None else tuple(regions.items()))
 
-    title = '{} {}'.format(kwargs.get('title', ''), current_time().isot)
+        if key in _registration_cache:
+            _registration_cache.move_to_end(key)
+            return _registration_cache[key]
 
-    solve_field = "{}/scripts/cr2_to_jpg.sh".format(os.getenv('POCS'),
-                                                    '/var/panoptes/POCS')
-    cmd = [solve_field, fname, title]
+    if callable(data):
+        data = data()
 
-    if kwargs.get('primary', False):
-        cmd.append('link')
-
-    if verbose:
-        print(cmd)
+    registration = SubframeRegistration(data, regions=regions, subframe_size=subframe_size)
 
-    try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
-                                stderr=subprocess.DEVNULL)
-        if verbose:
-            print(proc)
-    except OSError as e:
-        raise error.InvalidCommand("Can't send command to gphoto2."
-                                   " {} \t {}".format(e, cmd))
-    except ValueError as e:
-        raise error.InvalidCommand("Bad parameters to gphoto2."
-                                   " {} \t {}".format(e, cmd))
-    except Exception as e:
-        raise error.PanError("Timeout on plate solving: {}".format(e))
+    if key is not None:
+        _registration_cache[key] = registration
+        while len(_registration_cache) > _registration_cache_size:
+            _registration_cache.popitem(last=False)
 
-    return fname.replace('cr2', 'jpg')
+    return registration
 
 
 def crop_data(data, box_width=200, center=None, verbose=False):
@@ -790,90 +605,3 @@ def crop_data(data, box_width=200, center=None, verbose=False):
     center = data[x_center - box_width: x_center + box_width, y_center - box_width: y_center + box_width]
 
     return center
-
-
-def get_wcsinfo(fits_fname, verbose=False):  # pragma: no cover
-    """Returns the WCS information for a FITS file.
-    Uses the `wcsinfo` astrometry.net utility script to get the WCS information from a plate-solved file
-    Parameters
-    ----------
-    fits_fname : {str}
-        Name of a FITS file that contains a WCS.
-    verbose : {bool}, optional
-        Verbose (the default is False)
-    Returns
-    -------
-    dict
-        Output as returned from `wcsinfo`
-    """
-    assert os.path.exists(fits_fname), warn("No file exists at: {}".format(fits_fname))
-
-    wcsinfo = shutil.which('wcsinfo')
-    if wcsinfo is None:
-        wcsinfo = '{}/astrometry/bin/wcsinfo'.format(os.getenv('PANDIR', default='/var/panoptes'))
-
-    run_cmd = [wcsinfo, fits_fname]
-
-    if verbose:
-        print("wcsinfo command: {}".format(run_cmd))
-
-    proc = subprocess.Popen(run_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    try:
-        output, errs = proc.communicate(timeout=5)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        output, errs = proc.communicate()
-
-    unit_lookup = {
-        'crpix0': u.pixel,
-        'crpix1': u.pixel,
-        'crval0': u.degree,
-        'crval1': u.degree,
-        'cd11': (u.deg / u.pixel),
-        'cd12': (u.deg / u.pixel),
-        'cd21': (u.deg / u.pixel),
-        'cd22': (u.deg / u.pixel),
-        'imagew': u.pixel,
-        'imageh': u.pixel,
-        'pixscale': (u.arcsec / u.pixel),
-        'orientation': u.degree,
-        'ra_center': u.degree,
-        'dec_center': u.degree,
-        'orientation_center': u.degree,
-        'ra_center_h': u.hourangle,
-        'ra_center_m': u.minute,
-        'ra_center_s': u.second,
-        'dec_center_d': u.degree,
-        'dec_center_m': u.minute,
-        'dec_center_s': u.second,
-        'fieldarea': (u.degree * u.degree),
-        'fieldw': u.degree,
-        'fieldh': u.degree,
-        'decmin': u.degree,
-        'decmax': u.degree,
-        'ramin': u.degree,
-        'ramax': u.degree,
-        'ra_min_merc': u.degree,
-        'ra_max_merc': u.degree,
-        'dec_min_merc': u.degree,
-        'dec_max_merc': u.degree,
-        'merc_diff': u.degree,
-    }
-
-    wcs_info = {}
-    for line in output.split('\n'):
-        try:
-            k, v = line.split(' ')
-            try:
-                v = float(v)
-            except:
-                pass
-
-            wcs_info[k] = float(v) * unit_lookup.get(k, 1)
-        except ValueError:
-            pass
-            # print("Error on line: {}".format(line))
-
-    wcs_info['wcs_file'] = fits_fname
-
-    return wcs_info
@@ -3,13 +3,18 @@ import os
 import time
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
 from astroplan import Observer
 from astropy import units as u
 from astropy.coordinates import EarthLocation
 from astropy.coordinates import get_moon
 from astropy.coordinates import get_sun
+from astropy.io import fits
+from astropy.wcs import WCS
 
 from . import PanBase
 from .scheduler.constraint import Duration
@@ -19,6 +24,13 @@ from .utils import error
 from .utils import images
 from .utils import list_connected_cameras
 from .utils import load_module
+from .utils import pretty
+from .utils import quality
+from .utils import sources
+from .utils.calibration import get_calibration_library
+from .utils.solve_server import SolverClient
+from .utils.solver import SolverPool
+from .utils.stacking import SequenceStack
 
 
 class Observatory(PanBase):
@@ -55,6 +67,18 @@ class Observatory(PanBase):
 
         self.offset_info = None
 
+        self._solver = None
+        self._solve_jobs = dict()
+        self._ref_sources = None
+        self._rejected = dict()
+
+        self._stacks = dict()
+        self._stack_executor = None
+        self._unstacked = dict()
+
+        self._pretty_executor = None
+        self._pretty_job = None
+
         self._image_dir = self.config['directories']['images']
         self.logger.info('\t Observatory initialized')
 
@@ -92,6 +116,43 @@ class Observatory(PanBase):
     def current_observation(self):
         return self.scheduler.current_observation
 
+    @property
+    def solver(self):
+        """ Pool of processes used for plate solving, created on first use """
+        if self._solver is None:
+            solver_config = self.config.get('solver', {})
+
+            kwargs = {'max_workers': solver_config.get('max_workers')}
+
+            # Send the solves to a running solver server if there is one
+            if solver_config.get('address'):
+                client = SolverClient(address=solver_config['address'])
+                if client.ping(timeout=2):
+                    kwargs['solve_func'] = client.get_solve_field
+                else:
+                    self.logger.warning("No solver server at {}, solving locally".format(client.address))
+                client.close()
+
+            self._solver = SolverPool(**kwargs)
+
+        return self._solver
+
+    @property
+    def stack_executor(self):
+        """ Single background thread that adds frames to the co-adds in order """
+        if self._stack_executor is None:
+            self._stack_executor = ThreadPoolExecutor(max_workers=1)
+
+        return self._stack_executor
+
+    @property
+    def pretty_executor(self):
+        """ Single background thread that makes the pretty images """
+        if self._pretty_executor is None:
+            self._pretty_executor = ThreadPoolExecutor(max_workers=1)
+
+        return self._pretty_executor
+
 
 ##################################################################################################
 # Methods
@@ -100,6 +161,16 @@ class Observatory(PanBase):
     def power_down(self):
         self.logger.debug("Shutting down observatory")
 
+        if self._solver is not None:
+            self._solver.shutdown(wait=False)
+
+        if self._stack_executor is not None:
+            self._write_stacks(close=True)
+            self._stack_executor.shutdown(wait=True)
+
+        if self._pretty_executor is not None:
+            self._pretty_executor.shutdown(wait=False)
+
     def status(self):
         """ Get the status for various parts of the observatory """
         status = {}
@@ -239,27 +310,56 @@ class Observatory(PanBase):
 
         self.current_observation.current_exp += 1
 
+        # Update the co-adds at the end of each set
+        if self.current_observation.current_exp % self.current_observation.exp_set_size == 0:
+            self._write_stacks()
+
     def _process_observation(self, image_id, info):
         self.logger.debug("Processing {}".format(image_id))
         file_path = info['file_path']
 
-        # Make pretty image
-        if info['is_primary']:
-            self.logger.debug("Extracting pretty image")
-            images.make_pretty_image(file_path, title=image_id, primary=True)
+        # Only the primary frames are solved, the others are compressed as they are written
+        compress = not info['is_primary']
+        compression = self.config.get('compression', {})
 
         self.logger.debug("Converting CR2 -> FITS: {}".format(file_path))
-        fits_path = images.cr2_to_fits(file_path, headers=info, remove_cr2=True)
+        timings = dict()
+
+        # Make the pretty image from the data decoded for the FITS file
+        on_data = None
+        if info['is_primary']:
+            def on_data(data, header):
+                self._make_pretty_image(data, file_path, image_id)
+
+        fits_path = images.cr2_to_fits(file_path, headers=info, remove_cr2=True, timings=timings,
+                                       compress=compress,
+                                       tile_size=compression.get('tile_size'),
+                                       quantize_level=compression.get('quantize_level', 16),
+                                       on_data=on_data)
+        self.logger.debug("Conversion timings: {}".format(timings))
 
         if info['is_primary']:
             self.current_observation.exposure_list[image_id] = fits_path
-        else:
-            self.logger.debug('Compressing image')
-            compressed = images.fpack(fits_path)
-            self.logger.debug('Compressed image: {}'.format(compressed))
+
+            problems = self._check_quality(info, fits_path)
+            if problems:
+                self._rejected[fits_path] = problems
+
+            # Start solving now so the result is ready (or close) when analyzing
+            if self._needs_solve(self.current_observation.current_exp) and not problems:
+                self._solve_jobs[fits_path] = self.solver.submit(fits_path,
+                                                                 ra=self.current_observation.field.ra.value,
+                                                                 dec=self.current_observation.field.dec.value,
+                                                                 radius=15)
 
         info['file_path'] = fits_path
 
+        # Primary frames are only stacked once `analyze_recent` is done solving and compressing them
+        if info['is_primary']:
+            self._unstacked[fits_path] = info
+        else:
+            self._add_to_stack(info, fits_path)
+
         self.logger.debug("Adding image metadata to db: {}".format(image_id))
         self.db.observations.insert_one({
             'data': info,
@@ -283,10 +383,9 @@ class Observatory(PanBase):
 
         # If we just finished the first exposure, solve the image so it can be reference
         if self.current_observation.current_exp == 1:
-            solve_info = images.get_solve_field(ref_image_path,
-                                                ra=self.current_observation.field.ra.value,
-                                                dec=self.current_observation.field.dec.value,
-                                                radius=15)
+            # The reference is needed however poor it is
+            self._rejected.pop(ref_image_path, None)
+            solve_info = self._get_solve_info(ref_image_path)
 
             try:
                 del solve_info['HISTORY']  # Don't show full history
@@ -294,17 +393,33 @@ class Observatory(PanBase):
             except KeyError:
                 pass
             self.logger.debug("Reference Solve Info: {}".format(solve_info))
+
+            # The reference is kept as it is for the offsets
+            self._stack_analyzed(ref_image_path, ref_image_path)
         else:
             # Get the image to compare
             image_id, image_path = self.current_observation.last_exposure
-            solve_info = images.get_solve_field(image_path,
-                                                ra=self.current_observation.field.ra.value,
-                                                dec=self.current_observation.field.dec.value,
-                                                radius=15)
+
+            # Frames that failed the quality checks aren't worth a solve
+            problems = self._rejected.pop(image_path, None)
+            if problems:
+                self.logger.warning("Not analyzing {}: {}".format(image_id, ', '.join(problems)))
+                # Nor are they worth co-adding
+                self._unstacked.pop(image_path, None)
+                images.fpack(image_path)
+                return self.offset_info
 
             # Get the WCS info
             ref_wcs_info = images.get_wcsinfo(ref_image_path)
-            image_wcs_info = images.get_wcsinfo(image_path)
+
+            # Only every few frames are solved, the rest are measured against the reference
+            image_wcs_info = None
+            if not self._needs_solve(self.current_observation.current_exp - 1):
+                image_wcs_info = self._get_centroid_wcs_info(ref_image_path, ref_wcs_info, image_path)
+
+            if image_wcs_info is None:
+                solve_info = self._get_solve_info(image_path)
+                image_wcs_info = images.get_wcsinfo(image_path)
 
             # Get time from image_id
             ref_wcs_info['date_obs'] = ref_image_id.split('_')[-1]
@@ -328,6 +443,8 @@ class Observatory(PanBase):
             compressed = images.fpack(image_path)
             self.logger.debug('Compressed image: {}'.format(compressed))
 
+            self._stack_analyzed(image_path, compressed)
+
         return self.offset_info
 
     def update_tracking(self):
@@ -382,6 +499,205 @@ class Observatory(PanBase):
 # Private Methods
 ##################################################################################################
 
+    def _needs_solve(self, exp_num):
+        """ If exposure number `exp_num` (starting at 0) should be plate-solved
+
+        The first exposure is the reference and is always solved, after that only every
+        `analysis.solve_every` exposure is solved.
+        """
+        solve_every = self.config.get('analysis', {}).get('solve_every', 10)
+
+        return solve_every <= 1 or exp_num % solve_every == 0
+
+    def _make_pretty_image(self, data, file_path, image_id):
+        """ Make the pretty images for a frame on the background thread
+
+        Only the latest frame waits to be done, an older frame that hasn't been
+        started yet is skipped.
+        """
+        if self._pretty_job is not None and self._pretty_job.cancel():
+            self.logger.debug("Skipping pretty image for previous frame")
+
+        def make_pretty():
+            try:
+                pretty.make_pretty_images(data, images.get_pretty_fname(file_path),
+                                          title='{} {}'.format(image_id, current_time().isot),
+                                          link=images.get_latest_link())
+            except Exception as e:
+                self.logger.warning("Problem making pretty image: {}".format(e))
+
+        self.logger.debug("Making pretty image")
+        self._pretty_job = self.pretty_executor.submit(make_pretty)
+
+    def _check_quality(self, info, fits_path):
+        """ Measure the quality of a frame and check it is worth analyzing
+
+        The measures are added to `info['quality']`. Uses the `quality` config: `enabled`
+        (default True), `num_sources` (stars measured, default 200), `min_stars` (default 10),
+        `max_fwhm` (pixels, default None to not check) and `max_ellipticity` (default 0.5).
+
+        Returns:
+            list: Problems with the frame, empty if it is fine (or isn't checked)
+        """
+        quality_config = self.config.get('quality', {})
+        if not quality_config.get('enabled', True):
+            return list()
+
+        try:
+            measures = quality.measure_image(fits_path, num_sources=quality_config.get('num_sources', 200))
+        except Exception as e:
+            self.logger.warning("Can't measure quality of {}: {}".format(fits_path, e))
+            return list()
+
+        problems = quality.check_quality(measures,
+                                         min_stars=quality_config.get('min_stars', 10),
+                                         max_fwhm=quality_config.get('max_fwhm'),
+                                         max_ellipticity=quality_config.get('max_ellipticity', 0.5))
+
+        info['quality'] = {key: measures[key] for key in
+                           ['background', 'noise', 'num_stars', 'fwhm', 'ellipticity', 'theta']}
+        info['quality']['problems'] = problems
+
+        self.logger.debug("Quality of {}: {} stars, FWHM {:.02f}, ellipticity {:.02f} ({:.02f}s)".format(
+            fits_path, measures['num_stars'], measures['fwhm'], measures['ellipticity'], measures['elapsed']))
+
+        return problems
+
+    def _get_centroid_wcs_info(self, ref_image_path, ref_wcs_info, image_path):
+        """ Estimate the WCS info for an image from the offset of its stars to the reference
+
+        The shift and rotation of the brightest stars on the luminance plane are used to
+        find where the center of the image falls on the (solved) reference image.
+
+        Returns:
+            dict: Copy of `ref_wcs_info` with `ra_center` and `dec_center` for the image,
+                or None if the offset couldn't be measured and the image should be solved
+        """
+        num_sources = self.config.get('analysis', {}).get('num_sources', 50)
+
+        try:
+            if self._ref_sources is None or self._ref_sources[0] != ref_image_path:
+                ref_data = images.bin_data(fits.getdata(ref_image_path), 2, np.float32, average=True)
+                self._ref_sources = (ref_image_path, sources.detect_sources(ref_data, num_sources=num_sources))
+
+            data = images.bin_data(fits.getdata(image_path), 2, np.float32, average=True)
+            offset = sources.compute_centroid_offset(data, self._ref_sources[1], num_sources=num_sources)
+        except Exception as e:
+            self.logger.warning("Can't measure offset from stars, solving instead: {}".format(e))
+            return None
+
+        self.logger.debug("Offset from {} stars: {:.02f} {:.02f} {:.03f} (rms {:.02f})".format(
+            offset['matches'], offset['X'], offset['Y'], offset['angle'], offset['rms']))
+
+        # Center of the image on the reference, in full size (binned by 2) FITS pixels
+        center = ((data.shape[1] - 1) / 2, (data.shape[0] - 1) / 2)
+        ref_x, ref_y = sources.to_reference(center, offset)[0] * 2 + 0.5 + 1
+
+        ref_wcs = WCS(fits.getheader(ref_image_path))
+        ra, dec = ref_wcs.all_pix2world([ref_x], [ref_y], 1)
+
+        image_wcs_info = dict(ref_wcs_info)
+        image_wcs_info['ra_center'] = ra[0] * u.degree
+        image_wcs_info['dec_center'] = dec[0] * u.degree
+        image_wcs_info['wcs_file'] = image_path
+
+        return image_wcs_info
+
+    def _add_to_stack(self, info, fits_path):
+        """ Add a frame to the co-add for its camera and sequence
+
+        Frames are added on a background thread (see `stack_executor`), so `fits_path`
+        must not change any more. A new co-add is started for each sequence, written to
+        `coadd.fits` in the directory of its frames. Uses the `stacking` config: `enabled`
+        (default False), `sigma` (default 5, None for no clipping), `min_frames` (default 5)
+        and `calibrate` (default True).
+        """
+        stack_config = self.config.get('stacking', {})
+        if not stack_config.get('enabled', False):
+            return
+
+        camera_uid = info['camera_uid']
+        sequence_id = info['sequence_id']
+
+        if camera_uid in self._stacks and self._stacks[camera_uid][0] != sequence_id:
+            self._write_stack(camera_uid, close=True)
+
+        if camera_uid not in self._stacks:
+            library = None
+            if stack_config.get('calibrate', True):
+                library = get_calibration_library()
+
+            stack = SequenceStack(sigma=stack_config.get('sigma', 5),
+                                  min_frames=stack_config.get('min_frames', 5),
+                                  num_sources=self.config.get('analysis', {}).get('num_sources', 50),
+                                  library=library)
+            coadd_path = os.path.join(os.path.dirname(fits_path), 'coadd.fits')
+
+            self._stacks[camera_uid] = (sequence_id, stack, coadd_path)
+
+        stack = self._stacks[camera_uid][1]
+        self.stack_executor.submit(self._stack_frame, stack, fits_path)
+
+    def _stack_analyzed(self, image_path, fits_path):
+        """ Add a primary frame to its co-add now `analyze_recent` is done with it
+
+        Args:
+            image_path (str): Path the frame was processed as
+            fits_path (str): Path of the frame now, e.g. after compressing it
+        """
+        info = self._unstacked.pop(image_path, None)
+        if info is not None:
+            self._add_to_stack(info, fits_path)
+
+    def _stack_frame(self, stack, fits_path):
+        try:
+            offset = stack.add(fits_path)
+        except Exception as e:
+            self.logger.warning("Not adding {} to co-add: {}".format(fits_path, e))
+        else:
+            if offset:
+                self.logger.debug("Added {} to co-add, offset {:.02f} {:.02f}".format(
+                    fits_path, offset['X'], offset['Y']))
+
+    def _write_stacks(self, close=False):
+        for camera_uid in list(self._stacks.keys()):
+            self._write_stack(camera_uid, close=close)
+
+    def _write_stack(self, camera_uid, close=False):
+        """ Write the co-add for a camera once the frames queued before it are added """
+        sequence_id, stack, coadd_path = self._stacks[camera_uid]
+
+        def write():
+            try:
+                if len(stack):
+                    stack.write(coadd_path)
+                    self.logger.debug("Co-add of {} frames: {}".format(len(stack), coadd_path))
+            except Exception as e:
+                self.logger.warning("Problem writing co-add {}: {}".format(coadd_path, e))
+            finally:
+                if close:
+                    stack.close()
+
+        if close:
+            del self._stacks[camera_uid]
+
+        self.stack_executor.submit(write)
+
+    def _get_solve_info(self, image_path, timeout=60):
+        """ Get the solve info for an image
+
+        Waits for the solve job submitted when the image was processed, or
+        solves it now if there isn't one.
+        """
+        future = self._solve_jobs.pop(image_path, None)
+        if future is None:
+            future = self.solver.submit(image_path,
+                                        ra=self.current_observation.field.ra.value,
+                                        dec=self.current_observation.field.dec.value,
+                                        radius=15)
+
+        return future.result(timeout=timeout)
+
     def _setup_location(self):
         """
         Sets up the site and location details for the observatory
@@ -603,8 +919,19 @@ class Observatory(PanBase):
                 # Simple constraint for now
                 constraints = [MoonAvoidance(), Duration(30 * u.deg)]
 
+                # Keep the nightly ephemeris across restarts
+                ephemeris_file = scheduler_config.get('ephemeris_file')
+                if ephemeris_file is not None:
+                    ephemeris_file = os.path.join(self.config['directories']['base'], ephemeris_file)
+
+                # Keep the parsed fields file too
+                catalog_cache = scheduler_config.get('catalog_cache')
+                if catalog_cache is not None:
+                    catalog_cache = os.path.join(self.config['directories']['base'], catalog_cache)
+
                 # Create the Scheduler instance
-                self.scheduler = module.Scheduler(self.observer, fields_file=fields_path, constraints=constraints)
+                self.scheduler = module.Scheduler(self.observer, fields_file=fields_path, constraints=constraints,
+                                                  ephemeris_file=ephemeris_file, catalog_cache=catalog_cache)
                 self.logger.debug("Scheduler created")
             except ImportError as e:
                 raise error.NotFound(msg=e)
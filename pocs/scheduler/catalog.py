@@ -0,0 +1,327 @@
+import os
+import yaml
+
+import numpy as np
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+from ..utils import error
+from .ephemeris import EphemerisTable
+
+# Columns of a catalog that are passed on to the `Observation`, and their types.
+# Other columns are ignored.
+FIELD_COLUMNS = [
+    ('priority', float),
+    ('exp_time', float),
+    ('min_nexp', int),
+    ('exp_set_size', int),
+]
+
+# Formats for `astropy.table.Table.read` of each extension, YAML and Parquet are read separately
+TABLE_FORMATS = {
+    '.csv': 'ascii.csv',
+    '.ecsv': 'ascii.ecsv',
+    '.fits': 'fits',
+    '.fit': 'fits',
+    '.fits.gz': 'fits',
+}
+
+# Bump when the layout of the cache file changes
+CACHE_VERSION = 1
+
+
+def read_catalog(fname, cache_file=None):
+    """ Read a list of fields from a YAML, CSV, FITS table or Parquet file
+
+    A YAML file is a list of field configs as for `BaseScheduler.add_observation`,
+    with a `name` and a `position`. The other formats are tables with a `name`
+    column and either `ra` and `dec` columns (in degrees unless they have units)
+    or a `position` column, and optionally any of `FIELD_COLUMNS`. Column names
+    are not case sensitive. Parquet files are read with `pandas`, which needs
+    `pyarrow` or `fastparquet`.
+
+    Parsing the positions is by far the slowest part for a long list, so if there
+    is a `cache_file` the parsed catalog is written to it and read from it as
+    long as the file hasn't changed.
+
+    Args:
+        fname (str): Name of the fields file
+        cache_file (str, optional): `.npz` file to keep the parsed catalog in
+
+    Returns:
+        FieldCatalog: The fields
+
+    Raises:
+        FileNotFoundError: If `fname` does not exist
+        error.InvalidConfig: If the format isn't known or the file has no positions
+    """
+    os.stat(fname)
+
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            catalog = FieldCatalog.load(cache_file)
+            if catalog.is_current(fname):
+                return catalog
+        except Exception:
+            pass
+
+    fmt = _get_format(fname)
+
+    if fmt == 'yaml':
+        with open(fname, 'r') as f:
+            catalog = FieldCatalog.from_list(yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)))
+    elif fmt == 'parquet':
+        import pandas
+        catalog = FieldCatalog.from_table(Table.from_pandas(pandas.read_parquet(fname)))
+    else:
+        catalog = FieldCatalog.from_table(Table.read(fname, format=fmt))
+
+    catalog.source = _get_source(fname)
+
+    if cache_file is not None:
+        try:
+            catalog.save(cache_file)
+        except Exception:
+            pass
+
+    return catalog
+
+
+class FieldCatalog(object):
+
+    """ Names, positions and observing options of a list of fields, as columns
+
+    Unlike `Field`s and `Observation`s, which take a while to make, a catalog of
+    100k fields is a few arrays. `get_visible` picks the fields that are up
+    during a night in one go, and `get_field_configs` gives the configs to make
+    `Observation`s of just those.
+
+    Args:
+        names (list): Names of the fields
+        ra (numpy.ndarray): Right ascension of each field in degrees (ICRS)
+        dec (numpy.ndarray): Declination of each field in degrees (ICRS)
+        columns (dict, optional): Array for each of `FIELD_COLUMNS` in the catalog,
+            NaN where a field doesn't set it
+        source (tuple, optional): Path, modification time and size of the file the
+            catalog was read from
+    """
+
+    def __init__(self, names, ra, dec, columns=None, source=None):
+        self.names = np.asarray(names, dtype=str)
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+
+        self.columns = {name: np.asarray(values, dtype=float) for name, values in (columns or {}).items()}
+        self.source = source
+
+        self._coords = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def coords(self):
+        """ `SkyCoord` array of the field centers """
+        if self._coords is None:
+            self._coords = SkyCoord(ra=self.ra, dec=self.dec, unit='deg')
+
+        return self._coords
+
+    @classmethod
+    def from_list(cls, field_list):
+        """ Make a catalog from a list of field configs, e.g. as read from YAML
+
+        Entries without a name or with a position that can't be read are skipped.
+        """
+        field_list = [config for config in (field_list or []) if 'name' in config and 'position' in config]
+
+        coords, valid = _parse_positions([config['position'] for config in field_list])
+        field_list = [config for config, ok in zip(field_list, valid) if ok]
+
+        columns = dict()
+        for name, type_ in FIELD_COLUMNS:
+            if any(name in config for config in field_list):
+                columns[name] = [_to_float(config.get(name)) for config in field_list]
+
+        return cls([str(config['name']) for config in field_list],
+                   coords.ra.to(u.degree).value, coords.dec.to(u.degree).value,
+                   columns=columns)
+
+    @classmethod
+    def from_table(cls, table):
+        """ Make a catalog from an `astropy.table.Table`, see `read_catalog` """
+        table = Table(table, copy=False)
+        for name in table.colnames:
+            if name != name.lower():
+                table.rename_column(name, name.lower())
+
+        if 'name' not in table.colnames:
+            raise error.InvalidConfig("Fields catalog has no name column")
+
+        if 'ra' in table.colnames and 'dec' in table.colnames:
+            ra = _to_degrees(table['ra'])
+            dec = _to_degrees(table['dec'])
+            valid = np.isfinite(ra) & np.isfinite(dec)
+        elif 'position' in table.colnames:
+            coords, valid = _parse_positions([str(position) for position in table['position']])
+            ra = np.full(len(table), np.nan)
+            dec = np.full(len(table), np.nan)
+            ra[valid] = coords.ra.to(u.degree).value
+            dec[valid] = coords.dec.to(u.degree).value
+        else:
+            raise error.InvalidConfig("Fields catalog needs ra and dec or position columns")
+
+        columns = dict()
+        for name, type_ in FIELD_COLUMNS:
+            if name in table.colnames:
+                columns[name] = _to_floats(table[name])[valid]
+
+        return cls([str(name).strip() for name in table['name'][valid]], ra[valid], dec[valid],
+                   columns=columns)
+
+    def is_current(self, fname):
+        """ If the catalog was read from `fname` as it is now """
+        return self.source is not None and tuple(self.source) == _get_source(fname)
+
+    def get_field_configs(self, rows=None):
+        """ Field configs for `BaseScheduler.add_observation`
+
+        Args:
+            rows (numpy.ndarray, optional): Indices of the fields, defaults to all
+
+        Yields:
+            dict: The `name`, `position` (a `SkyCoord`) and any of `FIELD_COLUMNS` that are set
+        """
+        if rows is None:
+            rows = range(len(self))
+
+        for i in rows:
+            config = {
+                'name': str(self.names[i]),
+                'position': SkyCoord(ra=self.ra[i], dec=self.dec[i], unit='deg'),
+            }
+
+            for name, type_ in FIELD_COLUMNS:
+                if name in self.columns and np.isfinite(self.columns[name][i]):
+                    config[name] = type_(self.columns[name][i])
+
+            yield config
+
+    def get_visible(self, observer, start, end, horizon=30 * u.degree):
+        """ Which fields are above `horizon` at some point between `start` and `end`
+
+        Args:
+            observer (astroplan.Observer): Location of the observer
+            start (astropy.time.Time): Start of the night
+            end (astropy.time.Time): End of the night
+            horizon (astropy.units.Quantity, optional): Lowest altitude, default 30 deg
+
+        Returns:
+            numpy.ndarray: Boolean array, True for the fields that are up
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=bool)
+
+        table = EphemerisTable.compute(observer, self.names, self.coords, start, end, horizon=horizon)
+
+        return np.isfinite(table.window_start)
+
+    def save(self, fname):
+        """ Write the catalog to a `.npz` file """
+        if os.path.dirname(fname):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        source = self.source or ('', 0, 0)
+
+        tmp_fname = '{}.tmp.npz'.format(fname)
+        np.savez(tmp_fname,
+                 version=CACHE_VERSION,
+                 names=self.names,
+                 ra=self.ra,
+                 dec=self.dec,
+                 source_path=source[0],
+                 source_mtime=source[1],
+                 source_size=source[2],
+                 **{'column_' + name: values for name, values in self.columns.items()})
+        os.replace(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """ Read a catalog written by `save` """
+        with np.load(fname) as data:
+            assert int(data['version']) == CACHE_VERSION, "Old catalog cache"
+
+            columns = {key[len('column_'):]: data[key] for key in data.files if key.startswith('column_')}
+            source = (str(data['source_path']), float(data['source_mtime']), int(data['source_size']))
+
+            return cls(data['names'], data['ra'], data['dec'], columns=columns, source=source)
+
+
+def _get_format(fname):
+    name = fname.lower()
+
+    if name.endswith(('.yaml', '.yml')):
+        return 'yaml'
+
+    if name.endswith(('.parquet', '.pq')):
+        return 'parquet'
+
+    for ext, fmt in TABLE_FORMATS.items():
+        if name.endswith(ext):
+            return fmt
+
+    raise error.InvalidConfig("Unknown format of fields file: {}".format(fname))
+
+
+def _get_source(fname):
+    stat = os.stat(fname)
+    return (os.path.abspath(fname), float(stat.st_mtime), int(stat.st_size))
+
+
+def _parse_positions(positions):
+    """ `SkyCoord` array of the positions that can be read and which ones those are """
+    valid = np.ones(len(positions), dtype=bool)
+
+    try:
+        return SkyCoord(positions, frame='icrs'), valid
+    except Exception:
+        pass
+
+    # Find the ones that can't be read
+    for i, position in enumerate(positions):
+        try:
+            SkyCoord(position, frame='icrs')
+        except Exception:
+            valid[i] = False
+
+    positions = [position for position, ok in zip(positions, valid) if ok]
+    if len(positions) == 0:
+        return SkyCoord(ra=[], dec=[], unit='deg'), valid
+
+    return SkyCoord(positions, frame='icrs'), valid
+
+
+def _to_degrees(column):
+    if getattr(column, 'unit', None) is not None:
+        return np.ma.filled(column.quantity.to(u.degree).value, np.nan)
+
+    return _to_floats(column)
+
+
+def _to_floats(column):
+    try:
+        return np.ma.filled(np.ma.asarray(column).astype(float), np.nan)
+    except (TypeError, ValueError):
+        return np.array([_to_float(value) for value in column])
+
+
+def _to_float(value):
+    if value is np.ma.masked:
+        return np.nan
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
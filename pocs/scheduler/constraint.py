@@ -1,10 +1,19 @@
+import numpy as np
+
 from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import get_moon
 
 from .. import PanBase
+from .ephemeris import get_event_seconds
 
 
 class BaseConstraint(PanBase):
 
+    # If a veto only means a sequence can't be started at that time (e.g. it couldn't
+    # be finished) rather than that the field can't be observed then
+    start_only = False
+
     def __init__(self, weight=1.0, default_score=0.0, *args, **kwargs):
         """ Base constraint
 
@@ -12,6 +21,10 @@ class BaseConstraint(PanBase):
         for determining a score for a particular target and observer at a given
         time. The `score` is then multiplied by the `weight` of the constraint.
 
+        `get_scores` does the same for many observations at once. By default it
+        calls `get_score` for each, constraints override it to score all the
+        observations in one go.
+
         Args:
             weight (float, optional): The weight of the observation, which will
                 be multipled by the score
@@ -32,6 +45,61 @@ class BaseConstraint(PanBase):
     def get_score(self, time, observer, target):
         raise NotImplementedError
 
+    def get_scores(self, time, observer, observations, coords=None, **kwargs):
+        """ Score many observations at once
+
+        Args:
+            time (astropy.time.Time): Time at which to score the observations
+            observer (astroplan.Observer): The observer
+            observations (list): The `~pocs.scheduler.observation.Observation`s to score
+            coords (astropy.coordinates.SkyCoord, optional): Array with the field center of
+                each observation, built from `observations` if not given
+            **kwargs: Properties shared by all constraints, e.g. `end_of_night` and `moon`
+
+        Returns:
+            tuple: Arrays of the veto and the (weighted) score of each observation
+        """
+        vetoes = np.zeros(len(observations), dtype=bool)
+        scores = np.zeros(len(observations))
+
+        for i, observation in enumerate(observations):
+            vetoes[i], scores[i] = self.get_score(time, observer, observation, **kwargs)
+
+        return vetoes, scores
+
+    def get_night_scores(self, times, observer, observations, coords=None, **kwargs):
+        """ Score many observations at many times at once
+
+        By default `get_scores` is called for each time, with the `moon` at that
+        time. Constraints that can read everything from the `visibility` grid or the
+        `ephemeris` override it to score all the times in one go.
+
+        Args:
+            times (astropy.time.Time): Array of times at which to score the observations
+            observer (astroplan.Observer): The observer
+            observations (list): The `~pocs.scheduler.observation.Observation`s to score
+            coords (astropy.coordinates.SkyCoord, optional): Array with the field center of
+                each observation, built from `observations` if not given
+            **kwargs: Properties shared by all constraints, as for `get_scores`
+
+        Returns:
+            tuple: Arrays of the veto and the (weighted) score, observations x times
+        """
+        vetoes = np.zeros((len(observations), len(times)), dtype=bool)
+        scores = np.zeros((len(observations), len(times)))
+
+        if coords is None:
+            coords = get_coords(observations)
+
+        moons = get_moon(times, observer.location)
+
+        for k in range(len(times)):
+            kwargs['moon'] = moons[k]
+            vetoes[:, k], scores[:, k] = self.get_scores(times[k], observer, observations,
+                                                         coords=coords, **kwargs)
+
+        return vetoes, scores
+
 
 class Altitude(BaseConstraint):
 
@@ -69,12 +137,38 @@ class Altitude(BaseConstraint):
 
         return veto, score * self.weight
 
+    def get_scores(self, time, observer, observations, coords=None, **kwargs):
+        # Read the altitudes from the visibility grid if it covers the time
+        visibility = kwargs.get('visibility')
+        if visibility is not None and visibility.covers(time):
+            rows = visibility.get_rows([obs.name for obs in observations])
+            alt = visibility.get_altitudes(time, rows=rows) * u.degree
+        else:
+            if coords is None:
+                coords = get_coords(observations)
+
+            alt = observer.altaz(time, target=coords).alt
+
+        vetoes = np.asarray(alt < self.minimum)
+        scores = np.where(vetoes, self._score, 1.0)
+
+        return vetoes, scores * self.weight
+
+    def get_night_scores(self, times, observer, observations, coords=None, **kwargs):
+        visibility = kwargs.get('visibility')
+        if visibility is None or not visibility.covers(times):
+            return super().get_night_scores(times, observer, observations, coords=coords, **kwargs)
+
+        return self.get_scores(times, observer, observations, coords=coords, **kwargs)
+
     def __str__(self):
         return "Altitude {}".format(self.minimum)
 
 
 class Duration(BaseConstraint):
 
+    start_only = True
+
     @u.quantity_input(horizon=u.degree)
     def __init__(self, horizon, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -128,6 +222,49 @@ class Duration(BaseConstraint):
 
         return veto, score * self.weight
 
+    def get_scores(self, time, observer, observations, coords=None, **kwargs):
+        if coords is None and kwargs.get('ephemeris') is None:
+            coords = get_coords(observations)
+
+        end_of_night = kwargs.get('end_of_night')
+        if end_of_night is None:
+            end_of_night = observer.tonight(time=time, horizon=-18 * u.degree)[1]
+        night_left = (end_of_night - time).sec
+
+        # Read the events from the nightly table if there is one
+        ephemeris = kwargs.get('ephemeris')
+        if ephemeris is not None:
+            rows = ephemeris.get_rows([obs.name for obs in observations])
+            events = ephemeris.get_event_seconds(time, horizon=self.horizon, rows=rows)
+        else:
+            events = get_event_seconds(time, observer, coords, horizon=self.horizon)
+        min_duration = np.array([obs.minimum_duration.to(u.second).value for obs in observations])
+
+        # Many times at once, see `get_night_scores`
+        if np.ndim(night_left) > 0:
+            min_duration = min_duration[:, np.newaxis]
+
+        vetoes = ~events['is_up']
+
+        # Can't meet the minimum before a meridian flip that happens tonight
+        vetoes |= (events['transit'] < night_left) & (min_duration > events['transit'])
+
+        # Total seconds until the target sets (or the night ends) is the score
+        scores = np.minimum(events['set'], night_left)
+        with np.errstate(invalid='ignore'):
+            vetoes |= ~(scores >= min_duration)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(events['is_up'], scores / night_left, self._score)
+
+        return vetoes, scores * self.weight
+
+    def get_night_scores(self, times, observer, observations, coords=None, **kwargs):
+        if kwargs.get('ephemeris') is None or kwargs.get('end_of_night') is None:
+            return super().get_night_scores(times, observer, observations, coords=coords, **kwargs)
+
+        return self.get_scores(times, observer, observations, coords=coords, **kwargs)
+
     def __str__(self):
         return "Duration above {}".format(self.horizon)
 
@@ -157,5 +294,43 @@ class MoonAvoidance(BaseConstraint):
 
         return veto, score * self.weight
 
+    def get_scores(self, time, observer, observations, coords=None, **kwargs):
+        # Read the separations from the visibility grid if it covers the time
+        visibility = kwargs.get('visibility')
+        if visibility is not None and visibility.covers(time):
+            rows = visibility.get_rows([obs.name for obs in observations])
+            moon_sep = visibility.get_moon_separations(time, rows=rows)
+        else:
+            if coords is None:
+                coords = get_coords(observations)
+
+            try:
+                moon = kwargs['moon']
+            except KeyError:
+                self.logger.error("Moon must be set")
+
+            moon_sep = coords.separation(moon).to(u.degree).value
+
+        # This would potentially be within image
+        vetoes = moon_sep < 15
+        scores = np.where(vetoes, self._score, moon_sep / 180)
+
+        return vetoes, scores * self.weight
+
+    def get_night_scores(self, times, observer, observations, coords=None, **kwargs):
+        visibility = kwargs.get('visibility')
+        if visibility is None or not visibility.covers(times):
+            return super().get_night_scores(times, observer, observations, coords=coords, **kwargs)
+
+        return self.get_scores(times, observer, observations, coords=coords, **kwargs)
+
     def __str__(self):
         return "Moon Avoidance"
+
+
+def get_coords(observations):
+    """ `SkyCoord` array of the field centers of `observations` """
+    ra = [obs.field.ra.to(u.degree).value for obs in observations]
+    dec = [obs.field.dec.to(u.degree).value for obs in observations]
+
+    return SkyCoord(ra=ra, dec=dec, unit='deg')
@@ -1,3 +1,5 @@
+import numpy as np
+
 from astropy import units as u
 
 from astropy.coordinates import get_moon
@@ -37,36 +39,45 @@ class Scheduler(BaseScheduler):
         if time is None:
             time = current_time()
 
-        valid_obs = {obs: 1.0 for obs in self.observations}
+        self.update_observations(time=time)
+
+        names, coords = self.field_coords
+        observations = [self.observations[name] for name in names]
+
+        # Every constraint scores all the remaining observations at once
+        valid = np.ones(len(names), dtype=bool)
+        merits = np.ones(len(names))
         best_obs = []
 
+        end_of_night = self.observer.tonight(time=time, horizon=-18 * u.degree)[-1]
+
         common_properties = {
-            'end_of_night': self.observer.tonight(time=time, horizon=-18 * u.degree)[-1],
-            'moon': get_moon(time, self.observer.location)
+            'end_of_night': end_of_night,
+            'moon': get_moon(time, self.observer.location),
+            'ephemeris': self.get_ephemeris(time=time, end_of_night=end_of_night),
+            'visibility': self.get_visibility(time=time, end_of_night=end_of_night),
         }
 
         for constraint in listify(self.constraints):
-            self.logger.debug("Checking Constraint: {}".format(constraint))
-            for obs_name, observation in self.observations.items():
-                if obs_name in valid_obs:
-                    self.logger.debug("\tObservation: {}".format(obs_name))
+            idx = np.flatnonzero(valid)
+            if len(idx) == 0:
+                break
 
-                    veto, score = constraint.get_score(
-                        time, self.observer, observation, **common_properties)
+            self.logger.debug("Checking Constraint: {} ({} observations)".format(constraint, len(idx)))
 
-                    self.logger.debug("\t\tScore: {}\tVeto: {}".format(score, veto))
+            vetoes, scores = constraint.get_scores(time, self.observer,
+                                                   [observations[i] for i in idx],
+                                                   coords=coords[idx],
+                                                   **common_properties)
 
-                    if veto:
-                        self.logger.debug("\t\t{} vetoed by {}".format(obs_name, constraint))
-                        del valid_obs[obs_name]
-                        continue
+            valid[idx[vetoes]] = False
+            merits[idx] += scores
 
-                    valid_obs[obs_name] += score
+            self.logger.debug("\t{} vetoed by {}".format(np.count_nonzero(vetoes), constraint))
 
-        for obs_name, score in valid_obs.items():
-            valid_obs[obs_name] += self.observations[obs_name].priority
+        valid_obs = {names[i]: float(merits[i] + observations[i].priority) for i in np.flatnonzero(valid)}
 
-        print(valid_obs)
+        self.logger.debug("Valid observations: {}".format(len(valid_obs)))
         if len(valid_obs) > 0:
             # Sort the list by highest score (reverse puts in correct order)
             best_obs = sorted(valid_obs.items(), key=lambda x: x[1])[::-1]
@@ -0,0 +1,299 @@
+import os
+
+import numpy as np
+
+from astropy import units as u
+from astropy.coordinates import FK5
+from astropy.time import Time
+
+# Length of a sidereal day in (SI) seconds
+SIDEREAL_DAY = 86164.0905
+
+
+def get_hour_angles(time, observer, coords):
+    """ Hour angle and declination of each target at `time`
+
+    The coordinates are precessed to the equinox of `time` in a single transform.
+
+    Args:
+        time (astropy.time.Time): Time of the hour angles
+        observer (astroplan.Observer): Location of the observer
+        coords (astropy.coordinates.SkyCoord): Array of targets
+
+    Returns:
+        tuple: Hour angles and declinations in degrees, as arrays. Hour angles are
+            in [-180, 180).
+    """
+    lst = observer.local_sidereal_time(time).to(u.degree).value
+    apparent = coords.transform_to(FK5(equinox=time))
+
+    ha = (lst - apparent.ra.to(u.degree).value + 180) % 360 - 180
+
+    return ha, apparent.dec.to(u.degree).value
+
+
+def get_altitudes(ha, dec, latitude):
+    """ Altitude in degrees for hour angles and declinations in degrees """
+    lat = np.radians(latitude)
+    ha = np.radians(ha)
+    dec = np.radians(dec)
+
+    sin_alt = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(ha)
+
+    return np.degrees(np.arcsin(np.clip(sin_alt, -1, 1)))
+
+
+def get_horizon_hour_angles(dec, latitude, horizon):
+    """ Hour angle at which targets cross `horizon`
+
+    Args:
+        dec (numpy.ndarray): Declinations in degrees
+        latitude (float): Latitude of the observer in degrees
+        horizon (float): Altitude of the horizon in degrees
+
+    Returns:
+        numpy.ndarray: Hour angle in degrees (0 to 180) at which each target sets, NaN for
+            targets that never rise and 180 for targets that never set
+    """
+    lat = np.radians(latitude)
+    dec = np.radians(dec)
+
+    cos_ha = (np.sin(np.radians(horizon)) - np.sin(lat) * np.sin(dec)) / (np.cos(lat) * np.cos(dec))
+
+    ha = np.degrees(np.arccos(np.clip(cos_ha, -1, 1)))
+    ha[cos_ha > 1] = np.nan
+
+    return ha
+
+
+def seconds_until(ha, target_ha):
+    """ Seconds until the hour angle goes from `ha` to `target_ha` (both degrees) """
+    return ((target_ha - ha) % 360) / 360 * SIDEREAL_DAY
+
+
+def get_event_seconds(time, observer, coords, horizon=0 * u.degree):
+    """ Seconds from `time` to the next rise, set and meridian transit of each target
+
+    The events are worked out from the hour angles, which is exact for fixed targets
+    apart from refraction (which astroplan also leaves out by default) and the
+    small change in the apparent position over a day.
+
+    Args:
+        time (astropy.time.Time): Time to start from
+        observer (astroplan.Observer): Location of the observer
+        coords (astropy.coordinates.SkyCoord): Array of targets
+        horizon (astropy.units.Quantity, optional): Altitude of the horizon, default 0 deg
+
+    Returns:
+        dict: Arrays of seconds until the next `rise`, `set` and `transit`, the `altitude`
+            (degrees) at `time` and whether each target `is_up`. Rise and set are
+            NaN for targets that never rise and inf for targets that never set.
+    """
+    latitude = observer.location.lat.to(u.degree).value
+    ha, dec = get_hour_angles(time, observer, coords)
+
+    return _get_events(ha, dec, latitude, horizon.to(u.degree).value)
+
+
+def _get_events(ha, dec, latitude, horizon):
+    set_ha = get_horizon_hour_angles(dec, latitude, horizon)
+
+    altitude = get_altitudes(ha, dec, latitude)
+
+    never_sets = set_ha >= 180
+
+    with np.errstate(invalid='ignore'):
+        rise = np.where(never_sets, np.inf, seconds_until(ha, -set_ha))
+        set_ = np.where(never_sets, np.inf, seconds_until(ha, set_ha))
+
+    return {
+        'rise': rise,
+        'set': set_,
+        'transit': seconds_until(ha, 0),
+        'altitude': altitude,
+        'is_up': altitude >= horizon,
+    }
+
+
+class EphemerisTable(object):
+
+    """ Rise, set and meridian transit times of all the fields for a night
+
+    The hour angle and apparent declination of every field are worked out once,
+    at `start`. Because fixed targets just turn with the sky, the hour angles at
+    any other time in the night (and from them the altitudes and the times of
+    the next events for any horizon, see `get_event_seconds`) are then simple
+    arithmetic. The rise, set and transit times for `horizon`, and the window
+    each field is above it during the night, are kept as arrays of MJD.
+
+    Use `compute` to make a table for a list of fields, and `save` and `load` to
+    keep it on disk.
+
+    Args:
+        names (list): Names of the fields
+        start (astropy.time.Time): Time the table starts from, e.g. dusk
+        end (astropy.time.Time): End of the night
+        latitude (float): Latitude of the observer in degrees
+        ha (numpy.ndarray): Hour angle of each field at `start` in degrees
+        dec (numpy.ndarray): Apparent declination of each field in degrees
+        horizon (float, optional): Horizon for the rise and set times in degrees, default 30
+
+    Attributes:
+        rise, set, transit (numpy.ndarray): MJD of the first rise, set and meridian
+            transit after `start`. Rise and set are NaN for fields that never rise
+            and inf for fields that never set.
+        window_start, window_end (numpy.ndarray): MJD of the first period between `start`
+            and `end` that each field is above `horizon`, NaN if it isn't up that night
+    """
+
+    def __init__(self, names, start, end, latitude, ha, dec, horizon=30):
+        self.names = list(names)
+        self.start = start
+        self.end = end
+        self.latitude = float(latitude)
+        self.horizon = float(horizon)
+
+        self.ha = np.asarray(ha, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+
+        self._rows = {name: i for i, name in enumerate(self.names)}
+
+        events = _get_events(self.ha, self.dec, self.latitude, self.horizon)
+
+        start_mjd = self.start.mjd
+        end_mjd = self.end.mjd
+        day = SIDEREAL_DAY / 86400
+
+        self.rise = start_mjd + events['rise'] / 86400
+        self.set = start_mjd + events['set'] / 86400
+        self.transit = start_mjd + events['transit'] / 86400
+
+        # Up at the start until it sets, otherwise from when it rises until it sets
+        up = events['is_up']
+        with np.errstate(invalid='ignore'):
+            next_set = np.where(self.set > self.rise, self.set, self.set + day)
+
+            self.window_start = np.where(up, start_mjd, self.rise)
+            self.window_end = np.minimum(np.where(up, self.set, next_set), end_mjd)
+
+            not_up = ~(self.window_start < end_mjd)
+
+        self.window_start[not_up] = np.nan
+        self.window_end[not_up] = np.nan
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def compute(cls, observer, names, coords, start, end, horizon=30 * u.degree):
+        """ Make the table for the fields at `coords`
+
+        Args:
+            observer (astroplan.Observer): Location of the observer
+            names (list): Names of the fields
+            coords (astropy.coordinates.SkyCoord): Array of the field centers
+            start (astropy.time.Time): Time the table starts from
+            end (astropy.time.Time): End of the night
+            horizon (astropy.units.Quantity, optional): Horizon for the rise and set
+                times, default 30 deg
+
+        Returns:
+            EphemerisTable: The table
+        """
+        ha, dec = get_hour_angles(start, observer, coords)
+
+        return cls(names, start, end, observer.location.lat.to(u.degree).value, ha, dec,
+                   horizon=horizon.to(u.degree).value)
+
+    def is_valid(self, names, end, latitude=None, horizon=None, tolerance=60 * u.second):
+        """ If the table is for the fields in `names` and the night ending at `end`
+
+        Args:
+            names (list): Names of the fields
+            end (astropy.time.Time): End of the night
+            latitude (float, optional): Latitude of the observer in degrees, not checked if None
+            horizon (float, optional): Horizon in degrees, not checked if None
+            tolerance (astropy.units.Quantity, optional): Difference allowed in `end`, default 60s
+        """
+        if abs((self.end - end).sec) > tolerance.to(u.second).value:
+            return False
+
+        if latitude is not None and abs(self.latitude - latitude) > 1e-6:
+            return False
+
+        if horizon is not None and abs(self.horizon - horizon) > 1e-6:
+            return False
+
+        return self.names == list(names)
+
+    def get_rows(self, names):
+        """ Rows of the table for the fields in `names` """
+        return np.array([self._rows[name] for name in names], dtype=int)
+
+    def get_hour_angles(self, time, rows=None):
+        """ Hour angle of each field at `time` in degrees, for the `rows` given or all
+
+        If `time` is an array the hour angles are fields x times.
+        """
+        ha = self.ha if rows is None else self.ha[rows]
+
+        seconds = np.asarray((time - self.start).sec)
+        if seconds.ndim > 0:
+            ha = ha[:, np.newaxis]
+
+        return (ha + seconds / SIDEREAL_DAY * 360 + 180) % 360 - 180
+
+    def get_event_seconds(self, time, horizon=None, rows=None):
+        """ Seconds from `time` to the next rise, set and meridian transit of each field
+
+        The same as the `get_event_seconds` function, without any coordinate transforms.
+
+        Args:
+            time (astropy.time.Time): Time to start from
+            horizon (astropy.units.Quantity, optional): Altitude of the horizon, defaults
+                to the horizon of the table
+            rows (numpy.ndarray, optional): Rows of the fields, see `get_rows`, defaults
+                to all the fields
+
+        If `time` is an array each value is fields x times.
+        """
+        if horizon is None:
+            horizon = self.horizon
+        else:
+            horizon = horizon.to(u.degree).value
+
+        dec = self.dec if rows is None else self.dec[rows]
+
+        ha = self.get_hour_angles(time, rows=rows)
+        if ha.ndim > 1:
+            dec = dec[:, np.newaxis]
+
+        return _get_events(ha, dec, self.latitude, horizon)
+
+    def save(self, fname):
+        """ Write the table to a `.npz` file """
+        if os.path.dirname(fname):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        tmp_fname = '{}.tmp.npz'.format(fname)
+        np.savez(tmp_fname,
+                 names=np.array(self.names, dtype=str),
+                 start=self.start.mjd,
+                 end=self.end.mjd,
+                 latitude=self.latitude,
+                 horizon=self.horizon,
+                 ha=self.ha,
+                 dec=self.dec)
+        os.replace(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """ Read a table written by `save` """
+        with np.load(fname) as data:
+            return cls(data['names'].tolist(),
+                       Time(float(data['start']), format='mjd'),
+                       Time(float(data['end']), format='mjd'),
+                       float(data['latitude']),
+                       data['ha'],
+                       data['dec'],
+                       horizon=float(data['horizon']))
@@ -15,12 +15,16 @@ class Field(FixedTarget, PanBase):
         Arguments:
             name {str} -- Name of the field, typically the name of object at center `position`
             position {str} -- Center of field, can be anything accepted by `~astropy.coordinates.SkyCoord`
+                or a `~astropy.coordinates.SkyCoord`, which is used as it is
             **kwargs {dict} -- Additional keywords to be passed to `astroplan.ObservingBlock`
 
         """
         PanBase.__init__(self)
 
-        super().__init__(SkyCoord(position, equinox=equinox, frame='icrs'), name=name, **kwargs)
+        if not isinstance(position, SkyCoord):
+            position = SkyCoord(position, equinox=equinox, frame='icrs')
+
+        super().__init__(position, name=name, **kwargs)
 
         self._field_name = self.name.title().replace(' ', '').replace('-', '')
 
@@ -0,0 +1,462 @@
+from collections import namedtuple
+
+import numpy as np
+
+from astropy import units as u
+
+from .scheduler import BaseScheduler
+from .visibility import angular_separation
+from ..utils import current_time
+from ..utils import listify
+
+# One stretch of the plan: the field, when it is selected (the slew starts) and when
+# its last exposure ends, the number of sets of exposures and the mean merit of a set
+PlanEntry = namedtuple('PlanEntry', ['name', 'start', 'end', 'num_sets', 'merit'])
+
+# Options of the planner, can be set under `scheduler.planner` in the config
+PLANNER_DEFAULTS = {
+    'slew_rate': 1.5,       # degrees per second
+    'settle_time': 120.,    # seconds for each new field, e.g. settling and pointing
+    'slew_weight': 1.,      # merit lost per set worth of time spent slewing
+    'max_candidates': 20,   # fields considered for a new sequence at each step
+}
+
+
+class NightPlan(object):
+
+    """ Best observing plan for the rest of the night from any time and mount position
+
+    The night is split into the time steps of the merit tables. Observing a field
+    means either starting a sequence, which is the slew and then the minimum
+    number of exposures (`min_nexp`), or adding one more set of exposures
+    (`exp_set_size`) to the field that was just observed. A block is only
+    allowed if the field isn't vetoed at any step it covers, and a sequence
+    also can't start at a step where it has a start veto (e.g. from `Duration`,
+    when the minimum can't be finished in time). A block is worth
+    its mean merit for each set, less `slew_weight` times the time spent
+    slewing (in sets) at the same rate.
+
+    The total merit to the end of the night of the best plan from each step and
+    mount position (any of the fields or unknown, e.g. parked) is worked out
+    backwards from the end of the night in one pass. The best plan from any
+    step and position is then read off by following the best choices, so
+    planning again after the night has been interrupted (e.g. by the weather)
+    doesn't compute anything new.
+
+    At each step only the `max_candidates` fields that would give the most merit
+    after the shortest possible slew are considered for a new sequence, so the
+    work grows with the number of fields times `max_candidates` rather than with
+    the number of fields squared. The plan is exact unless a field outside of
+    those would make up for a longer slew.
+
+    Args:
+        names (list): Names of the fields
+        start (astropy.time.Time): Time of the first step
+        step (float): Seconds between steps
+        merits (numpy.ndarray): Merit of each field at each step, fields x steps
+        vetoes (numpy.ndarray): If each field is vetoed at each step, fields x steps
+        min_steps (numpy.ndarray): Steps needed for the minimum exposures of each field
+        set_steps (numpy.ndarray): Steps needed for a set of exposures of each field
+        num_sets (numpy.ndarray): Number of sets in the minimum exposures of each field
+        ra (numpy.ndarray): Right ascension of each field in degrees
+        dec (numpy.ndarray): Declination of each field in degrees
+        start_vetoes (numpy.ndarray, optional): If a sequence of each field can't be
+            started at each step, fields x steps. Defaults to no start vetoes.
+        slew_rate (float, optional): Slew rate of the mount in degrees per second
+        settle_time (float, optional): Seconds lost for each new field on top of the slew
+        slew_weight (float, optional): Merit lost per set worth of time spent slewing
+        max_candidates (int, optional): Number of fields considered for a new sequence
+            at each step
+
+    The defaults of the options are in `PLANNER_DEFAULTS`.
+    """
+
+    def __init__(self, names, start, step, merits, vetoes, min_steps, set_steps, num_sets, ra, dec,
+                 start_vetoes=None,
+                 slew_rate=PLANNER_DEFAULTS['slew_rate'],
+                 settle_time=PLANNER_DEFAULTS['settle_time'],
+                 slew_weight=PLANNER_DEFAULTS['slew_weight'],
+                 max_candidates=PLANNER_DEFAULTS['max_candidates']):
+        self.names = list(names)
+        self.start = start
+        self.step = float(step)
+
+        self.merits = np.asarray(merits, dtype=float)
+        self.vetoes = np.asarray(vetoes, dtype=bool)
+
+        if start_vetoes is None:
+            start_vetoes = np.zeros_like(self.vetoes)
+        self.start_vetoes = np.asarray(start_vetoes, dtype=bool)
+
+        self.min_steps = np.asarray(min_steps, dtype=int)
+        self.set_steps = np.asarray(set_steps, dtype=int)
+        self.num_sets = np.asarray(num_sets, dtype=int)
+
+        self.slew_rate = float(slew_rate)
+        self.settle_time = float(settle_time)
+        self.slew_weight = float(slew_weight)
+        self.max_candidates = int(max_candidates)
+
+        num_fields = len(self.names)
+        shapes = (self.merits.shape, self.vetoes.shape, self.start_vetoes.shape)
+        assert len(set(shapes)) == 1 and self.merits.shape[0] == num_fields, "Merit tables must be fields x steps"
+
+        # Positions in radians, with an extra last one for an unknown position
+        self._ra = np.radians(np.append(np.asarray(ra, dtype=float), 0))
+        self._dec = np.radians(np.append(np.asarray(dec, dtype=float), 0))
+
+        self._rows = {name: i for i, name in enumerate(self.names)}
+
+        self._solve()
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def num_steps(self):
+        return self.merits.shape[1]
+
+    @property
+    def end(self):
+        return self.start + (self.num_steps - 1) * self.step * u.second
+
+    def covers(self, time):
+        """ If `time` is within the night of the plan """
+        return self.start <= time <= self.end
+
+    def is_valid(self, names, time):
+        """ If the plan is for the fields in `names` and covers `time` """
+        return self.covers(time) and self.names == list(names)
+
+    def get_step(self, time):
+        """ First step at or after `time` """
+        return int(np.ceil((time - self.start).sec / self.step - 1e-9))
+
+    def get_plan(self, time, name=None):
+        """ Best plan from `time` to the end of the night
+
+        Args:
+            time (astropy.time.Time): Time to start from
+            name (str, optional): Field the mount is on, a new set of it can be added
+                without a slew. Defaults to None for an unknown position.
+
+        Returns:
+            list: A `PlanEntry` for each field in order, with the sets added to a
+                field one after the other in a single entry
+        """
+        k = max(self.get_step(time), 0)
+        f = self._rows.get(name, len(self.names))
+
+        blocks = list()
+        while k < self.num_steps - 1:
+            g = self._choices[k, f]
+            if g < 0:
+                k += 1
+                continue
+
+            if g == f:
+                begin, end, num_sets = k, k + self.set_steps[g], 1
+            else:
+                begin = k + int(self._get_overhead_steps(f, g))
+                end, num_sets = begin + self.min_steps[g], self.num_sets[g]
+
+            if blocks and g == f:
+                blocks[-1][2] = end
+                blocks[-1][3] += num_sets
+                blocks[-1][4] += self._mean_merit(g, begin, end) * num_sets
+            else:
+                blocks.append([g, k, end, num_sets, self._mean_merit(g, begin, end) * num_sets])
+
+            k, f = end, g
+
+        plan = list()
+        for g, begin, end, num_sets, merit in blocks:
+            plan.append(PlanEntry(self.names[g],
+                                  self.start + begin * self.step * u.second,
+                                  self.start + end * self.step * u.second,
+                                  int(num_sets),
+                                  merit / num_sets))
+
+        return plan
+
+    def get_value(self, time, name=None):
+        """ Total merit of the best plan from `time`, see `get_plan` """
+        k = min(max(self.get_step(time), 0), self.num_steps - 1)
+
+        return float(self._values[k, self._rows.get(name, len(self.names))])
+
+    def _mean_merit(self, g, begin, end):
+        return (self._merit_sums[g, end] - self._merit_sums[g, begin]) / max(end - begin, 1)
+
+    def _get_overhead_steps(self, f, g):
+        """ Steps to slew from fields `f` (or the unknown position) to fields `g`, broadcast """
+        slew = angular_separation(self._ra[f], self._dec[f], self._ra[g], self._dec[g]) / self.slew_rate
+        slew = np.where(np.asarray(f) == len(self.names), 0, slew)
+
+        return np.ceil((self.settle_time + slew) / self.step - 1e-9).astype(int)
+
+    def _solve(self):
+        num_fields = len(self.names)
+        last = self.num_steps - 1
+
+        # Sums up to (not including) each step, for the merit and vetoes of any block
+        zeros = np.zeros((num_fields, 1))
+        self._merit_sums = np.hstack([zeros, np.cumsum(self.merits, axis=1)])
+        veto_sums = np.hstack([zeros, np.cumsum(self.vetoes, axis=1)])
+
+        # Best total merit from each step and position, and the field observed next
+        # (-1 to wait a step)
+        self._values = np.zeros((self.num_steps, num_fields + 1))
+        self._choices = np.full((self.num_steps, num_fields + 1), -1, dtype=int)
+
+        if num_fields == 0:
+            return
+
+        # The same at every step
+        fields = np.arange(num_fields)
+        rows = np.arange(num_fields + 1)
+        positions = rows[:, np.newaxis]
+        set_steps = self.set_steps.astype(float)
+        settle_steps = int(np.ceil(self.settle_time / self.step - 1e-9))
+        num_candidates = min(self.max_candidates, num_fields)
+
+        for k in range(last - 1, -1, -1):
+            best = self._values[k + 1].copy()
+            choice = np.full(num_fields + 1, -1, dtype=int)
+
+            # Pick the candidates for a new sequence as if there were no slew
+            begin = min(k + settle_steps, last)
+            end = begin + self.min_steps
+            allowed = end <= last
+            end = np.minimum(end, last)
+
+            allowed &= (veto_sums[fields, end + 1] - veto_sums[fields, begin]) == 0
+            allowed &= ~self.start_vetoes[fields, begin]
+
+            if np.any(allowed):
+                merit = (self._merit_sums[fields, end] - self._merit_sums[fields, begin]) / np.maximum(end - begin, 1)
+                estimates = np.where(allowed, merit * self.num_sets + self._values[end, fields], -np.inf)
+
+                candidates = np.argpartition(-estimates, num_candidates - 1)[:num_candidates]
+                candidates = candidates[np.isfinite(estimates[candidates])]
+
+                # Start a sequence of a candidate after slewing to it
+                overheads = self._get_overhead_steps(positions, candidates[np.newaxis, :])
+                begin = k + overheads
+                end = begin + self.min_steps[candidates]
+
+                allowed = end <= last
+                begin = np.minimum(begin, last)
+                end = np.minimum(end, last)
+
+                allowed &= (veto_sums[candidates, end + 1] - veto_sums[candidates, begin]) == 0
+                allowed &= ~self.start_vetoes[candidates, begin]
+                allowed[candidates, np.arange(len(candidates))] = False
+
+                sums = self._merit_sums[candidates, end] - self._merit_sums[candidates, begin]
+                merit = sums / np.maximum(end - begin, 1)
+                slew_sets = overheads / set_steps[candidates]
+
+                totals = merit * (self.num_sets[candidates] - self.slew_weight * slew_sets)
+                totals += self._values[end, candidates]
+                totals[~allowed] = -np.inf
+
+                # Don't wait when observing now is as good
+                c = np.argmax(totals, axis=1)
+                top = totals[rows, c]
+                better = top >= best
+                best[better] = top[better]
+                choice[better] = candidates[c][better]
+
+            # Add a set to the field that was just observed
+            end = k + self.set_steps
+            allowed = end <= last
+            end = np.minimum(end, last)
+
+            allowed &= (veto_sums[fields, end + 1] - veto_sums[fields, k]) == 0
+
+            merit = (self._merit_sums[fields, end] - self._merit_sums[fields, k]) / np.maximum(end - k, 1)
+
+            totals = np.where(allowed, merit + self._values[end, fields], -np.inf)
+
+            better = totals >= best[:num_fields]
+            best[:num_fields][better] = totals[better]
+            choice[:num_fields][better] = fields[better]
+
+            self._values[k] = best
+            self._choices[k] = choice
+
+
+class Scheduler(BaseScheduler):
+
+    def __init__(self, *args, **kwargs):
+        """ Plans the whole night ahead, see `NightPlan`
+
+        Keyword Args:
+            slew_rate (float, optional): Slew rate of the mount in degrees per second
+            settle_time (float, optional): Seconds lost for each new field on top of
+                the slew, e.g. to settle and for the pointing images
+            slew_weight (float, optional): Merit lost per set worth of time spent slewing
+            max_candidates (int, optional): Number of fields considered for a new
+                sequence at each step
+
+        The defaults are in `PLANNER_DEFAULTS`, and can be set under `scheduler.planner`
+        in the config.
+        """
+        options = {key: kwargs.pop(key) for key in PLANNER_DEFAULTS if key in kwargs}
+
+        BaseScheduler.__init__(self, *args, **kwargs)
+
+        self.options = dict(PLANNER_DEFAULTS)
+        self.options.update(self.config.get('scheduler', {}).get('planner', {}) or {})
+        self.options.update(options)
+
+        self._night_plan = None
+
+
+##########################################################################
+# Methods
+##########################################################################
+
+    def get_observation(self, time=None, show_all=False):
+        """Get the observation the plan has for `time`
+
+        Args:
+            time (astropy.time.Time, optional): Time at which scheduler applies,
+                defaults to time called
+            show_all (bool, optional): Return the whole plan from `time` as a list
+                of name and merit, defaults to False to only get the current one
+
+        Returns:
+            tuple or list: A tuple (or list of tuples) with name and merit of planned observations
+        """
+        if time is None:
+            time = current_time()
+
+        plan = self.get_plan(time=time)
+
+        best_obs = [(entry.name, entry.merit) for entry in plan]
+
+        night_plan = self.get_night_plan(time=time)
+        if len(plan) > 0 and (plan[0].start - time).sec < night_plan.step:
+            self.current_observation = self.observations[plan[0].name]
+            self.current_observation.merit = plan[0].merit
+        else:
+            if len(plan) > 0:
+                self.logger.debug("Nothing planned until {}".format(plan[0].start.isot))
+            else:
+                self.logger.warning("No valid observations found")
+
+            self.current_observation = None
+            best_obs = list()
+
+        if not show_all and len(best_obs) > 0:
+            best_obs = best_obs[0]
+
+        return best_obs
+
+    def get_plan(self, time=None):
+        """Get the timed plan for the rest of the night
+
+        The plan starts from the field that is being observed, if there is one,
+        so it is planned again from where things are whenever this is called,
+        e.g. after the weather has closed the observatory for a while.
+
+        Args:
+            time (astropy.time.Time, optional): Time to plan from, defaults to now
+
+        Returns:
+            list: A `PlanEntry` for each field to observe, in order
+        """
+        if time is None:
+            time = current_time()
+
+        self.update_observations(time=time)
+
+        name = None
+        if self.current_observation is not None:
+            name = self.current_observation.name
+
+        plan = self.get_night_plan(time=time).get_plan(time, name=name)
+
+        for entry in plan:
+            self.logger.debug("Plan: {} {} - {} {} sets, merit {:.02f}".format(
+                entry.name, entry.start.isot, entry.end.isot, entry.num_sets, entry.merit))
+
+        return plan
+
+    def get_night_plan(self, time=None):
+        """Get the `NightPlan` for the rest of the night
+
+        The merit tables and the plan are computed the first time they are needed
+        each night, and kept until the night or the fields change.
+
+        Args:
+            time (astropy.time.Time, optional): Time during (or before) the night,
+                defaults to now
+
+        Returns:
+            `NightPlan`: The plan for the night
+        """
+        if time is None:
+            time = current_time()
+
+        names, coords = self.field_coords
+
+        if self._night_plan is None or not self._night_plan.is_valid(names, time):
+            end_of_night = self.observer.tonight(time=time, horizon=-18 * u.degree)[-1]
+
+            self.logger.debug("Planning the night for {} fields".format(len(names)))
+            self._night_plan = self._make_night_plan(time, end_of_night)
+
+        return self._night_plan
+
+##########################################################################
+# Private Methods
+##########################################################################
+
+    def _make_night_plan(self, time, end_of_night):
+        names, coords = self.field_coords
+        observations = [self.observations[name] for name in names]
+
+        end_of_night = max(end_of_night, time + 1 * u.hour)
+
+        visibility = self.get_visibility(time=time, end_of_night=end_of_night)
+        ephemeris = self.get_ephemeris(time=time, end_of_night=end_of_night)
+
+        # Plan on the steps of the visibility grid
+        num_steps = int(np.searchsorted((visibility.times - visibility.start).sec,
+                                        (end_of_night - visibility.start).sec, side='right'))
+        times = visibility.times[:max(num_steps, 2)]
+        step = (times[1] - times[0]).sec
+
+        common_properties = {
+            'end_of_night': end_of_night,
+            'ephemeris': ephemeris,
+            'visibility': visibility,
+        }
+
+        # Every constraint scores all the fields at all the steps at once. Vetoes of
+        # start only constraints (e.g. `Duration`) only apply to starting a sequence.
+        merits = np.ones((len(names), len(times)))
+        vetoes = ~visibility.is_up(times)
+        start_vetoes = np.zeros_like(vetoes)
+
+        for constraint in listify(self.constraints):
+            constraint_vetoes, scores = constraint.get_night_scores(times, self.observer, observations,
+                                                                    coords=coords, **common_properties)
+            if constraint.start_only:
+                start_vetoes |= constraint_vetoes
+            else:
+                vetoes |= constraint_vetoes
+            merits += scores
+
+        merits += np.array([obs.priority for obs in observations])[:, np.newaxis]
+
+        min_steps = [int(np.ceil(obs.minimum_duration.to(u.second).value / step)) for obs in observations]
+        set_steps = [int(np.ceil(obs.set_duration.to(u.second).value / step)) for obs in observations]
+        num_sets = [obs.min_nexp // obs.exp_set_size for obs in observations]
+
+        return NightPlan(names, times[0], step, merits, vetoes, min_steps, set_steps, num_sets,
+                         coords.ra.to(u.degree).value, coords.dec.to(u.degree).value,
+                         start_vetoes=start_vetoes, **self.options)
@@ -1,5 +1,6 @@
 import os
-import yaml
+
+import numpy as np
 
 from astroplan import Observer
 from astropy import units as u
@@ -7,13 +8,22 @@ from astropy import units as u
 from .. import PanBase
 from ..utils import current_time
 
+from .catalog import read_catalog
+from .constraint import get_coords
+from .ephemeris import EphemerisTable
+from .visibility import VisibilityGrid
 from .field import Field
 from .observation import Observation
 
 
+# Fields files with more fields than this only get `Observation`s for the fields up each night
+PREFILTER_SIZE = 1000
+
+
 class BaseScheduler(PanBase):
 
-    def __init__(self, observer, fields_list=None, fields_file=None, constraints=list(), *args, **kwargs):
+    def __init__(self, observer, fields_list=None, fields_file=None, constraints=list(),
+                 ephemeris_file=None, catalog_cache=None, prefilter_size=PREFILTER_SIZE, *args, **kwargs):
         """Loads `~pocs.scheduler.field.Field`s from a field
 
         Note:
@@ -25,9 +35,18 @@ class BaseScheduler(PanBase):
         Args:
             observer (`astroplan.Observer`): The physical location the scheduling will take place from
             fields_list (list, optional): A list of valid field configurations
-            fields_file (str): YAML file containing field parameters
+            fields_file (str): YAML, CSV, FITS table or Parquet file containing field
+                parameters, see `~pocs.scheduler.catalog.read_catalog`
             constraints (list, optional): List of `Constraints` to apply to each
                 observation
+            ephemeris_file (str, optional): File the nightly `EphemerisTable` is kept
+                in, so it isn't computed again after a restart. Defaults to None, in
+                which case it is only kept in memory.
+            catalog_cache (str, optional): File the parsed `fields_file` is kept in, so
+                it is only parsed again when it changes. Defaults to None.
+            prefilter_size (int, optional): Fields files with more fields than this only
+                get `Observations` for the fields that are up each night, see
+                `update_observations`. Defaults to `PREFILTER_SIZE`.
             *args: Arguments to be passed to `PanBase`
             **kwargs: Keyword args to be passed to `PanBase`
         """
@@ -38,6 +57,17 @@ class BaseScheduler(PanBase):
         self._fields_file = fields_file
         self._fields_list = fields_list
         self._observations = dict()
+        self._field_coords = None
+
+        self._catalog = None
+        self._catalog_cache = catalog_cache
+        self._catalog_night = None
+        self._prefilter_size = prefilter_size
+
+        self._ephemeris = None
+        self._ephemeris_file = ephemeris_file
+
+        self._visibility = None
 
         self.observer = observer
 
@@ -65,6 +95,24 @@ class BaseScheduler(PanBase):
 
         return self._observations
 
+    @property
+    def field_coords(self):
+        """Names and `SkyCoord` array of the field centers of all the observations
+
+        The coordinates are built once and kept until the observations change, so
+        constraints can score all the fields at once (see `BaseConstraint.get_scores`).
+
+        Returns:
+            tuple: List of observation names and the `SkyCoord` of each in the same order
+        """
+        if self._field_coords is None:
+            names = list(self.observations.keys())
+            coords = get_coords([self.observations[name] for name in names])
+
+            self._field_coords = (names, coords)
+
+        return self._field_coords
+
     @property
     def current_observation(self):
         """ The observation that is currently selected by the scheduler """
@@ -112,6 +160,8 @@ class BaseScheduler(PanBase):
         # Clear out existing list and observations
         self._fields_list = None
         self._observations = dict()
+        self._field_coords = None
+        self._catalog = None
 
         self._fields_file = new_file
         if new_file is not None:
@@ -141,6 +191,8 @@ class BaseScheduler(PanBase):
         # Clear out existing list and observations
         self._fields_file = None
         self._observations = dict()
+        self._field_coords = None
+        self._catalog = None
 
         self._fields_list = new_list
         self.read_field_list()
@@ -164,6 +216,85 @@ class BaseScheduler(PanBase):
         """
         raise NotImplementedError
 
+    def get_ephemeris(self, time=None, end_of_night=None):
+        """Get the rise, set and transit times of all the fields for the night
+
+        The `~pocs.scheduler.ephemeris.EphemerisTable` is computed the first time it
+        is needed each night and kept until the night or the fields change. If there
+        is an `ephemeris_file` the table is read from it when it is for the same
+        night and fields, and written to it when a new one is computed.
+
+        Args:
+            time (astropy.time.Time, optional): Time during (or before) the night,
+                defaults to now
+            end_of_night (astropy.time.Time, optional): End of the night, looked up
+                if not given
+
+        Returns:
+            `~pocs.scheduler.ephemeris.EphemerisTable`: The table for the night
+        """
+        if time is None:
+            time = current_time()
+
+        if end_of_night is None:
+            end_of_night = self.observer.tonight(time=time, horizon=-18 * u.degree)[-1]
+
+        names, coords = self.field_coords
+        latitude = self.observer.location.lat.to(u.degree).value
+
+        def is_valid(table):
+            return table is not None and time >= table.start and \
+                table.is_valid(names, end_of_night, latitude=latitude)
+
+        if not is_valid(self._ephemeris) and self._ephemeris_file is not None \
+                and os.path.exists(self._ephemeris_file):
+            try:
+                self._ephemeris = EphemerisTable.load(self._ephemeris_file)
+            except Exception as e:
+                self.logger.warning("Can't read ephemeris file {}: {}".format(self._ephemeris_file, e))
+
+        if not is_valid(self._ephemeris):
+            self.logger.debug("Computing ephemeris for {} fields".format(len(names)))
+            self._ephemeris = EphemerisTable.compute(self.observer, names, coords, time, end_of_night)
+
+            if self._ephemeris_file is not None:
+                try:
+                    self._ephemeris.save(self._ephemeris_file)
+                except Exception as e:
+                    self.logger.warning("Can't write ephemeris file {}: {}".format(self._ephemeris_file, e))
+
+        return self._ephemeris
+
+    def get_visibility(self, time=None, end_of_night=None):
+        """Get the altitude and moon separation of all the fields through the night
+
+        The `~pocs.scheduler.visibility.VisibilityGrid` runs from `time` to the end of
+        the night and is kept until `time` is past it or the fields change.
+
+        Args:
+            time (astropy.time.Time, optional): Time during (or before) the night,
+                defaults to now
+            end_of_night (astropy.time.Time, optional): End of the night, looked up
+                if not given
+
+        Returns:
+            `~pocs.scheduler.visibility.VisibilityGrid`: The grid for the night
+        """
+        if time is None:
+            time = current_time()
+
+        names, coords = self.field_coords
+
+        if self._visibility is None or not self._visibility.is_valid(names, time):
+            if end_of_night is None:
+                end_of_night = self.observer.tonight(time=time, horizon=-18 * u.degree)[-1]
+
+            self.logger.debug("Computing visibility grid for {} fields".format(len(names)))
+            self._visibility = VisibilityGrid.compute(self.observer, names, coords, time,
+                                                      max(end_of_night, time + 1 * u.hour))
+
+        return self._visibility
+
     def status(self):
         return {
             'constraints': self.constraints,
@@ -178,6 +309,12 @@ class BaseScheduler(PanBase):
             time (astropy.time.Time): The time at which to check observation
 
         """
+        # Look it up in the visibility grid if there is one for the time
+        names, coords = self.field_coords
+        if self._visibility is not None and self._visibility.is_valid(names, time):
+            rows = self._visibility.get_rows([observation.name])
+            return bool(self._visibility.is_up(time, horizon=30 * u.degree, rows=rows)[0])
+
         return self.observer.target_is_up(time, observation.field, horizon=30 * u.degree)
 
     def add_observation(self, field_config):
@@ -201,6 +338,7 @@ class BaseScheduler(PanBase):
             self.logger.warning(e)
         else:
             self._observations[field.name] = obs
+            self._field_coords = None
 
     def remove_observation(self, field_name):
         """Removes an `Observation` from the scheduler
@@ -212,22 +350,81 @@ class BaseScheduler(PanBase):
         try:
             obs = self._observations[field_name]
             del self._observations[field_name]
+            self._field_coords = None
             self.logger.debug("Observation removed: {}".format(obs))
         except:
             pass
 
-    def read_field_list(self):
-        """Reads the field file and creates valid `Observations` """
+    def read_field_list(self, time=None):
+        """Reads the field file or list and creates valid `Observations`
+
+        A large field file only gets `Observations` for the fields that are up
+        during the night of `time`, see `update_observations`. Without a `time`
+        these are left for `update_observations` to make when the schedulers first
+        pick an observation.
+
+        Args:
+            time (astropy.time.Time, optional): Time during (or before) the night
+        """
         if self._fields_file is not None:
-            self.logger.debug('Reading fields from file: {}'.format(self.fields_file))
+            if self._catalog is None or not self._catalog.is_current(self._fields_file):
+                self.logger.debug('Reading fields from file: {}'.format(self.fields_file))
 
-            with open(self._fields_file, 'r') as yaml_string:
-                self._fields_list = yaml.load(yaml_string)
+                self._catalog = read_catalog(self._fields_file, cache_file=self._catalog_cache)
+                self._catalog_night = None
 
-        if self._fields_list is not None:
+            if len(self._catalog) > self._prefilter_size:
+                if time is not None:
+                    self.update_observations(time=time)
+            else:
+                for field_config in self._catalog.get_field_configs():
+                    self.add_observation(field_config)
+
+        elif self._fields_list is not None:
             for field_config in self._fields_list:
                 self.add_observation(field_config)
 
+    def update_observations(self, time=None):
+        """Make `Observations` of the fields of a large field file that are up tonight
+
+        All the fields of the file are checked at once (see
+        `~pocs.scheduler.catalog.FieldCatalog.get_visible`) and `Observations` are only
+        made for those above 30 degrees at some point in the night of `time`. The
+        fields of the night before that aren't up are removed, unless one is the
+        current observation. Nothing is done if this was already done for the night
+        or the field file is small enough for all of the fields to be loaded.
+
+        Args:
+            time (astropy.time.Time, optional): Time during (or before) the night,
+                defaults to now
+        """
+        if self._catalog is None or len(self._catalog) <= self._prefilter_size:
+            return
+
+        if time is None:
+            time = current_time()
+
+        start_of_night, end_of_night = self.observer.tonight(time=time, horizon=-18 * u.degree)
+
+        if self._catalog_night is not None and abs((self._catalog_night - end_of_night).sec) < 60:
+            return
+
+        visible = self._catalog.get_visible(self.observer, start_of_night, end_of_night,
+                                            horizon=30 * u.degree)
+        self.logger.debug("{} of {} fields are up tonight".format(
+            np.count_nonzero(visible), len(self._catalog)))
+
+        down = set(self._catalog.names[~visible])
+        for name in list(self._observations.keys()):
+            if name in down and (self.current_observation is None or name != self.current_observation.name):
+                self.remove_observation(name)
+
+        for field_config in self._catalog.get_field_configs(np.flatnonzero(visible)):
+            if field_config['name'] not in self._observations:
+                self.add_observation(field_config)
+
+        self._catalog_night = end_of_night
+
 ##########################################################################
 # Utility Methods
 ##########################################################################
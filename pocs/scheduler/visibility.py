@@ -0,0 +1,148 @@
+import numpy as np
+
+from astropy import units as u
+from astropy.coordinates import AltAz
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import get_moon
+
+
+class VisibilityGrid(object):
+
+    """ Altitude, airmass and moon separation of all the fields through the night
+
+    The values are worked out for every field at `step` intervals from `start`
+    to `end` with a single coordinate transform. They are then looked up for any
+    time in between by linear interpolation between the two nearest steps, which
+    is a couple of array operations whatever the number of fields. The lookups
+    also take an array of times, and then give fields x times. Use `compute`
+    to make a grid.
+
+    Args:
+        names (list): Names of the fields
+        times (astropy.time.Time): Times of the steps, evenly spaced
+        altitude (numpy.ndarray): Altitude in degrees, fields x times
+        moon_separation (numpy.ndarray): Separation from the moon in degrees, fields x times
+    """
+
+    def __init__(self, names, times, altitude, moon_separation):
+        assert altitude.shape == moon_separation.shape == (len(names), len(times)), \
+            "Grid must be fields x times"
+
+        self.names = list(names)
+        self.times = times
+
+        self.altitude = altitude
+        self.moon_separation = moon_separation
+
+        self._rows = {name: i for i, name in enumerate(self.names)}
+
+        self._step = (times[1] - times[0]).sec if len(times) > 1 else 1.
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def start(self):
+        return self.times[0]
+
+    @property
+    def end(self):
+        return self.times[-1]
+
+    @property
+    def airmass(self):
+        """ Airmass (sec z) of each field at each step, NaN below the horizon """
+        return _airmass(self.altitude)
+
+    @classmethod
+    def compute(cls, observer, names, coords, start, end, step=2 * u.minute):
+        """ Make the grid for the fields at `coords`
+
+        Args:
+            observer (astroplan.Observer): Location of the observer
+            names (list): Names of the fields
+            coords (astropy.coordinates.SkyCoord): Array of the field centers
+            start (astropy.time.Time): First time of the grid
+            end (astropy.time.Time): Last time of the grid
+            step (astropy.units.Quantity, optional): Time between steps, default 2 minutes
+
+        Returns:
+            VisibilityGrid: The grid
+        """
+        num_steps = int(np.ceil(((end - start).sec / step.to(u.second).value))) + 1
+        times = start + np.arange(max(num_steps, 2)) * step
+
+        # One transform for all the fields at all the times
+        frame = AltAz(obstime=times, location=observer.location,
+                      pressure=observer.pressure, temperature=observer.temperature,
+                      relative_humidity=observer.relative_humidity)
+        altitude = coords[:, np.newaxis].transform_to(frame).alt.to(u.degree).value
+
+        # Same separation as `MoonAvoidance.get_score`
+        moon = SkyCoord(get_moon(times, observer.location)).transform_to(coords.frame)
+        moon_separation = angular_separation(coords.ra.radian[:, np.newaxis],
+                                             coords.dec.radian[:, np.newaxis],
+                                             moon.ra.radian[np.newaxis, :],
+                                             moon.dec.radian[np.newaxis, :])
+
+        return cls(names, times, altitude.astype(np.float32), moon_separation.astype(np.float32))
+
+    def covers(self, time):
+        """ If `time` (or all of an array of times) is within the grid """
+        return bool(np.all((self.start <= time) & (time <= self.end)))
+
+    def is_valid(self, names, time):
+        """ If the grid is for the fields in `names` and covers `time` """
+        return self.covers(time) and self.names == list(names)
+
+    def get_rows(self, names):
+        """ Rows of the grid for the fields in `names` """
+        return np.array([self._rows[name] for name in names], dtype=int)
+
+    def get_altitudes(self, time, rows=None):
+        """ Altitude in degrees at `time`, for the `rows` given or all the fields """
+        return self._interpolate(self.altitude, time, rows)
+
+    def get_airmass(self, time, rows=None):
+        """ Airmass at `time`, NaN below the horizon """
+        return _airmass(self.get_altitudes(time, rows=rows))
+
+    def get_moon_separations(self, time, rows=None):
+        """ Separation from the moon in degrees at `time` """
+        return self._interpolate(self.moon_separation, time, rows)
+
+    def is_up(self, time, horizon=30 * u.degree, rows=None):
+        """ If the fields are above `horizon` at `time` """
+        return self.get_altitudes(time, rows=rows) >= horizon.to(u.degree).value
+
+    def _interpolate(self, values, time, rows):
+        assert self.covers(time), "{} is outside of the grid".format(time)
+
+        position = np.asarray((time - self.start).sec) / self._step
+        i = np.minimum(position.astype(int), len(self.times) - 2)
+        weight = position - i
+
+        if rows is not None:
+            values = values[rows]
+
+        return values[:, i] * (1 - weight) + values[:, i + 1] * weight
+
+
+def _airmass(alt):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        airmass = 1 / np.sin(np.radians(alt))
+
+    airmass[alt <= 0] = np.nan
+
+    return airmass
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """ Angular separation in degrees (Vincenty formula) for angles in radians """
+    dra = ra2 - ra1
+
+    num1 = np.cos(dec2) * np.sin(dra)
+    num2 = np.cos(dec1) * np.sin(dec2) - np.sin(dec1) * np.cos(dec2) * np.cos(dra)
+    denominator = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(dra)
+
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
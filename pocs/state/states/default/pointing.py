@@ -9,106 +9,57 @@ from pocs.utils import images
 def on_enter(event_data):
     """ Adjust pointing.
 
-    * Take 60 second exposure
-    * Call `sync_coordinates`
-        * Plate-solve
-        * Get pointing error
-        * If within `_pointing_threshold`
-            * goto tracking
-        * Else
-            * set set mount field coords to center RA/Dec
-            * sync mount coords
-            * slew to field
+    Repeat up to `pointing.max_iterations` times:
+
+    * Take `pointing.exptime` second exposure
+    * Plate-solve
+        * With `pointing.fast`, try progressively slower solves (see
+          `pocs.utils.images.get_progressive_pointing_error`)
+    * Get pointing error
+    * If within `pointing.threshold`
+        * goto tracking
+    * Else
+        * set set mount field coords to center RA/Dec
+        * sync mount coords
+        * slew to field and wait for the mount to settle
     """
     pocs = event_data.model
 
     # This should all move to the `states.pointing` module or somewhere else
     point_config = pocs.config.get('pointing', {})
     pointing_exptime = point_config.get('exptime', 30) * u.s
+    pointing_threshold = point_config.get('threshold', 0.05)
+    max_iterations = point_config.get('max_iterations', 1)
 
     pocs.next_state = 'parking'
 
     try:
-        pocs.say("Taking pointing picture.")
-
         primary_camera = pocs.observatory.primary_camera
         observation = pocs.observatory.current_observation
 
-        image_dir = pocs.config['directories']['images']
-
-        filename = "{}/fields/{}/{}/{}/pointing.cr2".format(
-            image_dir,
-            observation.field.field_name,
-            primary_camera.uid,
-            observation.seq_time)
-
-        start_time = current_time(flatten=True)
-        fits_headers = pocs.observatory.get_standard_headers(observation=observation)
-
-        # Add observation metadata
-        fits_headers.update(observation.status())
-
-        image_id = '{}_{}_{}'.format(
-            pocs.config['name'],
-            primary_camera.uid,
-            start_time
-        )
-
-        sequence_id = '{}_{}_{}'.format(
-            pocs.config['name'],
-            primary_camera.uid,
-            observation.seq_time
-        )
-
-        camera_metadata = {
-            'camera_uid': primary_camera.uid,
-            'camera_name': primary_camera.name,
-            'filter': primary_camera.filter_type,
-            'img_file': filename,
-            'is_primary': primary_camera.is_primary,
-            'start_time': start_time,
-            'image_id': image_id,
-            'sequence_id': sequence_id
-        }
-        fits_headers.update(camera_metadata)
-        pocs.logger.debug("Pointing headers: {}".format(fits_headers))
-
-        # Take pointing picture and wait for result
-        primary_camera.take_exposure(
-            seconds=pointing_exptime,
-            filename=filename,
-        )
-
-        time.sleep(pointing_exptime.value)
-        time.sleep(4)
+        for iteration in range(max_iterations):
+            pocs.say("Taking pointing picture {} of {}.".format(iteration + 1, max_iterations))
 
-        pocs.logger.debug("Processing {}".format(filename))
+            fits_path = _take_pointing_image(pocs, primary_camera, observation, pointing_exptime, iteration)
 
-        pocs.logger.debug("Converting CR2 -> FITS: {}".format(filename))
-        fits_path = images.cr2_to_fits(filename, headers=fits_headers, remove_cr2=True)
+            pocs.say("Ok, I've got the pointing picture, let's see how close we are.")
 
-        observation.exposure_list[image_id] = fits_path
+            # Get the image and solve
+            if point_config.get('fast', False):
+                pointing_coord, pointing_error, tier = images.get_progressive_pointing_error(
+                    fits_path, tiers=point_config.get('tiers'), verbose=True)
+                pocs.logger.debug("Pointing solved with tier {}".format(tier))
+            else:
+                pointing_coord, pointing_error = images.get_pointing_error(fits_path, verbose=True)
 
-        pocs.logger.debug("Adding image metadata to db: {}".format(image_id))
-        pocs.db.observations.insert_one({
-            'data': camera_metadata,
-            'date': current_time(datetime=True),
-            'image_id': image_id,
-        })
+            pocs.logger.debug("Pointing coords: {}".format(pointing_coord))
+            pocs.logger.debug("Pointing Error: {}".format(pointing_error))
 
-        pocs.logger.debug("Pointing file: {}".format(fits_path))
+            separation = pointing_error.separation.value
 
-        pocs.say("Ok, I've got the pointing picture, let's see how close we are.")
+            if separation <= pointing_threshold:
+                break
 
-        # Get the image and solve
-        pointing_coord, pointing_error = images.get_pointing_error(fits_path, verbose=True)
-
-        pocs.logger.debug("Pointing coords: {}".format(pointing_coord))
-        pocs.logger.debug("Pointing Error: {}".format(pointing_error))
-
-        separation = pointing_error.separation.value
-
-        if separation > point_config.get('pointing_threshold', 0.05):
             pocs.say("I'm still a bit away from the field so I'm going to try and get a bit closer.")
 
             # Tell the mount we are at the field, which is the center
@@ -124,7 +75,84 @@ def on_enter(event_data):
                     pocs.observatory.mount.set_target_coordinates(observation.field)
                     pocs.observatory.mount.slew_to_target()
 
+                    # Wait for the slew to finish before the next picture or tracking
+                    while not pocs.observatory.mount.is_tracking:
+                        pocs.logger.debug("Slewing to target")
+                        pocs.sleep()
+
         pocs.next_state = 'tracking'
 
     except Exception as e:
         pocs.say("Hmm, I had a problem checking the pointing error. Sending to parking. {}".format(e))
+
+
+def _take_pointing_image(pocs, primary_camera, observation, pointing_exptime, iteration):
+    """ Take a pointing picture, convert it to FITS and record it in the db, returning the FITS path
+
+    Pointing pictures are not science exposures, so they are not added to the
+    `exposure_list` of the observation.
+    """
+    image_dir = pocs.config['directories']['images']
+
+    filename = "{}/fields/{}/{}/{}/pointing{:02d}.cr2".format(
+        image_dir,
+        observation.field.field_name,
+        primary_camera.uid,
+        observation.seq_time,
+        iteration)
+
+    start_time = current_time(flatten=True)
+    fits_headers = pocs.observatory.get_standard_headers(observation=observation)
+
+    # Add observation metadata
+    fits_headers.update(observation.status())
+
+    image_id = '{}_{}_{}'.format(
+        pocs.config['name'],
+        primary_camera.uid,
+        start_time
+    )
+
+    sequence_id = '{}_{}_{}'.format(
+        pocs.config['name'],
+        primary_camera.uid,
+        observation.seq_time
+    )
+
+    camera_metadata = {
+        'camera_uid': primary_camera.uid,
+        'camera_name': primary_camera.name,
+        'filter': primary_camera.filter_type,
+        'img_file': filename,
+        'is_primary': primary_camera.is_primary,
+        'start_time': start_time,
+        'image_id': image_id,
+        'sequence_id': sequence_id
+    }
+    fits_headers.update(camera_metadata)
+    pocs.logger.debug("Pointing headers: {}".format(fits_headers))
+
+    # Take pointing picture and wait for result
+    primary_camera.take_exposure(
+        seconds=pointing_exptime,
+        filename=filename,
+    )
+
+    time.sleep(pointing_exptime.value)
+    time.sleep(4)
+
+    pocs.logger.debug("Processing {}".format(filename))
+
+    pocs.logger.debug("Converting CR2 -> FITS: {}".format(filename))
+    fits_path = images.cr2_to_fits(filename, headers=fits_headers, remove_cr2=True)
+
+    pocs.logger.debug("Adding image metadata to db: {}".format(image_id))
+    pocs.db.observations.insert_one({
+        'data': camera_metadata,
+        'date': current_time(datetime=True),
+        'image_id': image_id,
+    })
+
+    pocs.logger.debug("Pointing file: {}".format(fits_path))
+
+    return fits_path
@@ -1,6 +1,8 @@
 import os
 import pytest
 
+import numpy as np
+
 from pocs.utils.config import parse_config
 
 
@@ -52,3 +54,53 @@ def config():
 @pytest.fixture
 def data_dir():
     return '{}/pocs/tests/data'.format(os.getenv('POCS'))
+
+
+def make_star_field(positions, shape=(400, 600), flux=2000., fwhm=3.5, axes=None, theta=0.,
+                    background=100., noise=5., seed=0):
+    """ Image of Gaussian stars on a noisy background, for the image processing tests
+
+    Args:
+        positions (numpy.ndarray): (x, y) center of each star in pixels, N x 2
+        shape (tuple, optional): Shape of the image
+        flux (float or numpy.ndarray, optional): Total flux of the stars or of each star
+        fwhm (float, optional): FWHM of the (round) stars in pixels
+        axes (tuple, optional): Standard deviations along the major and minor axes of
+            elliptical stars, used instead of `fwhm`
+        theta (float, optional): Angle of the major axis in radians
+        background (float, optional): Level of the background
+        noise (float, optional): Standard deviation of the noise
+        seed (int, optional): Seed of the noise
+
+    Returns:
+        numpy.ndarray: The image
+    """
+    rng = np.random.RandomState(seed)
+    data = np.full(shape, float(background))
+    if noise:
+        data += rng.normal(0, noise, size=shape)
+
+    if axes is None:
+        axes = (fwhm / 2.355, fwhm / 2.355)
+    sigma_u, sigma_v = axes
+    cos, sin = np.cos(theta), np.sin(theta)
+
+    # Only the pixels close to each star are worth computing
+    radius = int(np.ceil(6 * max(axes)))
+    for (x0, y0), f in zip(positions, np.broadcast_to(flux, len(positions))):
+        rows = slice(min(max(int(y0) - radius, 0), shape[0]), min(max(int(y0) + radius + 1, 0), shape[0]))
+        cols = slice(min(max(int(x0) - radius, 0), shape[1]), min(max(int(x0) + radius + 1, 0), shape[1]))
+        y, x = np.mgrid[rows, cols]
+
+        u = (x - x0) * cos + (y - y0) * sin
+        v = (y - y0) * cos - (x - x0) * sin
+        data[rows, cols] += f / (2 * np.pi * sigma_u * sigma_v) * np.exp(
+            -u**2 / (2 * sigma_u**2) - v**2 / (2 * sigma_v**2))
+
+    return data
+
+
+@pytest.fixture
+def star_positions():
+    rng = np.random.RandomState(42)
+    return np.column_stack([rng.uniform(40, 560, 40), rng.uniform(40, 360, 40)])
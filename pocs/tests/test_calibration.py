@@ -0,0 +1,175 @@
+import os
+import pytest
+
+import numpy as np
+
+from astropy.io import fits
+
+from pocs.images import Image
+from pocs.utils.calibration import CalibrationLibrary
+from pocs.utils.calibration import combine_frames
+from pocs.utils.calibration import get_calibration_key
+from pocs.utils.calibration import get_chunk_rows
+from pocs.utils.error import PanError
+from pocs.utils.images import write_fits
+
+
+def make_frames(directory, data, name='frame', camera_uid='XXXXXX', iso=100, exptime=120.4,
+                compress=False):
+    fnames = list()
+    for i, frame in enumerate(data):
+        hdu = fits.PrimaryHDU(np.asarray(frame, dtype=np.uint16))
+        hdu.header.set('INSTRUME', camera_uid)
+        hdu.header.set('ISO', iso)
+        hdu.header.set('EXPTIME', exptime)
+
+        fname = os.path.join(str(directory), '{}_{:02d}.fits'.format(name, i))
+        if compress:
+            fname += '.fz'
+        write_fits(hdu, fname, compress=compress, clobber=True)
+        fnames.append(fname)
+
+    return fnames
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.RandomState(0)
+    return rng.poisson(2048, size=(7, 60, 40))
+
+
+def test_calibration_key():
+    header = fits.Header([('INSTRUME', 'ee04d1'), ('ISO', 200), ('EXPTIME', 120.4)])
+    assert get_calibration_key(header) == ('ee04d1', 200, 120.4)
+
+    assert get_calibration_key(fits.Header()) == ('unknown', None, None)
+
+
+def test_chunk_rows():
+    # 30 full frames combined in blocks of a few hundred rows
+    rows = get_chunk_rows(30, 5208, max_memory=256 * 2**20)
+    assert 0 < rows < 3476
+    assert rows % 2 == 0
+
+    assert get_chunk_rows(30, 5208, max_memory=1) == 2
+
+
+@pytest.mark.parametrize('method', ['median', 'mean'])
+def test_combine_frames(tmpdir, frames, method):
+    fnames = make_frames(tmpdir, frames)
+
+    # Small enough to need several blocks, including a short one at the end
+    combined = combine_frames(fnames, method=method, max_memory=7 * 40 * 4 * 3 * 8)
+
+    assert combined.dtype == np.float32
+    assert np.allclose(combined, getattr(np, method)(frames, axis=0))
+
+
+def test_combine_frames_sigma_clip(tmpdir, frames):
+    frames[3, 10, 10] = 60000
+    fnames = make_frames(tmpdir, frames)
+
+    combined = combine_frames(fnames, method='sigma_clip')
+
+    assert combined[10, 10] == pytest.approx(np.delete(frames[:, 10, 10], 3).mean())
+    combined[10, 10] = frames[:, 10, 10].mean()
+    assert np.abs(combined - frames.mean(axis=0)).max() < 50
+
+
+def test_combine_frames_compressed(tmpdir, frames):
+    fnames = make_frames(tmpdir, frames, compress=True)
+
+    combined = combine_frames(fnames, max_memory=1)
+
+    assert np.allclose(combined, np.median(frames, axis=0))
+
+
+def test_combine_frames_shape(tmpdir, frames):
+    fnames = make_frames(tmpdir, frames)
+    fnames += make_frames(tmpdir, frames[:1, :50], name='small')
+
+    with pytest.raises(PanError):
+        combine_frames(fnames)
+
+
+def test_build_masters(tmpdir):
+    rng = np.random.RandomState(1)
+    library = CalibrationLibrary(base_dir=str(tmpdir.join('calibration')))
+
+    bias = make_frames(tmpdir, rng.normal(2048, 5, size=(5, 60, 40)), name='bias', exptime=0)
+    bias_fname = library.build_master('bias', bias)
+
+    assert bias_fname == str(tmpdir.join('calibration', 'XXXXXX', 'bias_iso100.fits'))
+    assert fits.getheader(bias_fname)['NCOMBINE'] == 5
+    assert library.get_master('bias', 'XXXXXX', 100).mean() == pytest.approx(2048, abs=1)
+
+    # Flat field with a different level in each Bayer channel
+    response = rng.uniform(0.9, 1.1, size=(60, 40))
+    channels = np.tile([[3.0, 4.0], [4.0, 2.0]], (30, 20))
+    flats = make_frames(tmpdir, [2048 + f * 5000 * channels * response for f in [1, 1.2, 0.8]], name='flat')
+    library.build_master('flat', flats)
+
+    flat = library.get_master('flat', 'XXXXXX', 100)
+    for dy in range(2):
+        for dx in range(2):
+            assert np.median(flat[dy::2, dx::2]) == pytest.approx(1)
+            expected = response[dy::2, dx::2] / np.median(response[dy::2, dx::2])
+            assert np.allclose(flat[dy::2, dx::2], expected, rtol=0.01)
+
+    # Frames from another camera can't go in the same master
+    other = make_frames(tmpdir, rng.normal(2048, 5, size=(1, 60, 40)), name='other', camera_uid='YYYYYY')
+    with pytest.raises(PanError):
+        library.build_master('bias', bias + other, clobber=True)
+
+
+def test_calibrate(tmpdir):
+    rng = np.random.RandomState(2)
+    library = CalibrationLibrary(base_dir=str(tmpdir.join('calibration')))
+
+    offset = rng.normal(2048, 20, size=(60, 40))
+    darks = make_frames(tmpdir, offset + rng.normal(0, 1, size=(5, 60, 40)), name='dark')
+    library.build_master('dark', darks)
+
+    assert library.get_master('dark', 'XXXXXX', 100, exptime=120.4) is not None
+    assert library.get_master('dark', 'XXXXXX', 100, exptime=60) is None
+
+    header = fits.getheader(darks[0])
+    raw = (offset + 1000).astype(np.uint16)
+
+    calibrated, steps = library.calibrate(raw, header)
+
+    assert steps == ['dark']
+    assert calibrated.dtype == np.float32
+    assert np.abs(calibrated - 1000).max() < 3
+
+    # In place
+    data = raw.astype(np.float32)
+    out, _ = library.calibrate(data, header, out=data)
+    assert out is data
+    assert np.allclose(data, calibrated)
+
+    # Nothing for other cameras
+    header['INSTRUME'] = 'YYYYYY'
+    _, steps = library.calibrate(raw, header)
+    assert steps == []
+
+
+def test_image_calibrate(tmpdir, data_dir):
+    fits_file = os.path.join(data_dir, 'tiny.fits')
+    header = fits.getheader(fits_file)
+
+    library = CalibrationLibrary(base_dir=str(tmpdir.join('calibration')))
+    bias = make_frames(tmpdir, np.full((3, header['NAXIS2'], header['NAXIS1']), 100),
+                       camera_uid=header['INSTRUME'], iso=header['ISO'], name='bias')
+    library.build_master('bias', bias)
+
+    image = Image(fits_file)
+    raw = image.data.astype(np.float32)
+
+    assert image.calibrate(library=library) == ['bias']
+    assert image.data.dtype == np.float32
+    assert np.allclose(image.data, raw - 100)
+
+    # Only done once
+    assert image.calibrate(library=library) == ['bias']
+    assert np.allclose(image.data, raw - 100)
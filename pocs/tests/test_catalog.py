@@ -0,0 +1,143 @@
+import os
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import EarthLocation
+from astropy.table import Table
+from astropy.time import Time
+
+from astroplan import Observer
+
+from pocs.scheduler.catalog import FieldCatalog
+from pocs.scheduler.catalog import read_catalog
+from pocs.scheduler.dispatch import Scheduler
+from pocs.utils import error
+from pocs.utils.config import load_config
+
+config = load_config()
+
+loc = config['location']
+location = EarthLocation(lon=loc['longitude'], lat=loc['latitude'], height=loc['elevation'])
+observer = Observer(location=location, name="Test Observer", timezone=loc['timezone'])
+
+simple_fields_file = config['directories']['targets'] + '/simple.yaml'
+
+fields_csv = """name,ra,dec,priority,exp_time
+HD 189733,300.182139,22.710851,100,
+Wasp 33,36.712743,37.550482,100,90
+M44,130.1,19.666700,50,
+Wasp 140,60.385583,-20.450972,,
+"""
+
+start = Time('2016-08-13 06:00:00')
+
+
+@pytest.fixture
+def csv_file(tmpdir):
+    fname = str(tmpdir.join('fields.csv'))
+    with open(fname, 'w') as f:
+        f.write(fields_csv)
+
+    return fname
+
+
+def test_read_csv(csv_file):
+    catalog = read_catalog(csv_file)
+
+    assert len(catalog) == 4
+    assert list(catalog.names) == ['HD 189733', 'Wasp 33', 'M44', 'Wasp 140']
+    assert catalog.coords[2].ra.to(u.degree).value == pytest.approx(130.1)
+
+    configs = list(catalog.get_field_configs())
+    assert configs[1]['exp_time'] == 90
+    assert 'exp_time' not in configs[0]
+    assert 'priority' not in configs[3]
+
+
+def test_read_positions(tmpdir):
+    fname = str(tmpdir.join('fields.csv'))
+    with open(fname, 'w') as f:
+        f.write('Name,Position\n')
+        f.write('HD 189733,20h00m43.7135s +22d42m39.0645s\n')
+        f.write('Bad,foo\n')
+
+    catalog = read_catalog(fname)
+
+    assert list(catalog.names) == ['HD 189733']
+    assert catalog.ra[0] == pytest.approx(300.18214, abs=1e-4)
+
+
+def test_read_fits(csv_file, tmpdir):
+    fname = str(tmpdir.join('fields.fits'))
+    Table.read(csv_file, format='ascii.csv').write(fname)
+
+    catalog = read_catalog(fname)
+
+    assert list(catalog.names) == list(read_catalog(csv_file).names)
+    assert np.allclose(catalog.dec, read_catalog(csv_file).dec)
+
+
+def test_read_yaml():
+    catalog = read_catalog(simple_fields_file)
+
+    assert 'HD 189733' in catalog.names
+    assert len(catalog) > 2
+
+
+def test_bad_catalogs(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        read_catalog('/var/path/foo.csv')
+
+    fname = str(tmpdir.join('fields.txt'))
+    with open(fname, 'w') as f:
+        f.write('name\n')
+
+    with pytest.raises(error.InvalidConfig):
+        read_catalog(fname)
+
+
+def test_cache(csv_file, tmpdir):
+    cache_file = str(tmpdir.join('cache', 'fields.npz'))
+
+    catalog = read_catalog(csv_file, cache_file=cache_file)
+    assert os.path.exists(cache_file)
+
+    cached = FieldCatalog.load(cache_file)
+    assert cached.is_current(csv_file)
+    assert list(cached.names) == list(catalog.names)
+    assert np.allclose(cached.columns['exp_time'], catalog.columns['exp_time'], equal_nan=True)
+
+    # Changing the file means it is read again
+    with open(csv_file, 'a') as f:
+        f.write('M42,83.822,-5.391,25,\n')
+
+    assert not cached.is_current(csv_file)
+    assert len(read_catalog(csv_file, cache_file=cache_file)) == 5
+
+
+def test_get_visible(csv_file):
+    catalog = read_catalog(csv_file)
+    end = observer.tonight(time=start, horizon=-18 * u.degree)[-1]
+
+    visible = catalog.get_visible(observer, start, end)
+
+    # M44 doesn't rise above 30 degrees before the end of the night
+    assert visible[0]
+    assert not visible[2]
+
+
+def test_scheduler_prefilter(csv_file):
+    # Nothing depends on the date until there is a time to plan for
+    scheduler = Scheduler(observer, fields_file=csv_file, prefilter_size=2)
+    assert len(scheduler.observations) == 0
+
+    scheduler.update_observations(time=start)
+
+    assert 'HD 189733' in scheduler.observations
+    assert 'M44' not in scheduler.observations
+    assert scheduler.observations['Wasp 33'].exp_time == 90 * u.second
+
+    # Small files are loaded in full
+    scheduler = Scheduler(observer, fields_file=csv_file)
+    assert len(scheduler.observations) == 4
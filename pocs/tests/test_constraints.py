@@ -198,3 +198,48 @@ def test_moon_avoidance():
 
     assert veto1 is False and veto2 is False
     assert score2 > score1
+
+
+@pytest.fixture
+def observations():
+    observations = list()
+    for config in field_list:
+        config = dict(config)
+        if 'exp_time' in config:
+            config['exp_time'] = float(config['exp_time']) * u.second
+
+        observations.append(Observation(Field(config['name'], config['position']), **config))
+
+    return observations
+
+
+def test_base_get_scores(observations):
+    class Priority(BaseConstraint):
+
+        def get_score(self, time, observer, observation, **kwargs):
+            return observation.priority < 50, observation.priority / 100 * self.weight
+
+    vetoes, scores = Priority(weight=2.0).get_scores(Time('2016-08-13 10:00:00'), observer, observations)
+
+    assert list(vetoes) == [obs.priority < 50 for obs in observations]
+    assert list(scores) == [obs.priority / 50 for obs in observations]
+
+
+@pytest.mark.parametrize('constraint', [Altitude(30 * u.degree), Duration(30 * u.degree), MoonAvoidance()])
+def test_get_scores_matches_get_score(constraint, observations):
+    time = Time('2016-08-13 10:00:00')
+    kwargs = {
+        'end_of_night': observer.tonight(time=time, horizon=-18 * u.degree)[-1],
+        'moon': get_moon(time, observer.location),
+    }
+
+    vetoes, scores = constraint.get_scores(time, observer, observations, **kwargs)
+
+    assert len(vetoes) == len(scores) == len(observations)
+
+    for observation, veto, score in zip(observations, vetoes, scores):
+        expected_veto, expected_score = constraint.get_score(time, observer, observation, **kwargs)
+
+        assert veto == expected_veto
+        if not veto:
+            assert score == pytest.approx(expected_score, abs=0.01)
@@ -111,7 +111,10 @@ def test_continue_observation(scheduler):
     assert scheduler.current_observation is None
 
 
-def test_set_observation_then_reset(scheduler):
+def test_set_observation_then_reset(scheduler, monkeypatch):
+    # New sequences are timed to the second, so the clock moves on between picks
+    monkeypatch.setenv('POCSTIME', '2016-08-13T05:00:00')
+
     time = Time('2016-08-13 05:00:00')
     scheduler.get_observation(time=time)
 
@@ -121,6 +124,7 @@ def test_set_observation_then_reset(scheduler):
     # Reset priority
     scheduler.observations[obs1.name].priority = 1.0
 
+    monkeypatch.setenv('POCSTIME', '2016-08-13T05:00:01')
     scheduler.get_observation(time=time)
     obs2 = scheduler.current_observation
 
@@ -128,6 +132,7 @@ def test_set_observation_then_reset(scheduler):
 
     scheduler.observations[obs1.name].priority = 500.0
 
+    monkeypatch.setenv('POCSTIME', '2016-08-13T05:00:02')
     scheduler.get_observation(time=time)
     obs3 = scheduler.current_observation
     obs3_seq_time = obs3.seq_time
@@ -135,6 +140,7 @@ def test_set_observation_then_reset(scheduler):
     assert original_seq_time != obs3_seq_time
 
     # Now reselect same target and test that seq_time does not change
+    monkeypatch.setenv('POCSTIME', '2016-08-13T05:00:03')
     scheduler.get_observation(time=time)
     obs4 = scheduler.current_observation
     assert obs4.seq_time == obs3_seq_time
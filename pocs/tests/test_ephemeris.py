@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import EarthLocation
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+
+from astroplan import FixedTarget
+from astroplan import Observer
+
+from pocs.scheduler.constraint import Duration
+from pocs.scheduler.dispatch import Scheduler
+from pocs.scheduler.ephemeris import EphemerisTable
+from pocs.scheduler.ephemeris import get_event_seconds
+from pocs.utils.config import load_config
+
+config = load_config()
+
+loc = config['location']
+location = EarthLocation(lon=loc['longitude'], lat=loc['latitude'], height=loc['elevation'])
+observer = Observer(location=location, name="Test Observer", timezone=loc['timezone'])
+
+field_list = [
+    {'name': 'HD 189733', 'position': '20h00m43.7135s +22d42m39.0645s'},
+    {'name': 'Wasp 33', 'position': '02h26m51.0582s +37d33m01.733s'},
+    {'name': 'M44', 'position': '08h40m24s +19d40m00.12s'},
+    {'name': 'Polaris', 'position': '02h31m49.09s +89d15m50.8s'},
+]
+
+names = [field['name'] for field in field_list]
+coords = SkyCoord([field['position'] for field in field_list])
+
+start = Time('2016-08-13 06:00:00')
+end = observer.tonight(time=start, horizon=-18 * u.degree)[-1]
+
+
+@pytest.fixture
+def table():
+    return EphemerisTable.compute(observer, names, coords, start, end)
+
+
+def test_transit_times(table):
+    for i, name in enumerate(names[:3]):
+        transit = observer.target_meridian_transit_time(start, FixedTarget(coords[i], name=name), which='next')
+        assert abs(table.transit[i] - transit.mjd) * 86400 < 120
+
+
+def test_set_times(table):
+    target = FixedTarget(coords[0], name=names[0])
+    set_time = observer.target_set_time(start, target, which='next', horizon=30 * u.degree)
+
+    assert abs(table.set[0] - set_time.mjd) * 86400 < 120
+
+    # Polaris stays at about the latitude of the site, so never gets above 30 degrees
+    assert np.isnan(table.set[3])
+    assert np.isnan(table.rise[3])
+
+
+def test_never_sets():
+    north = Observer(location=EarthLocation(lon=location.lon, lat=70 * u.degree, height=0 * u.m))
+    north_table = EphemerisTable.compute(north, names, coords, start, start + 6 * u.hour)
+
+    # Polaris is always at about 70 degrees
+    assert np.isinf(north_table.set[3])
+    assert north_table.window_start[3] == pytest.approx(start.mjd)
+    assert north_table.window_end[3] == pytest.approx(north_table.end.mjd)
+
+
+def test_windows(table):
+    # HD 189733 is up at the start of the night, M44 only rises after it
+    assert table.window_start[0] == start.mjd
+    assert table.window_end[0] == pytest.approx(table.set[0])
+    assert np.isnan(table.window_start[2])
+
+    # Polaris is never up
+    assert np.isnan(table.window_start[3])
+    assert np.isnan(table.window_end[3])
+
+
+def test_events_match(table):
+    time = start + 3 * u.hour
+
+    from_table = table.get_event_seconds(time, horizon=20 * u.degree)
+    direct = get_event_seconds(time, observer, coords, horizon=20 * u.degree)
+
+    assert np.all(from_table['is_up'] == direct['is_up'])
+    assert np.allclose(from_table['transit'], direct['transit'], atol=5)
+    assert np.allclose(from_table['altitude'], direct['altitude'], atol=0.01)
+
+
+def test_save_load(table, tmpdir):
+    fname = str(tmpdir.join('cache', 'ephemeris.npz'))
+    table.save(fname)
+
+    loaded = EphemerisTable.load(fname)
+
+    assert loaded.names == names
+    assert loaded.is_valid(names, end)
+    assert not loaded.is_valid(names[:2], end)
+    assert np.allclose(loaded.transit, table.transit)
+
+
+def test_scheduler_ephemeris(tmpdir):
+    fname = str(tmpdir.join('ephemeris.npz'))
+    scheduler = Scheduler(observer, fields_list=list(field_list), constraints=[Duration(30 * u.degree)],
+                          ephemeris_file=fname)
+
+    table = scheduler.get_ephemeris(time=start)
+    assert scheduler.get_ephemeris(time=start + 1 * u.hour) is table
+
+    # Read back after a restart
+    scheduler = Scheduler(observer, fields_list=list(field_list), constraints=[Duration(30 * u.degree)],
+                          ephemeris_file=fname)
+    assert np.allclose(scheduler.get_ephemeris(time=start + 1 * u.hour).transit, table.transit)
+
+    # New fields or a new night need a new table
+    scheduler.remove_observation('M44')
+    assert len(scheduler.get_ephemeris(time=start)) == 3
+    assert scheduler.get_ephemeris(time=start + 1 * u.day).end > end
@@ -0,0 +1,84 @@
+import os
+import pytest
+import stat
+import sys
+
+from pocs.utils.error import InvalidSystemCommand
+from pocs.utils.exiftool import ExifTool
+
+# Minimal stand-in for `exiftool -stay_open True -@ -`
+fake_exiftool = """#!{python}
+import json
+import sys
+
+args = []
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line.startswith('-execute'):
+        files = [a for a in args if not a.startswith('-')]
+        sys.stdout.write(json.dumps([{{'SourceFile': f, 'ISO': 100}} for f in files]))
+        sys.stdout.write('\\n{{ready' + line[len('-execute'):] + '}}\\n')
+        sys.stdout.flush()
+        args = []
+    elif args[-1:] == ['-stay_open'] and line == 'False':
+        break
+    else:
+        args.append(line)
+"""
+
+
+@pytest.fixture
+def exiftool(request, tmpdir):
+    script = tmpdir.join('exiftool')
+    script.write(fake_exiftool.format(python=sys.executable))
+    os.chmod(str(script), stat.S_IRWXU)
+
+    et = ExifTool(executable=str(script), timeout=10)
+    request.addfinalizer(et.stop)
+
+    return et
+
+
+def test_bad_executable():
+    et = ExifTool(executable='/not/a/real/exiftool')
+    with pytest.raises(InvalidSystemCommand):
+        et.execute('-j', 'foo.cr2')
+
+
+def test_single_file(exiftool):
+    exif = exiftool.get_metadata(['foo.cr2'])
+    assert exif == [{'SourceFile': 'foo.cr2', 'ISO': 100}]
+
+
+def test_process_reused(exiftool):
+    exiftool.get_metadata(['foo.cr2'])
+    pid = exiftool._proc.pid
+
+    exiftool.get_metadata(['bar.cr2'])
+    assert exiftool._proc.pid == pid
+
+
+def test_batch(exiftool):
+    fnames = ['{:02d}.cr2'.format(i) for i in range(10)]
+    exif_list = exiftool.get_metadata(fnames)
+
+    assert len(exif_list) == len(fnames)
+    assert [exif['SourceFile'] for exif in exif_list] == fnames
+
+
+def test_restart(exiftool):
+    exiftool.get_metadata(['foo.cr2'])
+    exiftool._proc.kill()
+    exiftool._proc.wait()
+
+    exif = exiftool.get_metadata(['bar.cr2'])
+    assert exif[0]['SourceFile'] == 'bar.cr2'
+    assert exiftool.is_running
+
+
+def test_stop(exiftool):
+    exiftool.get_metadata(['foo.cr2'])
+    assert exiftool.is_running
+
+    exiftool.stop()
+    assert exiftool.is_running is False
@@ -0,0 +1,104 @@
+import os
+import pytest
+import time
+
+import numpy as np
+
+from astropy.io import fits
+
+from pocs.utils.image_index import ImageIndex
+from pocs.utils.image_index import read_header
+
+
+def make_frame(fname, field='Wasp 33', seq='PAN000_cam0_20160909T050000', date_obs='2016-09-09T05:00:00',
+               compress=False):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+    data = np.zeros((8, 8), dtype=np.uint16)
+
+    header = fits.PrimaryHDU(data).header
+    header['DATE-OBS'] = date_obs
+    header['FIELD'] = field
+    header['SEQID'] = seq
+    header['INSTRUME'] = 'cam0'
+    header['RA-MNT'] = 36.6
+    header['AIRMASS'] = ''
+
+    if compress:
+        fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header=header)]).writeto(fname)
+    else:
+        fits.PrimaryHDU(data, header=header).writeto(fname)
+
+
+@pytest.fixture
+def image_dir(tmpdir):
+    fields_dir = tmpdir.join('fields')
+    make_frame(str(fields_dir.join('Wasp33', 'cam0', 'seq0', '0.fits')))
+    make_frame(str(fields_dir.join('Wasp33', 'cam0', 'seq0', '1.fits')), date_obs='2016-09-09T05:01:00')
+    make_frame(str(fields_dir.join('M42', 'cam0', 'seq1', '0.fits.fz')), field='M42', seq='seq1',
+               date_obs='2016-09-10T05:00:00', compress=True)
+
+    return str(tmpdir)
+
+
+@pytest.fixture
+def index(tmpdir):
+    return ImageIndex(db_file=str(tmpdir.join('image_index.sqlite')))
+
+
+def test_read_header(image_dir):
+    header = read_header(os.path.join(image_dir, 'fields', 'M42', 'cam0', 'seq1', '0.fits.fz'))
+    assert header['FIELD'] == 'M42'
+
+    header = read_header(os.path.join(image_dir, 'fields', 'Wasp33', 'cam0', 'seq0', '0.fits'))
+    assert header['SEQID'] == 'PAN000_cam0_20160909T050000'
+
+
+def test_update(index, image_dir):
+    counts = index.update(directory=image_dir)
+    assert counts['added'] == 3
+    assert len(index) == 3
+
+    # Nothing to do the second time
+    counts = index.update(directory=image_dir)
+    assert counts['unchanged'] == 3
+    assert counts['added'] == 0
+
+
+def test_update_changed(index, image_dir):
+    index.update(directory=image_dir)
+
+    fname = os.path.join(image_dir, 'fields', 'Wasp33', 'cam0', 'seq0', '1.fits')
+    fits.setval(fname, 'FIELD', value='Wasp 33 b')
+    os.utime(fname, (time.time() + 10, time.time() + 10))
+    os.remove(os.path.join(image_dir, 'fields', 'Wasp33', 'cam0', 'seq0', '0.fits'))
+
+    counts = index.update(directory=image_dir)
+    assert counts['updated'] == 1
+    assert counts['removed'] == 1
+    assert index.fields() == ['M42', 'Wasp 33 b']
+
+
+def test_query(index, image_dir):
+    index.update(directory=image_dir)
+
+    frames = index.query(field='Wasp 33')
+    assert [frame['date_obs'] for frame in frames] == ['2016-09-09T05:00:00', '2016-09-09T05:01:00']
+    assert frames[0]['ra_mnt'] == 36.6
+    assert frames[0]['airmass'] is None
+    assert frames[0]['solved'] is False
+
+    assert len(index.files(start='2016-09-10')) == 1
+    assert len(index.files(end='2016-09-10', camera='cam0')) == 2
+    assert index.sequences(field='M42') == ['seq1']
+
+
+def test_solved(index, image_dir):
+    fname = os.path.join(image_dir, 'fields', 'Wasp33', 'cam0', 'seq0', '0.fits')
+    with open(fname.replace('.fits', '.solved'), 'wb') as f:
+        f.write(b'\x01')
+
+    index.add(fname)
+
+    assert fname in index
+    assert index.files(solved=True) == [fname]
@@ -2,11 +2,24 @@ import os
 import pytest
 import shutil
 
+import numpy as np
+
 from pocs.images import Image
 from pocs.images import PointingError
+from pocs.images import bin_data
+from pocs.images import compute_offset_rotation
+from pocs.images import get_regions
+from pocs.images import get_registration
+from pocs.images import get_rggb_channels
+from pocs.utils import images as img_utils
 from pocs.utils.error import SolveError
+from pocs.utils.images import get_wcsinfo
+from pocs.utils.images import run_wcsinfo
+from pocs.utils.images import write_fits
 
+from astropy import units as u
 from astropy.coordinates import SkyCoord
+from astropy.io import fits
 
 can_solve = pytest.mark.skipif(
     not pytest.config.getoption("--solve"),
@@ -121,6 +134,45 @@ def test_pointing_error(solved_fits_file):
     assert (perr.magnitude.value - 1.9445870862060288) < 1e-5
 
 
+def test_progressive_pointing_error(solved_fits_file, tmpdir, monkeypatch):
+    fits_fname = str(tmpdir.join('pointing00.fits'))
+    shutil.copyfile(solved_fits_file, fits_fname)
+
+    calls = list()
+
+    def fake_solve(fname, **kwargs):
+        calls.append(kwargs)
+        if kwargs['downsample'] == 8:
+            raise SolveError('File not solved')
+
+        with open(fname.replace('.fits', '.solved'), 'wb') as f:
+            f.write(b'\x01')
+
+        return {'solved_fits_file': fname}
+
+    monkeypatch.setattr(img_utils, 'get_solve_field', fake_solve)
+
+    coord, perr, tier = img_utils.get_progressive_pointing_error(fits_fname)
+
+    assert tier == 1
+    assert [c['radius'] for c in calls] == [2, 5]
+    assert isinstance(coord, SkyCoord)
+    assert perr.separation.value >= 0
+
+
+def test_progressive_pointing_error_fails(solved_fits_file, tmpdir, monkeypatch):
+    fits_fname = str(tmpdir.join('pointing00.fits'))
+    shutil.copyfile(solved_fits_file, fits_fname)
+
+    def fake_solve(fname, **kwargs):
+        raise SolveError('File not solved')
+
+    monkeypatch.setattr(img_utils, 'get_solve_field', fake_solve)
+
+    with pytest.raises(SolveError):
+        img_utils.get_progressive_pointing_error(fits_fname, tiers=[{'downsample': 4, 'radius': 5}])
+
+
 def test_compute_offset_arcsec(solved_fits_file, unsolved_fits_file):
     img0 = Image(solved_fits_file)
     img1 = Image(unsolved_fits_file)
@@ -153,3 +205,182 @@ def test_compute_offset_string(solved_fits_file, unsolved_fits_file):
 
     assert offset_info['offsetX'] - 3.9686712667745043 < 1e-5
     assert offset_info['offsetY'] - 17.585827075244445 < 1e-5
+
+
+def test_lazy_data(solved_fits_file):
+    im0 = Image(solved_fits_file)
+
+    assert im0._data is None
+    assert im0._mask is None
+    assert im0.shape == (700, 700)
+
+    assert im0.data.shape == im0.shape
+    assert im0._mask is None
+
+
+def test_lazy_mask(solved_fits_file):
+    im0 = Image(solved_fits_file)
+
+    assert im0.RGGB.mask is None
+
+    mask = im0.mask
+    assert mask.shape == im0.shape
+    assert mask.dtype == bool
+    assert im0.RGGB.mask is mask
+
+
+def test_bin_data():
+    data = np.arange(16, dtype=np.uint16).reshape(4, 4)
+
+    binned = bin_data(data, binning=2, dtype=np.uint32)
+    assert binned.dtype == np.uint32
+    assert binned.tolist() == [[10, 18], [42, 50]]
+
+    averaged = bin_data(data, binning=2, dtype=np.float32, average=True)
+    assert averaged.dtype == np.float32
+    assert averaged.tolist() == [[2.5, 4.5], [10.5, 12.5]]
+
+
+def test_bin_data_bad_shape():
+    with pytest.raises(AssertionError):
+        bin_data(np.zeros((5, 4)), binning=2)
+
+
+def test_rggb_channels():
+    data = np.arange(16, dtype=np.uint16).reshape(4, 4)
+    channels = get_rggb_channels(data)
+
+    assert list(channels.keys()) == ['R', 'G1', 'G2', 'B']
+    assert channels['R'].tolist() == [[0, 2], [8, 10]]
+    assert channels['G1'].tolist() == [[1, 3], [9, 11]]
+    assert channels['G2'].tolist() == [[4, 6], [12, 14]]
+    assert channels['B'].tolist() == [[5, 7], [13, 15]]
+
+    for channel in channels.values():
+        assert np.shares_memory(channel, data)
+
+
+def test_luminance(solved_fits_file):
+    im0 = Image(solved_fits_file)
+
+    lum = im0.luminance
+    assert lum.shape == (350, 350)
+    assert np.allclose(lum, (im0.R.astype(float) + im0.G1 + im0.G2 + im0.B) / 4)
+
+
+def test_get_regions():
+    regions = get_regions((1000, 2000), subframe_size=200)
+    assert list(regions.keys()) == ['center', 'upper_right', 'upper_left', 'lower_right', 'lower_left']
+    assert regions['center'] == (1000, 500)
+    assert regions['lower_left'] == (100, 100)
+
+    grid = get_regions((1000, 2000), subframe_size=200, grid=(3, 3))
+    assert len(grid) == 9
+    assert grid['center'] == (1000, 500)
+
+
+def test_registration_shift():
+    np.random.seed(0)
+    data = np.random.normal(size=(600, 600))
+    shifted = np.roll(np.roll(data, 3, axis=0), -5, axis=1)
+
+    offset = compute_offset_rotation(data, shifted, upsample_factor=10)
+    assert offset['X'].value == 3
+    assert offset['Y'].value == -5
+    assert abs(offset['angle'].value) < 1e-5
+
+
+def test_registration_cache():
+    np.random.seed(0)
+    data = np.random.normal(size=(600, 600))
+
+    reg0 = get_registration(data, cache_key='test_registration_cache')
+    reg1 = get_registration(lambda: pytest.fail("Reference should not be read"),
+                            cache_key='test_registration_cache')
+    assert reg0 is reg1
+
+    reg2 = get_registration(data, cache_key='test_registration_cache', subframe_size=100)
+    assert reg2 is not reg0
+
+
+def test_wcsinfo(solved_fits_file):
+    wcs_info = get_wcsinfo(solved_fits_file)
+    header = fits.getheader(solved_fits_file)
+
+    assert wcs_info['wcs_file'] == solved_fits_file
+
+    det = header['CD1_1'] * header['CD2_2'] - header['CD1_2'] * header['CD2_1']
+    assert wcs_info['pixscale'].value == pytest.approx(3600 * np.sqrt(abs(det)))
+    assert wcs_info['parity'] == -1
+
+    # Solved with --crpix-center so the center is the reference point
+    assert wcs_info['ra_center'].value == pytest.approx(header['CRVAL1'])
+    assert wcs_info['dec_center'].value == pytest.approx(header['CRVAL2'])
+    assert wcs_info['orientation_center'].value == pytest.approx(wcs_info['orientation'].value, abs=0.01)
+
+    assert wcs_info['ramin'] < wcs_info['ra_center'] < wcs_info['ramax']
+    assert wcs_info['decmin'] < wcs_info['dec_center'] < wcs_info['decmax']
+
+    field_width = (header['IMAGEW'] * u.pixel * wcs_info['pixscale']).to(u.degree)
+    assert wcs_info['fieldw'].value == pytest.approx(field_width.value, rel=0.01)
+
+
+def test_wcsinfo_unsolved(unsolved_fits_file):
+    assert get_wcsinfo(unsolved_fits_file) == {'wcs_file': unsolved_fits_file}
+
+
+def test_wcsinfo_cached(solved_fits_file):
+    wcs_info = get_wcsinfo(solved_fits_file)
+    wcs_info['date_obs'] = '20160909T081152'
+
+    assert 'date_obs' not in get_wcsinfo(solved_fits_file)
+
+
+@pytest.mark.skipif(not os.path.exists(shutil.which('wcsinfo') or '{}/astrometry/bin/wcsinfo'.format(os.getenv('PANDIR'))),
+                    reason="need astrometry.net wcsinfo")
+def test_wcsinfo_matches_command(solved_fits_file):
+    expected = run_wcsinfo(solved_fits_file)
+    wcs_info = get_wcsinfo(solved_fits_file)
+
+    for key, value in expected.items():
+        # `wcsinfo` gives the field size in varying `fieldunits`
+        if key in ['wcs_file', 'fieldarea', 'fieldw', 'fieldh']:
+            continue
+
+        # Bounds come from walking the edge so are only close
+        rel = 1e-4 if key.endswith('min') or key.endswith('max') or 'merc' in key else 1e-7
+        assert u.Quantity(wcs_info[key]).value == pytest.approx(u.Quantity(value).value, rel=rel, abs=1e-8), key
+
+
+def test_write_fits_compressed(solved_fits_file, tmpdir):
+    hdu = fits.open(solved_fits_file)[0]
+    fits_fname = str(tmpdir.join('compressed.fits.fz'))
+
+    write_fits(hdu, fits_fname, compress=True)
+
+    # Same layout as fpack
+    with fits.open(fits_fname, disable_image_compression=True) as hdu_list:
+        assert len(hdu_list) == 2
+        assert hdu_list[0].data is None
+        assert hdu_list[1].header['ZCMPTYPE'] == 'RICE_1'
+        assert hdu_list[1].header['ZTILE1'] == hdu.header['NAXIS1']
+        assert hdu_list[1].header['ZTILE2'] == 1
+
+    with fits.open(fits_fname) as hdu_list:
+        assert hdu_list[1].header['FIELD'] == hdu.header['FIELD']
+        assert np.array_equal(hdu_list[1].data, hdu.data)
+
+    assert os.path.getsize(fits_fname) < os.path.getsize(solved_fits_file)
+
+
+def test_write_fits_tile_size(solved_fits_file, tmpdir):
+    hdu = fits.open(solved_fits_file)[0]
+    fits_fname = str(tmpdir.join('compressed.fits.fz'))
+
+    write_fits(hdu, fits_fname, compress=True, tile_size=(100, 50))
+
+    with fits.open(fits_fname, disable_image_compression=True) as hdu_list:
+        assert hdu_list[1].header['ZTILE1'] == 100
+        assert hdu_list[1].header['ZTILE2'] == 50
+
+    assert np.array_equal(fits.getdata(fits_fname), hdu.data)
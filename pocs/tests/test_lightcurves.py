@@ -0,0 +1,112 @@
+import os
+import pytest
+
+import numpy as np
+
+from astropy.table import Table
+
+from pocs.utils.error import PanError
+from pocs.utils.lightcurves import LightCurveStore
+
+
+def make_table(frame, num_stars=20):
+    return Table({
+        'x': np.arange(num_stars) + 0.1 * frame,
+        'y': np.arange(num_stars) * 2.,
+        'flux': 1000. * np.arange(1, num_stars + 1) + frame,
+        'flags': np.full(num_stars, frame % 2, dtype=np.uint8),
+        'name': ['star{}'.format(i) for i in range(num_stars)],
+    })
+
+
+@pytest.fixture
+def store(tmpdir):
+    return LightCurveStore(base_dir=str(tmpdir.join('lightcurves')), chunk_frames=4)
+
+
+def test_append_read(store):
+    for frame in range(10):
+        assert store.append('M42', 'ee04d1', 'PAN001_ee04d1_20160907', 57640.5 + frame / 1440, make_table(frame)) == frame
+
+    info = store.get_info('M42', 'ee04d1', 'PAN001_ee04d1_20160907')
+    assert info['num_stars'] == 20
+    assert info['num_frames'] == 10
+    assert sorted(info['columns']) == ['flags', 'flux', 'x', 'y']
+
+    # Light curve of a single star across blocks
+    times, values = store.read('M42', 'ee04d1', 'PAN001_ee04d1_20160907', star=3)
+    assert np.allclose(times, 57640.5 + np.arange(10) / 1440)
+    assert np.allclose(values['flux'], 4000 + np.arange(10))
+    assert np.all(values['flags'] == np.arange(10) % 2)
+    assert values['flags'].dtype == np.uint8
+
+    times, values = store.read('M42', 'ee04d1', 'PAN001_ee04d1_20160907', columns=['x'])
+    assert list(values.keys()) == ['x']
+    assert values['x'].shape == (20, 10)
+    assert np.allclose(values['x'][:, 7], np.arange(20) + 0.7)
+
+
+def test_reopen(store):
+    for frame in range(6):
+        store.append('M42', 'ee04d1', 'seq', frame, make_table(frame), columns=['flux'], star_ids=range(20))
+    store.close()
+
+    # New store on the same directory carries on from the last frame
+    other = LightCurveStore(base_dir=store.base_dir)
+    assert other.append('M42', 'ee04d1', 'seq', 6, make_table(6)) == 6
+
+    info = other.get_info('M42', 'ee04d1', 'seq')
+    assert info['columns'] == ['flux']
+    assert info['star_ids'][:2] == ['0', '1']
+
+    times, values = other.read('M42', 'ee04d1', 'seq', star=0)
+    assert np.allclose(times, np.arange(7))
+    assert np.allclose(values['flux'], 1000 + np.arange(7))
+
+
+def test_interrupted_append(store):
+    store.append('M42', 'ee04d1', 'seq', 0, make_table(0))
+
+    # Columns written but not the time, as if the unit stopped part way
+    sequence = store._get_sequence('M42', 'ee04d1', 'seq')
+    sequence._get_block('flux', 0)[:, 1] = -1
+
+    assert store.get_info('M42', 'ee04d1', 'seq')['num_frames'] == 1
+    assert store.append('M42', 'ee04d1', 'seq', 1, make_table(1)) == 1
+
+    times, values = store.read('M42', 'ee04d1', 'seq', star=0)
+    assert np.allclose(values['flux'], [1000, 1001])
+
+
+def test_bad_frames(store):
+    store.append('M42', 'ee04d1', 'seq', 0, make_table(0))
+
+    with pytest.raises(PanError):
+        store.append('M42', 'ee04d1', 'seq', 1, make_table(1, num_stars=19))
+
+    table = make_table(1)
+    del table['flux']
+    with pytest.raises(PanError):
+        store.append('M42', 'ee04d1', 'seq', 1, table)
+
+    with pytest.raises(PanError):
+        store.read('M42', 'ee04d1', 'seq', star=20)
+
+    with pytest.raises(PanError):
+        store.read('M42', 'ee04d1', 'other')
+
+    assert store.get_info('M42', 'ee04d1', 'seq')['num_frames'] == 1
+
+
+def test_list_sequences(store):
+    store.append('M42', 'ee04d1', 'seq1', 0, make_table(0))
+    store.append('M42', '671a2b', 'seq2', 0, make_table(0))
+    store.append('Wasp 33', 'ee04d1', 'seq3', 0, make_table(0))
+
+    assert store.list_sequences() == [('M42', '671a2b', 'seq2'),
+                                      ('M42', 'ee04d1', 'seq1'),
+                                      ('Wasp_33', 'ee04d1', 'seq3')]
+    assert store.list_sequences(camera_uid='ee04d1') == [('M42', 'ee04d1', 'seq1'),
+                                                         ('Wasp_33', 'ee04d1', 'seq3')]
+
+    assert os.path.isdir(store.get_path('Wasp 33', 'ee04d1', 'seq3'))
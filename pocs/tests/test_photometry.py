@@ -0,0 +1,137 @@
+import os
+import pytest
+
+import numpy as np
+
+from astropy.coordinates import SkyCoord
+
+from conftest import make_star_field
+from pocs.images import Image
+from pocs.utils.error import PanError
+from pocs.utils.photometry import FLAG_BACKGROUND
+from pocs.utils.photometry import FLAG_EDGE
+from pocs.utils.photometry import aperture_photometry
+from pocs.utils.photometry import get_aperture_weights
+from pocs.utils.photometry import get_positions
+
+
+def make_frame(positions, fluxes, shape=(400, 600), background=(100, 150, 150, 80), fwhm=3.,
+               noise=0., seed=0):
+    """ Bayer frame with a Gaussian star per position, `fluxes` is N x 4 for R, G1, G2, B """
+    data = make_star_field([], shape=shape, background=0, noise=noise, seed=seed)
+
+    positions = np.asarray(positions, dtype=float)
+    for channel, (dy, dx) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+        plane = data[dy::2, dx::2]
+
+        # Positions on the channel plane, which has half the resolution
+        plane_positions = (positions - [dx, dy]) / 2
+        plane += make_star_field(plane_positions, shape=plane.shape, flux=fluxes[:, channel], fwhm=fwhm,
+                                 background=background[channel], noise=0)
+
+    return data
+
+
+@pytest.fixture
+def stars():
+    # Jittered grid so the stars don't overlap
+    rng = np.random.RandomState(3)
+    y, x = np.mgrid[50:350:60, 50:550:85]
+    positions = np.column_stack([x.ravel(), y.ravel()]) + rng.uniform(-5, 5, size=(30, 2))
+    fluxes = rng.uniform(1000, 20000, size=(30, 4))
+
+    return positions, fluxes
+
+
+def test_aperture_weights():
+    rng = np.random.RandomState(0)
+    dx, dy = rng.uniform(-0.5, 0.5, size=(2, 100))
+
+    weights = get_aperture_weights(dx, dy, np.arange(-6, 7), 4.3, subsample=9)
+
+    assert weights.shape == (100, 13, 13)
+    assert weights.min() >= 0 and weights.max() <= 1
+    assert np.allclose(weights.sum(axis=(1, 2)), np.pi * 4.3**2, rtol=0.01)
+
+
+def test_aperture_photometry(stars):
+    positions, fluxes = stars
+    data = make_frame(positions, fluxes)
+
+    table = aperture_photometry(data, positions, radius=10, annulus=(14, 20))
+
+    assert len(table) == len(positions)
+    assert np.all(table['flags'] == 0)
+
+    for channel, name in enumerate(['R', 'G1', 'G2', 'B']):
+        assert np.allclose(table['flux_{}'.format(name)], fluxes[:, channel], rtol=0.01)
+        assert np.allclose(table['bkg_{}'.format(name)], [100, 150, 150, 80][channel], rtol=0.01)
+
+    assert np.allclose(table['flux'], fluxes.sum(axis=1), rtol=0.01)
+
+
+def test_aperture_photometry_errors(stars):
+    positions, fluxes = stars
+
+    # The scatter of the fluxes over many noise realizations matches the errors
+    measured = list()
+    for seed in range(20):
+        data = make_frame(positions, fluxes, noise=10, seed=seed)
+        table = aperture_photometry(data, positions, radius=8, annulus=(12, 20), gain=1e9)
+        measured.append(table['flux_R'])
+
+    scatter = np.std(measured, axis=0)
+    ratio = np.median(scatter / table['flux_err_R'])
+
+    # No star noise in the frames, hence the huge gain
+    assert 0.8 < ratio < 1.2
+
+
+def test_aperture_photometry_flags(stars):
+    positions, fluxes = stars
+    data = make_frame(positions, fluxes)
+
+    table = aperture_photometry(data, [[2, 200], [300, 200], [np.nan, 5]], radius=6, annulus=(10, 15))
+
+    assert table['flags'][0] & FLAG_EDGE
+    assert table['flags'][1] == 0
+    assert table['flags'][2] & FLAG_EDGE
+    assert np.isnan(table['flux'][2])
+
+    # Off the frame entirely
+    table = aperture_photometry(data, [[-100, -100]])
+    assert table['flags'][0] == FLAG_EDGE | FLAG_BACKGROUND
+
+
+def test_aperture_photometry_chunks(stars):
+    positions, fluxes = stars
+    data = make_frame(positions, fluxes, noise=5)
+
+    table = aperture_photometry(data, positions)
+    chunked = aperture_photometry(data, positions, chunk_size=7)
+
+    assert np.allclose(table['flux'], chunked['flux'])
+    assert np.allclose(table['flux_err'], chunked['flux_err'])
+
+
+def test_get_positions_no_wcs():
+    with pytest.raises(PanError):
+        get_positions(None, SkyCoord(10, 20, unit='deg'))
+
+
+def test_image_photometry(data_dir):
+    image = Image(os.path.join(data_dir, 'solved.fits'))
+
+    positions = np.array([[100.2, 150.7], [350.9, 349.3], [600.4, 220.6]])
+    coords = image.wcs.all_pix2world(positions, 0)
+    coords = SkyCoord(coords[:, 0], coords[:, 1], unit='deg')
+
+    by_position = image.photometry(positions=positions)
+    by_coords = image.photometry(coords=coords)
+
+    assert np.allclose(by_coords['x'], positions[:, 0], atol=1e-3)
+    assert np.allclose(by_coords['y'], positions[:, 1], atol=1e-3)
+    assert np.allclose(by_coords['flux'], by_position['flux'], rtol=1e-3)
+
+    with pytest.raises(AssertionError):
+        image.photometry()
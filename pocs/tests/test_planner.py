@@ -0,0 +1,199 @@
+import numpy as np
+import pytest
+import yaml
+
+from astropy import units as u
+from astropy.coordinates import EarthLocation
+from astropy.time import Time
+
+from astroplan import Observer
+
+from pocs.scheduler.constraint import Duration
+from pocs.scheduler.constraint import MoonAvoidance
+from pocs.scheduler.planner import NightPlan
+from pocs.scheduler.planner import Scheduler
+from pocs.utils.config import load_config
+
+config = load_config()
+
+loc = config['location']
+location = EarthLocation(lon=loc['longitude'], lat=loc['latitude'], height=loc['elevation'])
+observer = Observer(location=location, name="Test Observer", timezone=loc['timezone'])
+
+start = Time('2016-08-13 06:00:00')
+
+# Late in the night, so there are few steps left to plan
+late = Time('2016-08-13 12:00:00')
+
+
+def same_time(time, other, tol=1e-3):
+    return abs((time - other).sec) < tol
+
+
+@pytest.fixture
+def night_plan():
+    # Two fields at the same position over 20 one minute steps, A is worth more
+    # but is vetoed from step 10. Each new field takes a step to settle.
+    merits = np.vstack([np.full(20, 2.), np.full(20, 1.)])
+    vetoes = np.zeros((2, 20), dtype=bool)
+    vetoes[0, 10:] = True
+
+    return NightPlan(['A', 'B'], start, 60, merits, vetoes,
+                     min_steps=[4, 4], set_steps=[2, 2], num_sets=[2, 2],
+                     ra=[0, 0], dec=[0, 0], settle_time=60)
+
+
+@pytest.fixture()
+def field_list():
+    return yaml.load("""
+    -
+        name: HD 189733
+        position: 20h00m43.7135s +22d42m39.0645s
+        priority: 100
+    -
+        name: HD 209458
+        position: 22h03m10.7721s +18d53m03.543s
+        priority: 100
+    -
+        name: Wasp 33
+        position: 02h26m51.0582s +37d33m01.733s
+        priority: 100
+    -
+        name: KIC 8462852
+        position: 20h06m15.4536s +44d27m24.75s
+        priority: 50
+        exp_time: 60
+        exp_set_size: 15
+        min_nexp: 45
+    -
+        name: M44
+        position: 08h40m24s +19d40m00.12s
+        priority: 50
+    """)
+
+
+@pytest.fixture
+def scheduler(field_list):
+    return Scheduler(observer, fields_list=field_list, constraints=[MoonAvoidance(), Duration(30 * u.deg)])
+
+
+def test_night_plan(night_plan):
+    plan = night_plan.get_plan(start)
+
+    assert [entry.name for entry in plan] == ['A', 'B']
+
+    # A until it is vetoed, then B for as many sets as fit
+    assert same_time(plan[0].start, start)
+    assert same_time(plan[0].end, start + 9 * u.minute)
+    assert plan[0].num_sets == 4
+    assert plan[0].merit == pytest.approx(2)
+
+    assert same_time(plan[1].start, start + 9 * u.minute)
+    assert same_time(plan[1].end, start + 18 * u.minute)
+    assert plan[1].num_sets == 4
+
+
+def test_night_plan_from_position(night_plan):
+    # On B already, keep adding sets without a slew
+    plan = night_plan.get_plan(start + 14 * u.minute, name='B')
+    assert len(plan) == 1
+    assert same_time(plan[0].start, start + 14 * u.minute)
+    assert plan[0].num_sets == 2
+
+    # After an interruption, from an unknown position
+    plan = night_plan.get_plan(start + 11.5 * u.minute)
+    assert plan[0].name == 'B'
+    assert same_time(plan[0].start, start + 12 * u.minute)
+    assert plan[0].num_sets == 3
+
+    assert night_plan.get_value(start) > night_plan.get_value(start + 11.5 * u.minute)
+
+
+def test_night_plan_start_vetoes(night_plan):
+    # B can't be started from step 12, but it can still be added to
+    start_vetoes = np.zeros((2, 20), dtype=bool)
+    start_vetoes[1, 12:] = True
+
+    vetoed = NightPlan(night_plan.names, start, 60, night_plan.merits, night_plan.vetoes,
+                       min_steps=[4, 4], set_steps=[2, 2], num_sets=[2, 2],
+                       ra=[0, 0], dec=[0, 0], start_vetoes=start_vetoes, settle_time=60)
+
+    assert [entry.name for entry in vetoed.get_plan(start)] == ['A', 'B']
+    assert vetoed.get_plan(start + 11.5 * u.minute) == []
+
+    plan = vetoed.get_plan(start + 14 * u.minute, name='B')
+    assert len(plan) == 1
+    assert plan[0].num_sets == 2
+
+
+def test_night_plan_candidates(night_plan):
+    # Only the best field is considered for a new sequence
+    one = NightPlan(night_plan.names, start, 60, night_plan.merits, night_plan.vetoes,
+                    min_steps=[4, 4], set_steps=[2, 2], num_sets=[2, 2],
+                    ra=[0, 0], dec=[0, 0], settle_time=60, max_candidates=1)
+
+    assert [entry.name for entry in one.get_plan(start)] == ['A', 'B']
+    assert one.get_value(start) == pytest.approx(night_plan.get_value(start))
+
+
+def test_night_plan_slew(night_plan):
+    # B is far away, the slew takes longer than A is up
+    far = NightPlan(night_plan.names, start, 60, night_plan.merits, night_plan.vetoes,
+                    min_steps=[4, 4], set_steps=[2, 2], num_sets=[2, 2],
+                    ra=[0, 180], dec=[0, 0], settle_time=60, slew_rate=0.5)
+
+    plan = far.get_plan(start, name='A')
+    assert plan[0].name == 'A'
+    assert far.get_value(start) < night_plan.get_value(start)
+
+
+def test_plan(scheduler):
+    time = late
+    plan = scheduler.get_plan(time=time)
+
+    assert len(plan) > 0
+
+    for entry, next_entry in zip(plan[:-1], plan[1:]):
+        assert entry.end <= next_entry.start
+
+    for entry in plan:
+        observation = scheduler.observations[entry.name]
+
+        assert entry.num_sets >= observation.min_nexp // observation.exp_set_size
+        assert entry.end - entry.start >= observation.minimum_duration
+        assert scheduler.observation_available(observation, entry.end)
+
+
+def test_plan_whole_night(scheduler):
+    # `Duration` only stops fields from being started too late, so the plan
+    # goes on close to the end of the night
+    time = Time('2016-08-13 06:00:00')
+    end_of_night = observer.tonight(time=time, horizon=-18 * u.degree)[-1]
+
+    plan = scheduler.get_plan(time=time)
+
+    assert (end_of_night - plan[-1].end).sec < 1800
+
+
+def test_get_observation(scheduler):
+    time = late
+    plan = scheduler.get_plan(time=time)
+
+    best = scheduler.get_observation(time=time)
+
+    assert best[0] == plan[0].name
+    assert scheduler.current_observation.name == plan[0].name
+
+
+def test_replan(scheduler):
+    time = late
+
+    scheduler.get_observation(time=time)
+    night_plan = scheduler.get_night_plan(time=time)
+
+    # Closed for two hours, start again from the parked position
+    scheduler.current_observation = None
+    plan = scheduler.get_plan(time=time + 2 * u.hour)
+
+    assert scheduler.get_night_plan(time=time + 2 * u.hour) is night_plan
+    assert plan[0].start >= time + 2 * u.hour
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from pocs.utils import pretty
+from pocs.utils.images import get_pretty_fname
+
+
+def test_get_rgb():
+    data = np.zeros((4, 6), dtype=np.uint16)
+    data[0::2, 0::2] = 1
+    data[0::2, 1::2] = 2
+    data[1::2, 0::2] = 4
+    data[1::2, 1::2] = 5
+
+    rgb = pretty.get_rgb(data)
+
+    assert rgb.shape == (2, 3, 3)
+    assert np.all(rgb[..., 0] == 1)
+    assert np.all(rgb[..., 1] == 3)
+    assert np.all(rgb[..., 2] == 5)
+
+
+def test_downsample():
+    image = np.arange(100 * 40 * 3, dtype=np.float32).reshape(40, 100, 3)
+
+    binned = pretty.downsample(image, 30)
+    assert binned.shape == (10, 25, 3)
+    assert binned[0, 0, 0] == image[:4, :4, 0].mean()
+
+    assert pretty.downsample(image, 100).shape == image.shape
+
+
+def test_stretch():
+    image = np.linspace(0, 100, 1000).reshape(10, 100)
+
+    stretched = pretty.stretch(image, *pretty.get_stretch_limits(image, sample=1))
+
+    assert stretched.dtype == np.uint8
+    assert stretched.min() == 0
+    assert stretched.max() == 255
+
+
+def test_make_pretty_images(tmpdir):
+    data = np.random.poisson(100, size=(200, 300)).astype(np.uint16)
+    fname = str(tmpdir.join('image.png'))
+    link = str(tmpdir.join('latest.png'))
+
+    outputs = pretty.make_pretty_images(data, fname, sizes=(150, 50), title='Test', link=link)
+
+    assert list(outputs.values()) == [fname, str(tmpdir.join('image_50.png'))]
+    for out_fname in outputs.values():
+        assert os.path.exists(out_fname)
+
+    assert os.readlink(link) == fname
+
+    # Updating the link replaces it
+    other = str(tmpdir.join('other.png'))
+    pretty.make_pretty_images(data, other, sizes=(50,), link=link)
+    assert os.readlink(link) == other
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
+
+
+def test_pretty_fname():
+    assert get_pretty_fname('/images/foo.cr2') == '/images/foo.jpg'
+    assert get_pretty_fname('/images/foo.fits.fz') == '/images/foo.jpg'
+    assert get_pretty_fname('/images/foo.fits') == '/images/foo.jpg'
@@ -0,0 +1,92 @@
+import os
+import pytest
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.table import Table
+
+from conftest import make_star_field
+from pocs.utils.quality import check_quality
+from pocs.utils.quality import get_image_quality
+from pocs.utils.quality import get_source_shapes
+from pocs.utils.quality import measure_directory
+from pocs.utils.quality import measure_image
+
+
+def make_field(shape=(400, 600), num_stars=100, sigma=(1.5, 1.5), theta=0., background=100.,
+               noise=5., seed=0):
+    """ Star field of elliptical Gaussians with axes `sigma` at angle `theta` (radians) """
+    rng = np.random.RandomState(seed)
+
+    x = rng.uniform(20, shape[1] - 20, num_stars)
+    y = rng.uniform(20, shape[0] - 20, num_stars)
+    fluxes = rng.uniform(2000, 20000, num_stars)
+
+    data = make_star_field(np.column_stack([x, y]), shape=shape, flux=fluxes, axes=sigma, theta=theta,
+                           background=background, noise=noise, seed=seed + 1)
+
+    return data, Table([x, y], names=['x', 'y'])
+
+
+def test_source_shapes():
+    data, stars = make_field(num_stars=30, sigma=(2.5, 1.), theta=0.5, noise=0.)
+
+    shapes = get_source_shapes(data, stars, background=100.)
+
+    # A few of the stars overlap
+    assert np.nanmedian(shapes['fwhm']) == pytest.approx(2.3548 * np.sqrt(2.5), rel=1e-3)
+    assert np.nanmedian(shapes['ellipticity']) == pytest.approx(0.6, abs=1e-3)
+    assert np.nanmedian(shapes['theta']) == pytest.approx(np.degrees(0.5), abs=0.1)
+
+
+def test_image_quality():
+    data, stars = make_field(sigma=(1.2, 1.2))
+
+    quality = get_image_quality(data)
+
+    assert abs(quality['background'] - 100) < 1
+    assert abs(quality['noise'] - 5) < 0.5
+    assert 90 <= quality['num_stars'] <= 100
+    assert abs(quality['fwhm'] - 2.3548 * 1.2) < 0.05
+    assert quality['ellipticity'] < 0.05
+
+
+def test_check_quality():
+    data, stars = make_field(sigma=(1.2, 1.2))
+    assert check_quality(get_image_quality(data)) == []
+    assert len(check_quality(get_image_quality(data), max_fwhm=2.5)) == 1
+
+    # Clouds
+    data, stars = make_field(num_stars=5)
+    problems = check_quality(get_image_quality(data))
+    assert problems == ['only 5 stars']
+
+    # Trailing
+    data, stars = make_field(sigma=(3., 1.))
+    problems = check_quality(get_image_quality(data))
+    assert len(problems) == 1 and problems[0].startswith('ellipticity')
+
+    # Nothing at all
+    data = np.random.RandomState(0).normal(100, 5, size=(400, 600))
+    assert check_quality(get_image_quality(data))
+
+
+def test_measure_directory(tmpdir):
+    # Bayer frames are measured on the luminance, FWHM in full frame pixels
+    for num, sigma in enumerate([1., 1.5]):
+        data, stars = make_field(shape=(800, 1200), sigma=(2 * sigma, 2 * sigma), seed=num)
+        fits.PrimaryHDU(data.astype(np.uint16)).writeto(str(tmpdir.join('frame{}.fits'.format(num))))
+
+    tmpdir.join('broken.fits').write('not a FITS file')
+
+    quality = measure_image(str(tmpdir.join('frame0.fits')))
+    assert abs(quality['fwhm'] - 2 * 2.3548) < 0.2
+    assert quality['elapsed'] < 1
+
+    results = measure_directory(str(tmpdir), workers=2)
+
+    assert [os.path.basename(r['file']) for r in results] == ['broken.fits', 'frame0.fits', 'frame1.fits']
+    assert 'error' in results[0]
+    assert abs(results[1]['fwhm'] - quality['fwhm']) < 1e-6
+    assert abs(results[2]['fwhm'] - 3 * 2.3548) < 0.3
@@ -0,0 +1,109 @@
+import os
+import pickle
+import pytest
+import shutil
+
+from astropy.io import fits
+
+from pocs.utils import error
+from pocs.utils.solve_server import FakeSolverBackend
+from pocs.utils.solve_server import SolveFieldBackend
+from pocs.utils.solve_server import SolverClient
+from pocs.utils.solve_server import SolverServer
+from pocs.utils.solver import SolverPool
+
+
+@pytest.fixture
+def address(tmpdir):
+    return 'ipc://{}'.format(tmpdir.join('solver.sock'))
+
+
+@pytest.fixture
+def backend(data_dir):
+    wcs = fits.getheader(os.path.join(data_dir, 'solved.fits'))
+    return FakeSolverBackend(wcs={key: wcs[key] for key in ['CRVAL1', 'CRVAL2', 'CD1_1', 'CD2_2']})
+
+
+@pytest.fixture
+def server(request, address, backend):
+    solver_server = SolverServer(address=address, backend=backend, max_workers=2)
+    solver_server.start()
+    request.addfinalizer(solver_server.stop)
+
+    return solver_server
+
+
+@pytest.fixture
+def client(request, server):
+    solver_client = SolverClient(address=server.address, timeout=5)
+    request.addfinalizer(solver_client.close)
+
+    return solver_client
+
+
+@pytest.fixture
+def unsolved_copy(data_dir, tmpdir):
+    fname = str(tmpdir.join('unsolved.fits'))
+    shutil.copyfile(os.path.join(data_dir, 'unsolved.fits'), fname)
+    return fname
+
+
+def test_ping(client):
+    assert client.ping()
+
+
+def test_no_server(address):
+    assert SolverClient(address=address).ping(timeout=0.2) is False
+
+
+def test_solve(client, backend, unsolved_copy):
+    result = client.get_solve_field(unsolved_copy, ra=10., dec=20., radius=5)
+
+    assert result['solved_fits_file'] == unsolved_copy
+    assert 'CRVAL1' in result
+    assert os.path.exists(unsolved_copy.replace('.fits', '.solved'))
+    assert 'CD1_1' in fits.getheader(unsolved_copy)
+
+    fname, kwargs = backend.calls[0]
+    assert kwargs == {'ra': 10., 'dec': 20., 'radius': 5}
+
+
+def test_solve_error(client, backend, unsolved_copy):
+    backend.fail.add(unsolved_copy)
+
+    with pytest.raises(error.SolveError):
+        client.get_solve_field(unsolved_copy)
+
+    # The connection can still be used
+    assert client.ping()
+
+
+def test_pickle_client(client):
+    copy = pickle.loads(pickle.dumps(client))
+
+    assert copy.address == client.address
+    assert copy.ping()
+
+
+def test_pool_with_client(client, unsolved_copy):
+    pool = SolverPool(max_workers=1, solve_func=client.get_solve_field)
+    try:
+        result = pool.solve(unsolved_copy, wait=30)
+    finally:
+        pool.shutdown()
+
+    assert result['solved_fits_file'] == unsolved_copy
+
+
+def test_index_files_mapped(tmpdir):
+    index_file = tmpdir.join('index-4210.fits')
+    index_file.write_binary(b'\x00' * 10000)
+
+    backend = SolveFieldBackend(index_dir=str(tmpdir))
+    backend.start()
+    try:
+        assert backend.index_files == [str(index_file)]
+    finally:
+        backend.stop()
+
+    assert backend.index_files == []
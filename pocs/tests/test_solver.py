@@ -0,0 +1,155 @@
+import os
+import pytest
+import shutil
+import time
+
+from astropy.io import fits
+from concurrent.futures import TimeoutError
+
+from pocs.utils import images
+from pocs.utils.solve_cache import SolveCache
+from pocs.utils.solve_cache import get_solve_key
+from pocs.utils.solver import SolverPool
+
+
+def fake_solve(fname, **kwargs):
+    time.sleep(kwargs.get('delay', 0))
+    return {'solved_fits_file': fname, 'kwargs': kwargs}
+
+
+@pytest.fixture
+def pool(request):
+    solver_pool = SolverPool(max_workers=1, solve_func=fake_solve)
+    request.addfinalizer(solver_pool.shutdown)
+
+    return solver_pool
+
+
+def test_default_workers():
+    assert SolverPool().max_workers >= 1
+
+
+def test_submit(pool):
+    future = pool.submit('foo.fits', ra=10, dec=20, radius=5)
+    result = future.result(timeout=30)
+
+    assert result['solved_fits_file'] == 'foo.fits'
+    assert result['kwargs']['ra'] == 10
+    assert result['kwargs']['dec'] == 20
+    assert result['kwargs']['radius'] == 5
+
+
+def test_solve(pool):
+    result = pool.solve('foo.fits', wait=30)
+    assert result['solved_fits_file'] == 'foo.fits'
+
+
+def test_solve_wait(pool):
+    with pytest.raises(TimeoutError):
+        pool.solve('foo.fits', wait=0.1, delay=2)
+
+
+def test_duplicate_submit(pool):
+    future0 = pool.submit('foo.fits', delay=1)
+    future1 = pool.submit('foo.fits', delay=1)
+
+    assert future0 is future1
+    assert len(pool.jobs) == 1
+
+
+def test_cancel(pool):
+    running = pool.submit('foo.fits', delay=1)
+    queued = [pool.submit('{}.fits'.format(i)) for i in range(5)]
+
+    # Jobs still in the queue can be cancelled
+    assert queued[-1].cancel()
+    assert queued[-1].cancelled()
+
+    assert running.result(timeout=30)['solved_fits_file'] == 'foo.fits'
+
+
+def test_cancel_all(pool):
+    pool.submit('foo.fits', delay=1)
+    for i in range(5):
+        pool.submit('{}.fits'.format(i))
+
+    assert pool.cancel_all() > 0
+
+
+@pytest.fixture
+def solve_cache(tmpdir):
+    return SolveCache(db_file=str(tmpdir.join('solve_cache.sqlite')), max_entries=3)
+
+
+@pytest.fixture
+def unsolved_copy(data_dir, tmpdir):
+    fname = str(tmpdir.join('unsolved.fits'))
+    shutil.copyfile(os.path.join(data_dir, 'unsolved.fits'), fname)
+    return fname
+
+
+def test_solve_key(unsolved_copy, tmpdir):
+    key = get_solve_key(unsolved_copy, ra=10., dec=20., radius=15)
+
+    # Name and header changes don't change the key
+    renamed = str(tmpdir.join('renamed.fits'))
+    shutil.copyfile(unsolved_copy, renamed)
+    fits.setval(renamed, 'OBJECT', value='Somewhere else')
+    assert get_solve_key(renamed, ra=10, dec=20, radius=15.) == key
+
+    # Different hints do
+    assert get_solve_key(unsolved_copy, ra=11., dec=20., radius=15) != key
+
+    # Different pixels do
+    with fits.open(renamed, 'update') as hdu:
+        hdu[0].data[0, 0] += 1
+    assert get_solve_key(renamed, ra=10., dec=20., radius=15) != key
+
+
+def test_solve_cache_put_get(solve_cache, data_dir):
+    header = fits.getheader(os.path.join(data_dir, 'solved.fits'))
+
+    assert solve_cache.get('foo') is None
+
+    solve_cache.put('foo', header, info={'fname': 'solved.fits'})
+    wcs_header, info = solve_cache.get('foo')
+
+    assert 'foo' in solve_cache
+    assert info['fname'] == 'solved.fits'
+    assert wcs_header['CRVAL1'] == header['CRVAL1']
+    assert wcs_header['CD1_1'] == header['CD1_1']
+    assert 'EXPTIME' not in wcs_header
+
+
+def test_solve_cache_eviction(solve_cache, data_dir):
+    header = fits.getheader(os.path.join(data_dir, 'solved.fits'))
+
+    for key in ['a', 'b', 'c']:
+        solve_cache.put(key, header)
+        time.sleep(0.01)
+
+    # Use 'a' so 'b' is the least recently used
+    solve_cache.get('a')
+    solve_cache.put('d', header)
+
+    assert len(solve_cache) == 3
+    assert 'b' not in solve_cache
+    assert 'a' in solve_cache
+
+
+def test_get_solve_field_cached(solve_cache, unsolved_copy, data_dir, monkeypatch):
+    def no_solve(*args, **kwargs):
+        raise AssertionError("solve_field called on a cached image")
+
+    monkeypatch.setattr(images, 'solve_field', no_solve)
+
+    header = fits.getheader(os.path.join(data_dir, 'solved.fits'))
+    solve_cache.put(get_solve_key(unsolved_copy, ra=10., dec=20., radius=15), header)
+
+    solve_info = images.get_solve_field(unsolved_copy, ra=10., dec=20.,
+                                        cache_file=solve_cache.db_file)
+
+    assert solve_info['solved_fits_file'] == unsolved_copy
+    assert solve_info['CRVAL1'] == header['CRVAL1']
+    assert fits.getval(unsolved_copy, 'CRVAL1') == header['CRVAL1']
+    assert os.path.exists(unsolved_copy.replace('.fits', '.solved'))
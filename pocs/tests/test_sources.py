@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from astropy import units as u
+
+from conftest import make_star_field
+from pocs.utils.error import PanError
+from pocs.utils.sources import compute_centroid_offset
+from pocs.utils.sources import detect_sources
+from pocs.utils.sources import fit_shift_rotation
+from pocs.utils.sources import match_sources
+from pocs.utils.sources import to_reference
+
+
+def transform(positions, dx=0., dy=0., angle=0., center=(299.5, 199.5)):
+    theta = np.radians(angle)
+    matrix = np.array([[np.cos(theta), -np.sin(theta)],
+                       [np.sin(theta), np.cos(theta)]])
+
+    return (np.asarray(positions) - center).dot(matrix.T) + center + [dx, dy]
+
+
+def test_detect_sources(star_positions):
+    data = make_star_field(star_positions)
+    sources = detect_sources(data, num_sources=100)
+
+    assert len(sources) == len(star_positions)
+
+    # Every source is within a fraction of a pixel of a star
+    xy = np.column_stack([sources['x'], sources['y']])
+    distance = np.hypot(*(xy[:, None, :] - star_positions[None, :, :]).transpose(2, 0, 1))
+    assert distance.min(axis=1).max() < 0.2
+
+
+def test_detect_sources_brightest(star_positions):
+    data = make_star_field(star_positions, flux=np.linspace(1000, 5000, len(star_positions)))
+    sources = detect_sources(data, num_sources=5)
+
+    assert len(sources) == 5
+    assert np.all(np.diff(sources['peak']) <= 0)
+    assert np.hypot(sources['x'][0] - star_positions[-1][0], sources['y'][0] - star_positions[-1][1]) < 0.2
+
+
+def test_match_sources(star_positions):
+    ref_sources = detect_sources(make_star_field(star_positions), num_sources=100)
+    sources = detect_sources(make_star_field(transform(star_positions, dx=12.3, dy=-7.6), seed=1),
+                             num_sources=100)
+
+    idx, ref_idx = match_sources(sources, ref_sources)
+
+    assert len(idx) >= 35
+    assert np.allclose(sources['x'][idx] - ref_sources['x'][ref_idx], 12.3, atol=0.3)
+    assert np.allclose(sources['y'][idx] - ref_sources['y'][ref_idx], -7.6, atol=0.3)
+
+
+def test_fit_shift_rotation(star_positions):
+    moved = transform(star_positions, dx=3, dy=-2, angle=0.5)
+
+    fit = fit_shift_rotation(moved, star_positions, center=(299.5, 199.5))
+
+    assert fit['X'].to(u.pixel).value == pytest.approx(3)
+    assert fit['Y'].to(u.pixel).value == pytest.approx(-2)
+    assert fit['angle'].to(u.degree).value == pytest.approx(0.5)
+    assert fit['rms'].value < 1e-8
+
+    assert np.allclose(to_reference(moved, fit), star_positions)
+
+
+def test_fit_shift_rotation_too_few():
+    with pytest.raises(PanError):
+        fit_shift_rotation([[1, 1]], [[2, 2]])
+
+
+def test_centroid_offset(star_positions):
+    ref_sources = detect_sources(make_star_field(star_positions), num_sources=50)
+    data = make_star_field(transform(star_positions, dx=5.2, dy=3.1, angle=0.3), seed=1)
+
+    offset = compute_centroid_offset(data, ref_sources)
+
+    assert offset['matches'] >= 30
+    assert offset['X'].to(u.pixel).value == pytest.approx(5.2, abs=0.1)
+    assert offset['Y'].to(u.pixel).value == pytest.approx(3.1, abs=0.1)
+    assert offset['angle'].to(u.degree).value == pytest.approx(0.3, abs=0.02)
+
+
+def test_centroid_offset_no_stars(star_positions):
+    ref_sources = detect_sources(make_star_field(star_positions), num_sources=50)
+    data = np.random.RandomState(0).normal(100, 5, size=(400, 600))
+
+    with pytest.raises(PanError):
+        compute_centroid_offset(data, ref_sources)
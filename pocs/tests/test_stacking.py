@@ -0,0 +1,133 @@
+import os
+import pytest
+
+import numpy as np
+
+from astropy import units as u
+from astropy.io import fits
+
+from conftest import make_star_field
+from pocs.utils.error import PanError
+from pocs.utils.images import write_fits
+from pocs.utils.stacking import SequenceStack
+
+
+def make_frame(positions, **kwargs):
+    """ Full size Bayer frame of bright stars, positions in full size pixels """
+    kwargs.setdefault('flux', 20000)
+    kwargs.setdefault('fwhm', 5.)
+
+    return make_star_field(positions, background=1000, **kwargs)
+
+
+def write_frame(directory, name, data, compress=False):
+    hdu = fits.PrimaryHDU(data.astype(np.float32))
+    hdu.header.set('EXPTIME', 120.)
+    hdu.header.set('INSTRUME', 'XXXXXX')
+
+    fname = os.path.join(str(directory), name + ('.fits.fz' if compress else '.fits'))
+    write_fits(hdu, fname, compress=compress, clobber=True)
+
+    return fname
+
+
+def test_stack_aligned(tmpdir, star_positions):
+    stack = SequenceStack(buffer_dir=str(tmpdir.join('buffers')))
+
+    frames = [make_frame(star_positions, seed=i) for i in range(4)]
+    for i, frame in enumerate(frames):
+        stack.add(write_frame(tmpdir, 'frame{}'.format(i), frame, compress=i % 2 == 1))
+
+    assert len(stack) == 4
+
+    mean, variance, count = stack.get_data()
+
+    assert np.all(count[4:-4, 4:-4] == 4)
+    assert np.allclose(mean[4:-4, 4:-4], np.mean(frames, axis=0)[4:-4, 4:-4], atol=2)
+    assert np.nanmean(variance) == pytest.approx(25, rel=0.1)
+
+    stack.close()
+
+
+def test_stack_registered(tmpdir, star_positions):
+    stack = SequenceStack()
+
+    reference = make_frame(star_positions)
+    stack.add(write_frame(tmpdir, 'reference', reference))
+
+    # Shift by a whole number of Bayer cells so the result can be compared directly
+    offset = stack.add(write_frame(tmpdir, 'shifted', make_frame(star_positions + [8, -6], seed=1)))
+
+    assert offset['X'].to(u.pixel).value == pytest.approx(4, abs=0.1)
+    assert offset['Y'].to(u.pixel).value == pytest.approx(-3, abs=0.1)
+
+    mean, variance, count = stack.get_data()
+
+    # Frame only covers part of the reference
+    assert np.all(count[:, -8:] == 1)
+    assert np.all(count[:6] == 1)
+    assert np.all(count[10:-10, 10:-10] == 2)
+
+    # Stars line up with the reference
+    inner = (slice(20, -20), slice(20, -20))
+    assert np.abs(mean[inner] - reference[inner]).max() < 0.05 * reference.max()
+
+    stack.close()
+    assert not os.path.exists(stack.buffer_dir)
+
+
+def test_stack_sigma_clip(tmpdir, star_positions):
+    stack = SequenceStack(sigma=5, min_frames=3)
+
+    frames = [make_frame(star_positions, seed=i) for i in range(6)]
+    for i, frame in enumerate(frames):
+        if i == 4:
+            # Satellite trail
+            frame = frame.copy()
+            frame[200:202, :] += 5000
+        stack.add(write_frame(tmpdir, 'frame{}'.format(i), frame))
+
+    mean, variance, count = stack.get_data()
+
+    assert np.all(count[200:202, 10:-10] == 5)
+    assert np.all(count[100:150, 10:-10] == 6)
+
+    expected = np.mean(frames[:4] + frames[5:], axis=0)
+    assert np.abs(mean[200:202, 10:-10] - expected[200:202, 10:-10]).max() < 10
+    assert stack.rejected >= 2 * 580
+
+    stack.close()
+
+
+def test_stack_bad_frame(tmpdir, star_positions):
+    stack = SequenceStack()
+    stack.add(write_frame(tmpdir, 'reference', make_frame(star_positions)))
+
+    with pytest.raises(PanError):
+        stack.add(write_frame(tmpdir, 'small', make_frame(star_positions, shape=(200, 300))))
+
+    with pytest.raises(PanError):
+        stack.add(write_frame(tmpdir, 'blank', make_frame([], seed=1)))
+
+    assert len(stack) == 1
+    assert np.all(stack.get_data()[2] == 1)
+
+    stack.close()
+
+
+def test_stack_write(tmpdir, star_positions):
+    stack = SequenceStack(sigma=3)
+    for i in range(2):
+        stack.add(write_frame(tmpdir, 'frame{}'.format(i), make_frame(star_positions, seed=i)))
+
+    coadd = stack.write(str(tmpdir.join('coadd.fits')))
+
+    with fits.open(coadd) as hdu_list:
+        assert hdu_list[0].header['NCOMBINE'] == 2
+        assert hdu_list[0].header['IMAGETYP'] == 'coadd'
+        assert hdu_list[0].header['EXPTIME'] == 120.
+        assert hdu_list[0].header['BITPIX'] == -32
+        assert hdu_list['VARIANCE'].data.shape == (400, 600)
+        assert np.all(hdu_list['NCOMBINE'].data[4:-4, 4:-4] == 2)
+
+    stack.close()
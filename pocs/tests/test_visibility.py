@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import EarthLocation
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import get_moon
+from astropy.time import Time
+
+from astroplan import Observer
+
+from pocs.scheduler.constraint import Altitude
+from pocs.scheduler.constraint import MoonAvoidance
+from pocs.scheduler.dispatch import Scheduler
+from pocs.scheduler.visibility import VisibilityGrid
+from pocs.utils.config import load_config
+
+config = load_config()
+
+loc = config['location']
+location = EarthLocation(lon=loc['longitude'], lat=loc['latitude'], height=loc['elevation'])
+observer = Observer(location=location, name="Test Observer", timezone=loc['timezone'])
+
+field_list = [
+    {'name': 'HD 189733', 'position': '20h00m43.7135s +22d42m39.0645s'},
+    {'name': 'Wasp 33', 'position': '02h26m51.0582s +37d33m01.733s'},
+    {'name': 'M44', 'position': '08h40m24s +19d40m00.12s'},
+    {'name': 'Polaris', 'position': '02h31m49.09s +89d15m50.8s'},
+]
+
+names = [field['name'] for field in field_list]
+coords = SkyCoord([field['position'] for field in field_list])
+
+start = Time('2016-08-13 06:00:00')
+end = observer.tonight(time=start, horizon=-18 * u.degree)[-1]
+
+
+@pytest.fixture
+def grid():
+    return VisibilityGrid.compute(observer, names, coords, start, end)
+
+
+def test_grid_shape(grid):
+    assert len(grid) == len(names)
+    assert grid.altitude.shape == (len(names), len(grid.times))
+    assert abs((grid.start - start).sec) < 1e-3
+    assert grid.end >= end
+
+
+def test_altitudes_match(grid):
+    # Halfway between two steps
+    time = start + 61 * u.minute
+
+    altaz = observer.altaz(time, target=coords)
+
+    assert np.allclose(grid.get_altitudes(time), altaz.alt.to(u.degree).value, atol=0.05)
+    assert np.allclose(grid.get_altitudes(time, rows=grid.get_rows(['M44'])), altaz.alt[2].value, atol=0.05)
+
+
+def test_airmass(grid):
+    time = start + 1 * u.hour
+    airmass = grid.get_airmass(time)
+
+    assert np.allclose(airmass[0], 1 / np.sin(np.radians(grid.get_altitudes(time)[0])))
+
+    # M44 is below the horizon
+    assert np.isnan(airmass[2])
+
+
+def test_moon_separations(grid):
+    time = start + 2 * u.hour
+    moon = get_moon(time, observer.location)
+
+    assert np.allclose(grid.get_moon_separations(time), coords.separation(moon).to(u.degree).value, atol=0.05)
+
+
+def test_outside_grid(grid):
+    assert not grid.covers(start - 1 * u.minute)
+    assert not grid.is_valid(names, start - 1 * u.minute)
+    assert not grid.is_valid(names[:2], start)
+
+    with pytest.raises(AssertionError):
+        grid.get_altitudes(end + 1 * u.hour)
+
+
+def test_scores_match(grid):
+    time = start + 1 * u.hour
+    observations = list(Scheduler(observer, fields_list=list(field_list)).observations.values())
+    moon = get_moon(time, observer.location)
+
+    for constraint in [Altitude(30 * u.degree), MoonAvoidance()]:
+        direct = constraint.get_scores(time, observer, observations, moon=moon)
+        from_grid = constraint.get_scores(time, observer, observations, moon=moon, visibility=grid)
+
+        assert np.all(direct[0] == from_grid[0])
+        assert np.allclose(direct[1], from_grid[1], atol=0.01)
+
+
+def test_scheduler_visibility():
+    scheduler = Scheduler(observer, fields_list=list(field_list), constraints=[Altitude(30 * u.degree)])
+
+    grid = scheduler.get_visibility(time=start)
+    assert scheduler.get_visibility(time=start + 1 * u.hour) is grid
+
+    observation = scheduler.observations['HD 189733']
+    assert scheduler.observation_available(observation, start)
+    assert not scheduler.observation_available(scheduler.observations['M44'], start)
+
+    # New fields need a new grid
+    scheduler.remove_observation('M44')
+    assert len(scheduler.get_visibility(time=start)) == 3
@@ -0,0 +1,527 @@
+import os
+import re
+import tempfile
+import threading
+
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from warnings import warn
+
+import numpy as np
+
+from astropy.io import fits
+
+from pocs.utils import error
+
+CALIBRATION_TYPES = ['bias', 'dark', 'flat']
+
+COMBINE_METHODS = ['median', 'mean', 'sigma_clip']
+
+
+def get_calibration_key(header):
+    """ Get the camera, ISO and exposure time a frame was taken with
+
+    Args:
+        header (astropy.io.fits.Header): Header of a frame from `cr2_to_fits`
+
+    Returns:
+        tuple: Camera uid (`INSTRUME`), ISO and exposure time in seconds
+    """
+    camera_uid = str(header.get('INSTRUME', '')).strip() or 'unknown'
+
+    try:
+        iso = int(header.get('ISO'))
+    except (TypeError, ValueError):
+        iso = None
+
+    try:
+        exptime = float(header.get('EXPTIME'))
+    except (TypeError, ValueError):
+        exptime = None
+
+    return camera_uid, iso, exptime
+
+
+def get_chunk_rows(num_frames, width, max_memory=256 * 2**20, copies=3):
+    """ Number of rows of each frame to combine at once
+
+    Args:
+        num_frames (int): Number of frames being combined
+        width (int): Width of the frames
+        max_memory (int, optional): Memory to use for the stack of rows in bytes,
+            default 256 MB
+        copies (int, optional): Number of float32 copies of the stack needed by
+            the combine method, default 3
+
+    Returns:
+        int: Number of rows, always even so chunks line up with the Bayer pattern
+    """
+    rows = max_memory // (num_frames * width * 4 * copies)
+
+    return max(2, int(rows) - int(rows) % 2)
+
+
+def combine_rows(stack, method='median', sigma=3., iters=5):
+    """ Combine a stack of rows from several frames
+
+    Args:
+        stack (numpy.ndarray): N x rows x width float32 array, changed in place
+            by `sigma_clip`
+        method (str, optional): One of `COMBINE_METHODS`, default 'median'
+        sigma (float, optional): Clipping limit for `sigma_clip` in units of the
+            standard deviation, default 3
+        iters (int, optional): Maximum number of clipping iterations, default 5
+
+    Returns:
+        numpy.ndarray: Combined rows
+    """
+    if method == 'median':
+        return np.median(stack, axis=0)
+    elif method == 'mean':
+        return stack.mean(axis=0)
+
+    # Clipped pixels are set to NaN so the remaining ones can be combined with the nan* functions.
+    # The first pass uses the median absolute deviation so a single bright outlier (e.g. a
+    # cosmic ray) can't hide itself in a small stack. Later passes only look at the pixels
+    # that had something clipped, which is usually a small fraction of them.
+    pixels = stack.reshape(len(stack), -1)
+
+    center = np.median(pixels, axis=0)
+    deviation = np.abs(pixels - center)
+    clip = deviation > sigma * 1.4826 * np.median(deviation, axis=0)
+
+    active = np.nonzero(clip.any(axis=0))[0]
+    for _ in range(iters - 1):
+        if len(active) == 0:
+            break
+
+        values = pixels[:, active]
+        values[clip[:, active]] = np.nan
+
+        center = np.nanmedian(values, axis=0)
+        std = np.nanstd(values, axis=0)
+
+        with np.errstate(invalid='ignore'):
+            clipped = np.abs(values - center) > sigma * std
+
+        pixels[:, active] = values
+
+        changed = clipped.any(axis=0)
+        clip[:, active] = clipped
+        active = active[changed]
+
+    if len(active):
+        pixels[:, active] = np.where(clip[:, active], np.nan, pixels[:, active])
+
+    combined = pixels.mean(axis=0)
+
+    # Only the pixels with something clipped need the slower NaN-aware mean
+    clipped_pixels = np.nonzero(np.isnan(combined))[0]
+    combined[clipped_pixels] = np.nanmean(pixels[:, clipped_pixels], axis=0)
+
+    return combined.reshape(stack.shape[1:])
+
+
+def combine_frames(fnames, method='median', sigma=3., iters=5, max_memory=256 * 2**20,
+                   subtract=None, scale=None, verbose=False):
+    """ Combine FITS frames into a single frame
+
+    The frames are combined a block of rows at a time so only one block from each
+    frame has to be held in memory. Uncompressed frames are memory-mapped and read
+    straight from disk. Compressed frames can't be memory-mapped so they are read
+    one at a time into a memory-mapped stack on disk first.
+
+    Args:
+        fnames (list): Names of the FITS files, which must all be the same shape
+        method (str, optional): One of `COMBINE_METHODS`, default 'median'
+        sigma (float, optional): Clipping limit for `sigma_clip`, default 3
+        iters (int, optional): Maximum number of clipping iterations, default 5
+        max_memory (int, optional): Approximate memory to use in bytes, default 256 MB
+        subtract (numpy.ndarray, optional): Frame to subtract from each frame, e.g. a
+            master bias
+        scale (numpy.ndarray, optional): N x 2 x 2 array, each frame is divided by
+            its 2 x 2 array tiled over the Bayer pattern
+        verbose (bool, optional): Print progress, default False
+
+    Returns:
+        numpy.ndarray: Combined float32 frame
+    """
+    assert method in COMBINE_METHODS, warn("Unknown combine method: {}".format(method))
+
+    if len(fnames) == 0:
+        raise error.PanError("No frames to combine")
+
+    with ExitStack() as stack:
+        readers = [_get_row_reader(fname, stack) for fname in fnames]
+
+        shape = readers[0].shape
+        for fname, reader in zip(fnames, readers):
+            if reader.shape != shape:
+                raise error.PanError("{} has shape {}, expected {}".format(fname, reader.shape, shape))
+
+        if subtract is not None:
+            assert subtract.shape == shape, warn("Frame to subtract must have shape {}".format(shape))
+
+        height, width = shape
+        chunk_rows = get_chunk_rows(len(readers), width, max_memory=max_memory)
+
+        if verbose:
+            print("Combining {} frames with {} in blocks of {} rows".format(len(fnames), method, chunk_rows))
+
+        combined = np.empty(shape, dtype=np.float32)
+        rows = np.empty((len(readers), min(chunk_rows, height), width), dtype=np.float32)
+
+        for start in range(0, height, chunk_rows):
+            stop = min(start + chunk_rows, height)
+            block = rows[:, :stop - start]
+
+            for i, reader in enumerate(readers):
+                block[i] = reader(start, stop)
+
+                if subtract is not None:
+                    block[i] -= subtract[start:stop]
+
+                if scale is not None:
+                    divide_bayer(block[i], scale[i], start=start)
+
+            combined[start:stop] = combine_rows(block, method=method, sigma=sigma, iters=iters)
+
+    return combined
+
+
+def divide_bayer(data, scale, start=0):
+    """ Divide each Bayer channel of `data` in place
+
+    Args:
+        data (numpy.ndarray): Float array of rows from a frame
+        scale (numpy.ndarray): 2 x 2 array of divisors for the R, G1 / G2, B pixels
+        start (int, optional): Row in the frame that `data` starts at, default 0
+    """
+    for dy in range(2):
+        for dx in range(2):
+            data[(dy - start) % 2::2, dx::2] /= scale[dy][dx]
+
+
+def get_bayer_levels(data, step=8):
+    """ Median level of each Bayer channel
+
+    Args:
+        data (numpy.ndarray): Frame data
+        step (int, optional): Sample every `step`-th row and column of each
+            channel, default 8
+
+    Returns:
+        numpy.ndarray: 2 x 2 array of levels for the R, G1 / G2, B pixels
+    """
+    levels = np.empty((2, 2), dtype=np.float32)
+    for dy in range(2):
+        for dx in range(2):
+            levels[dy, dx] = np.median(data[dy::2 * step, dx::2 * step])
+
+    return levels
+
+
+class CalibrationLibrary(object):
+
+    """ Master bias, dark and flat frames for each camera
+
+    Masters are built from raw frames with `build_master` and saved as FITS files in
+    `base_dir/<camera uid>/`. Bias and flat masters are kept for each ISO, dark
+    masters for each ISO and exposure time:
+
+        <camera uid>/bias_iso100.fits
+        <camera uid>/dark_iso100_exp120.fits
+        <camera uid>/flat_iso100.fits
+
+    Darks are not bias-subtracted, so a master dark with the same exposure time removes
+    the bias as well. Each flat frame has the master dark (or bias) removed and is
+    normalized by the median of each Bayer channel before being combined.
+
+    The most recently used masters are kept in memory so calibrating a sequence of
+    frames only reads them once.
+
+    Args:
+        base_dir (str, optional): Directory for the masters, defaults to
+            `$PANDIR/calibration`
+        max_memory (int, optional): Memory to use when combining frames, see `combine_frames`
+        cache_size (int, optional): Number of masters kept in memory, default 6
+    """
+
+    def __init__(self, base_dir=None, max_memory=256 * 2**20, cache_size=6):
+        if base_dir is None:
+            base_dir = os.path.join(os.getenv('PANDIR', '/var/panoptes'), 'calibration')
+
+        self.base_dir = base_dir
+        self.max_memory = max_memory
+        self.cache_size = cache_size
+
+        self._masters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_master_fname(self, kind, camera_uid, iso, exptime=None):
+        """ Name of the file for a master frame
+
+        Args:
+            kind (str): One of `CALIBRATION_TYPES`
+            camera_uid (str): Camera uid, see `pocs.camera.AbstractCamera.uid`
+            iso (int): ISO the frames were taken at
+            exptime (float, optional): Exposure time in seconds, only used for darks
+
+        Returns:
+            str: Full path of the master file
+        """
+        assert kind in CALIBRATION_TYPES, warn("Unknown calibration type: {}".format(kind))
+
+        name = '{}_iso{}'.format(kind, iso)
+        if kind == 'dark':
+            assert exptime is not None, warn("Darks need an exposure time")
+            name += '_exp{:g}'.format(float(exptime))
+
+        camera_dir = re.sub(r'[^\w.-]', '_', str(camera_uid))
+
+        return os.path.join(self.base_dir, camera_dir, '{}.fits'.format(name))
+
+    def build_master(self, kind, fnames, method=None, sigma=3., clobber=False, verbose=False):
+        """ Combine raw calibration frames into a master
+
+        The camera, ISO and exposure time are taken from the header of the first frame
+        and all the frames must match. An existing master is reused unless `clobber`
+        is set.
+
+        Args:
+            kind (str): One of `CALIBRATION_TYPES`
+            fnames (list): Names of the raw FITS frames
+            method (str, optional): One of `COMBINE_METHODS`, defaults to 'median' for
+                bias and dark, 'sigma_clip' for flats
+            sigma (float, optional): Clipping limit for `sigma_clip`, default 3
+            clobber (bool, optional): Rebuild an existing master, default False
+            verbose (bool, optional): Print progress, default False
+
+        Returns:
+            str: Name of the master file
+        """
+        assert kind in CALIBRATION_TYPES, warn("Unknown calibration type: {}".format(kind))
+
+        if len(fnames) == 0:
+            raise error.PanError("No frames given for master {}".format(kind))
+
+        keys = [get_calibration_key(fits.getheader(fname)) for fname in fnames]
+        camera_uid, iso, exptime = keys[0]
+
+        for fname, (frame_uid, frame_iso, frame_exptime) in zip(fnames, keys):
+            if (frame_uid, frame_iso) != (camera_uid, iso):
+                raise error.PanError("{} is from {} at ISO {}, expected {} at ISO {}".format(
+                    fname, frame_uid, frame_iso, camera_uid, iso))
+            if kind == 'dark' and frame_exptime != exptime:
+                raise error.PanError("{} has exposure time {}, expected {}".format(fname, frame_exptime, exptime))
+
+        master_fname = self.get_master_fname(kind, camera_uid, iso, exptime=exptime)
+
+        if os.path.exists(master_fname) and not clobber:
+            if verbose:
+                print("Using existing master {}: {}".format(kind, master_fname))
+            return master_fname
+
+        if method is None:
+            method = 'sigma_clip' if kind == 'flat' else 'median'
+
+        subtract = None
+        scale = None
+        if kind == 'flat':
+            subtract = self.get_offset(camera_uid, iso, exptime=exptime)
+            scale = np.array([self._get_flat_levels(fname, subtract) for fname in fnames])
+
+        master = combine_frames(fnames,
+                                method=method,
+                                sigma=sigma,
+                                max_memory=self.max_memory,
+                                subtract=subtract,
+                                scale=scale,
+                                verbose=verbose)
+
+        if kind == 'flat':
+            divide_bayer(master, get_bayer_levels(master, step=1))
+
+        header = fits.Header()
+        header.set('IMAGETYP', kind, 'Master calibration frame')
+        header.set('INSTRUME', camera_uid, 'Camera ID')
+        header.set('ISO', iso)
+        if exptime is not None:
+            header.set('EXPTIME', exptime, 'Seconds')
+        header.set('NCOMBINE', len(fnames), 'Number of frames combined')
+        header.set('COMBMETH', method, 'Combine method')
+
+        os.makedirs(os.path.dirname(master_fname), exist_ok=True)
+        fits.PrimaryHDU(master, header=header).writeto(master_fname, clobber=True)
+
+        with self._lock:
+            self._masters.pop(master_fname, None)
+
+        if verbose:
+            print("Master {} from {} frames: {}".format(kind, len(fnames), master_fname))
+
+        return master_fname
+
+    def get_master(self, kind, camera_uid, iso, exptime=None):
+        """ Get the data for a master frame
+
+        Args:
+            kind (str): One of `CALIBRATION_TYPES`
+            camera_uid (str): Camera uid
+            iso (int): ISO of the frame
+            exptime (float, optional): Exposure time in seconds, needed for darks
+
+        Returns:
+            numpy.ndarray: Read-only float32 master frame or None if there isn't one
+        """
+        if kind == 'dark' and exptime is None:
+            return None
+
+        master_fname = self.get_master_fname(kind, camera_uid, iso, exptime=exptime)
+
+        try:
+            mtime = os.path.getmtime(master_fname)
+        except OSError:
+            return None
+
+        with self._lock:
+            cached = self._masters.get(master_fname)
+            if cached is not None and cached[0] == mtime:
+                self._masters.move_to_end(master_fname)
+                return cached[1]
+
+        data = fits.getdata(master_fname).astype(np.float32)
+        data.flags.writeable = False
+
+        with self._lock:
+            self._masters[master_fname] = (mtime, data)
+            while len(self._masters) > self.cache_size:
+                self._masters.popitem(last=False)
+
+        return data
+
+    def get_offset(self, camera_uid, iso, exptime=None):
+        """ Master dark for `exptime` if there is one, otherwise the master bias """
+        offset = self.get_master('dark', camera_uid, iso, exptime=exptime)
+        if offset is None:
+            offset = self.get_master('bias', camera_uid, iso)
+
+        return offset
+
+    def calibrate(self, data, header, out=None):
+        """ Remove the dark (or bias) and divide by the flat
+
+        The masters are picked using the camera, ISO and exposure time in `header`.
+        Steps are skipped if there is no master for them.
+
+        Args:
+            data (numpy.ndarray): Raw frame
+            header (astropy.io.fits.Header): Header of the frame
+            out (numpy.ndarray, optional): Float32 array for the result, may be `data`
+                itself to calibrate in place
+
+        Returns:
+            tuple: The calibrated data and a list of the steps applied
+        """
+        camera_uid, iso, exptime = get_calibration_key(header)
+
+        if out is None:
+            out = np.array(data, dtype=np.float32)
+        elif out is not data:
+            out[:] = data
+
+        steps = list()
+
+        offset = self.get_master('dark', camera_uid, iso, exptime=exptime)
+        if offset is not None:
+            steps.append('dark')
+        else:
+            offset = self.get_master('bias', camera_uid, iso)
+            if offset is not None:
+                steps.append('bias')
+
+        if offset is not None:
+            np.subtract(out, offset, out=out)
+
+        flat = self.get_master('flat', camera_uid, iso)
+        if flat is not None:
+            np.divide(out, flat, out=out)
+            steps.append('flat')
+
+        return out, steps
+
+    def _get_flat_levels(self, fname, subtract=None, step=8):
+        data = fits.getdata(fname)
+
+        levels = np.empty((2, 2), dtype=np.float32)
+        for dy in range(2):
+            for dx in range(2):
+                channel = data[dy::2 * step, dx::2 * step].astype(np.float32)
+                if subtract is not None:
+                    channel -= subtract[dy::2 * step, dx::2 * step]
+
+                levels[dy, dx] = np.median(channel)
+
+        if np.any(levels <= 0):
+            raise error.PanError("Flat {} has no signal".format(fname))
+
+        return levels
+
+
+class _RowReader(object):
+
+    """ Read blocks of rows from a frame as float32 """
+
+    def __init__(self, data, bscale=1., bzero=0.):
+        self.data = data
+        self.shape = data.shape
+        self.bscale = bscale
+        self.bzero = bzero
+
+    def __call__(self, start, stop):
+        rows = self.data[start:stop].astype(np.float32)
+        if self.bscale != 1:
+            rows *= self.bscale
+        if self.bzero != 0:
+            rows += self.bzero
+
+        return rows
+
+
+def _get_row_reader(fname, stack):
+    hdu_list = stack.enter_context(fits.open(fname, memmap=True, do_not_scale_image_data=True))
+
+    for idx, hdu in enumerate(hdu_list):
+        if hdu.header.get('NAXIS', 0) == 2:
+            break
+    else:
+        raise error.PanError("No image data in {}".format(fname))
+
+    if isinstance(hdu, fits.CompImageHDU):
+        # Decompress once into a memory-mapped file instead of keeping the whole frame in memory
+        data = fits.getdata(fname, ext=idx)
+        tmp_file = stack.enter_context(tempfile.TemporaryFile(prefix='pocs_stack_'))
+        mapped = np.memmap(tmp_file, dtype=np.float32, mode='w+', shape=data.shape)
+        mapped[:] = data
+        del data
+
+        return _RowReader(mapped)
+
+    # The raw memory-mapped data, scaled a block at a time
+    return _RowReader(hdu.data,
+                      bscale=hdu.header.get('BSCALE', 1.),
+                      bzero=hdu.header.get('BZERO', 0.))
+
+
+_libraries = dict()
+_libraries_lock = threading.Lock()
+
+
+def get_calibration_library(base_dir=None):
+    """ Get the shared `CalibrationLibrary` for `base_dir`, creating it if needed """
+    with _libraries_lock:
+        if base_dir not in _libraries:
+            _libraries[base_dir] = CalibrationLibrary(base_dir=base_dir)
+
+        return _libraries[base_dir]
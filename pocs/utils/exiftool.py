@@ -0,0 +1,178 @@
+import atexit
+import os
+import select
+import shutil
+import subprocess
+import threading
+import time
+
+from json import loads
+from warnings import warn
+
+from pocs.utils import error
+
+
+class ExifTool(object):
+
+    """ A long-running `exiftool` process
+
+    Starting `exiftool` means starting a new Perl interpreter, which costs more than reading
+    the EXIF information itself. This class keeps a single process alive using the
+    `-stay_open True -@ -` options and sends it one request per `execute` call, reading
+    the output up to the `{readyNNN}` marker that `exiftool` writes after each request.
+
+    The process is started on first use and restarted if it has died. Calls are
+    serialized with a lock so a single instance can be shared between threads.
+
+    Args:
+        executable (str, optional): Path to `exiftool`, defaults to first found in path
+        timeout (int, optional): Seconds to wait for a single request, defaults to 30
+    """
+
+    def __init__(self, executable='exiftool', timeout=30):
+        self.executable = executable
+        self.timeout = timeout
+
+        self._proc = None
+        self._lock = threading.Lock()
+        self._num_requests = 0
+
+    @property
+    def is_running(self):
+        """ If the `exiftool` process is alive """
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self):
+        """ Start the `exiftool` process """
+        exiftool = shutil.which(self.executable)
+        if exiftool is None:
+            raise error.InvalidSystemCommand("Can't find exiftool: {}".format(self.executable))
+
+        try:
+            self._proc = subprocess.Popen([exiftool, '-stay_open', 'True', '-@', '-'],
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise error.InvalidSystemCommand("Can't start exiftool: {}".format(e))
+
+        self._num_requests = 0
+
+    def stop(self):
+        """ Stop the `exiftool` process, killing it if it doesn't exit on its own """
+        if self._proc is None:
+            return
+
+        try:
+            if self._proc.poll() is None:
+                self._proc.stdin.write(b'-stay_open\nFalse\n')
+                self._proc.stdin.flush()
+                self._proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self._proc.kill()
+            self._proc.wait()
+        finally:
+            for stream in [self._proc.stdin, self._proc.stdout]:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+            self._proc = None
+
+    def execute(self, *args):
+        """ Run `exiftool` with the given arguments
+
+        If the process has died it is restarted and the request is tried once more.
+
+        Args:
+            *args (str): Arguments for `exiftool`, one per line of the argument file
+
+        Returns:
+            str: Output of `exiftool` for the request
+        """
+        with self._lock:
+            for attempt in range(2):
+                if not self.is_running:
+                    self.stop()
+                    self.start()
+
+                try:
+                    return self._execute(args)
+                except (OSError, EOFError) as e:
+                    warn("exiftool stopped responding, restarting: {}".format(e))
+                    self.stop()
+
+            raise error.InvalidSystemCommand("exiftool failed for: {}".format(args))
+
+    def get_metadata(self, fnames):
+        """ Get the EXIF information for a list of files in one request
+
+        Args:
+            fnames (list): Names of files to read
+
+        Returns:
+            list: A dict of EXIF information for each file, in the same order as `fnames`
+        """
+        if len(fnames) == 0:
+            return list()
+
+        output = self.execute('-j', *fnames)
+
+        try:
+            exif_list = loads(output)
+        except ValueError:
+            raise error.InvalidSystemCommand("Bad output from exiftool for: {}".format(fnames))
+
+        # exiftool only lists files it could read, so match them back up by name
+        exif_lookup = {exif.get('SourceFile'): exif for exif in exif_list}
+
+        return [exif_lookup.get(fname, {}) for fname in fnames]
+
+    def _execute(self, args):
+        self._num_requests += 1
+        ready = '{{ready{}}}'.format(self._num_requests).encode('utf-8')
+
+        request = '\n'.join(list(args) + ['-execute{}'.format(self._num_requests), ''])
+        self._proc.stdin.write(request.encode('utf-8'))
+        self._proc.stdin.flush()
+
+        fd = self._proc.stdout.fileno()
+        output = b''
+        end_time = time.time() + self.timeout
+
+        while not output.rstrip().endswith(ready):
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                self.stop()
+                raise error.Timeout("Timeout waiting for exiftool: {}".format(args))
+
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise EOFError("exiftool exited")
+                output += chunk
+
+        return output.rstrip()[:-len(ready)].decode('utf-8')
+
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+def get_exiftool(executable='exiftool'):
+    """ Get the shared `ExifTool` session for `executable`, creating it if needed """
+    with _sessions_lock:
+        if executable not in _sessions:
+            _sessions[executable] = ExifTool(executable=executable)
+
+        return _sessions[executable]
+
+
+@atexit.register
+def _stop_sessions():
+    for session in _sessions.values():
+        try:
+            session.stop()
+        except Exception:
+            pass
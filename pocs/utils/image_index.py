@@ -0,0 +1,298 @@
+import os
+import sqlite3
+
+from contextlib import contextmanager
+
+from astropy.io import fits
+
+# FITS blocks are always 2880 bytes, cards 80
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Header card and type of each column of the index
+COLUMNS = [
+    ('date_obs', 'DATE-OBS', str),
+    ('field', 'FIELD', str),
+    ('sequence_id', 'SEQID', str),
+    ('image_id', 'IMAGEID', str),
+    ('camera', 'INSTRUME', str),
+    ('exptime', 'EXPTIME', float),
+    ('ra_mnt', 'RA-MNT', float),
+    ('dec_mnt', 'DEC-MNT', float),
+    ('ha_mnt', 'HA-MNT', float),
+    ('airmass', 'AIRMASS', float),
+]
+
+
+def read_header(fname):
+    """ Read the header of the image in a FITS file without reading any data
+
+    Only the header blocks are read. For a tile compressed file (`.fits.fz`) the
+    image header is the one after the empty primary header.
+
+    Args:
+        fname (str): Name of FITS file
+
+    Returns:
+        astropy.io.fits.Header: The header
+    """
+    with open(fname, 'rb') as f:
+        header = _read_header_blocks(f)
+
+        if header.get('NAXIS', 0) == 0 and header.get('EXTEND', False):
+            try:
+                header = _read_header_blocks(f)
+            except EOFError:
+                pass
+
+    return header
+
+
+def _read_header_blocks(f):
+    blocks = list()
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise EOFError("No END card in header of {}".format(f.name))
+
+        blocks.append(block)
+
+        if any(block[i:i + 8] == b'END     ' for i in range(0, BLOCK_SIZE, CARD_SIZE)):
+            break
+
+    return fits.Header.fromstring(b''.join(blocks).decode('ascii', errors='replace'))
+
+
+class ImageIndex(object):
+
+    """ Index of the headers of the FITS files in the images directory
+
+    Selected header cards (see `COLUMNS`) of each file, along with whether it has
+    been plate-solved, are kept in a SQLite table so frames can be selected by
+    field, sequence, camera or time without opening any files. `update` only
+    reads the headers of files that are new or have changed since they were last
+    indexed, and removes files that are gone.
+
+    A new connection is made for every call so the index can be used from several
+    threads and processes at once.
+
+    Args:
+        db_file (str, optional): Path to the database, defaults to
+            `$PANDIR/images/image_index.sqlite`
+    """
+
+    def __init__(self, db_file=None):
+        if db_file is None:
+            db_file = os.path.join(os.getenv('PANDIR', '/var/panoptes'), 'images', 'image_index.sqlite')
+
+        self.db_file = db_file
+
+        db_dir = os.path.dirname(self.db_file)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        columns = ',\n'.join('{} {}'.format(name, 'REAL' if type_ is float else 'TEXT')
+                             for name, card, type_ in COLUMNS)
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS images (
+                                path TEXT PRIMARY KEY,
+                                mtime REAL NOT NULL,
+                                solved INTEGER NOT NULL,
+                                {})""".format(columns))
+            conn.execute("CREATE INDEX IF NOT EXISTS images_date_obs ON images (date_obs)")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_field ON images (field, date_obs)")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_sequence_id ON images (sequence_id, date_obs)")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def __contains__(self, path):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM images WHERE path=?",
+                                (os.path.abspath(path),)).fetchone() is not None
+
+    def update(self, directory=None, verbose=False):
+        """ Bring the index up to date with the files in `directory`
+
+        Args:
+            directory (str, optional): Directory to index, searched recursively, defaults
+                to `$PANDIR/images`
+            verbose (bool, optional): Print the files that are indexed, default False
+
+        Returns:
+            dict: Number of files `added`, `updated`, `removed` and `unchanged`
+        """
+        if directory is None:
+            directory = os.path.join(os.getenv('PANDIR', '/var/panoptes'), 'images')
+
+        directory = os.path.abspath(directory)
+        prefix = os.path.join(directory, '')
+
+        with self._connect() as conn:
+            indexed = dict(conn.execute("SELECT path, mtime FROM images WHERE substr(path, 1, ?)=?",
+                                        (len(prefix), prefix)))
+
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+
+        rows = list()
+        for path, mtime in _find_fits_files(directory):
+            old_mtime = indexed.pop(path, None)
+            if old_mtime == mtime:
+                counts['unchanged'] += 1
+                continue
+
+            try:
+                rows.append(self._get_row(path, mtime))
+            except Exception as e:
+                if verbose:
+                    print("Can't read header of {}: {}".format(path, e))
+                continue
+
+            if verbose:
+                print("Indexing {}".format(path))
+
+            counts['added' if old_mtime is None else 'updated'] += 1
+
+        with self._connect() as conn:
+            self._insert(conn, rows)
+            conn.executemany("DELETE FROM images WHERE path=?", [(path,) for path in indexed])
+
+        counts['removed'] = len(indexed)
+
+        return counts
+
+    def add(self, path):
+        """ Add or update a single file, e.g. as soon as it has been written """
+        path = os.path.abspath(path)
+
+        with self._connect() as conn:
+            self._insert(conn, [self._get_row(path, os.path.getmtime(path))])
+
+    def remove(self, path):
+        """ Remove a file from the index """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM images WHERE path=?", (os.path.abspath(path),))
+
+    def query(self, field=None, sequence_id=None, camera=None, start=None, end=None, solved=None):
+        """ Get the indexed frames that match, in order of `date_obs`
+
+        Args:
+            field (str, optional): Field name
+            sequence_id (str, optional): Sequence ID
+            camera (str, optional): Camera UID
+            start (str, optional): Earliest DATE-OBS, as an ISO time (e.g. '2016-09-09T05:00')
+            end (str, optional): DATE-OBS before which frames are included, as an ISO time
+            solved (bool, optional): Only frames that have (or haven't) been solved
+
+        Returns:
+            list: A dict of the indexed values for each frame, with the filename as `path`
+        """
+        conditions = list()
+        params = list()
+
+        for column, value in [('field', field), ('sequence_id', sequence_id), ('camera', camera)]:
+            if value is not None:
+                conditions.append('{}=?'.format(column))
+                params.append(value)
+
+        if start is not None:
+            conditions.append('date_obs>=?')
+            params.append(str(start))
+
+        if end is not None:
+            conditions.append('date_obs<?')
+            params.append(str(end))
+
+        if solved is not None:
+            conditions.append('solved=?')
+            params.append(int(bool(solved)))
+
+        sql = "SELECT * FROM images"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY date_obs, path"
+
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(sql, params).fetchall()
+
+        frames = list()
+        for row in rows:
+            frame = dict(row)
+            frame['solved'] = bool(frame['solved'])
+            frames.append(frame)
+
+        return frames
+
+    def files(self, **kwargs):
+        """ Filenames of the frames that match, see `query` """
+        return [frame['path'] for frame in self.query(**kwargs)]
+
+    def fields(self):
+        """ Names of the indexed fields """
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT DISTINCT field FROM images WHERE field IS NOT NULL ORDER BY field")]
+
+    def sequences(self, field=None):
+        """ IDs of the indexed sequences, optionally only those of `field` """
+        sql = "SELECT DISTINCT sequence_id FROM images WHERE sequence_id IS NOT NULL"
+        params = list()
+        if field is not None:
+            sql += " AND field=?"
+            params.append(field)
+
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(sql + " ORDER BY sequence_id", params)]
+
+    def _get_row(self, path, mtime):
+        header = read_header(path)
+
+        solved = 'CTYPE1' in header or os.path.exists(_solved_marker(path))
+
+        values = [path, mtime, int(solved)]
+        for name, card, type_ in COLUMNS:
+            values.append(_get_value(header, card, type_))
+
+        return values
+
+    def _insert(self, conn, rows):
+        placeholders = ', '.join(['?'] * (len(COLUMNS) + 3))
+        conn.executemany("INSERT OR REPLACE INTO images VALUES ({})".format(placeholders), rows)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def _find_fits_files(directory):
+    """ Path and modification time of each FITS file under `directory` """
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            yield from _find_fits_files(entry.path)
+        elif entry.name.endswith(('.fits', '.fits.fz')):
+            yield entry.path, entry.stat().st_mtime
+
+
+def _solved_marker(path):
+    for ext in ['.fits.fz', '.fits']:
+        if path.endswith(ext):
+            return path[:-len(ext)] + '.solved'
+
+
+def _get_value(header, card, type_):
+    value = header.get(card)
+    if value is None or value == '':
+        return None
+
+    try:
+        return type_(value)
+    except (TypeError, ValueError):
+        return None
@@ -1,10 +1,12 @@
 import os
 import shutil
 import subprocess
+import time
+import warnings
 
+from collections import OrderedDict
 from collections import namedtuple
 from dateutil import parser as date_parser
-from json import loads
 
 from warnings import warn
 
@@ -13,14 +15,63 @@ from astropy.coordinates import SkyCoord
 import numpy as np
 
 from astropy import units as u
+from astropy import wcs
 from astropy.io import fits
 from astropy.time import Time
 
 from pocs.utils import current_time
 from pocs.utils import error
+from pocs.utils import pretty
+from pocs.utils.exiftool import get_exiftool
+from pocs.utils.solve_cache import get_solve_cache
+from pocs.utils.solve_cache import get_solve_key
 
 PointingError = namedtuple('PointingError', ['delta_ra', 'delta_dec', 'separation'])
 
+WCSINFO_UNITS = {
+    'crpix0': u.pixel,
+    'crpix1': u.pixel,
+    'crval0': u.degree,
+    'crval1': u.degree,
+    'cd11': (u.deg / u.pixel),
+    'cd12': (u.deg / u.pixel),
+    'cd21': (u.deg / u.pixel),
+    'cd22': (u.deg / u.pixel),
+    'imagew': u.pixel,
+    'imageh': u.pixel,
+    'pixscale': (u.arcsec / u.pixel),
+    'orientation': u.degree,
+    'ra_center': u.degree,
+    'dec_center': u.degree,
+    'orientation_center': u.degree,
+    'ra_center_h': u.hourangle,
+    'ra_center_m': u.minute,
+    'ra_center_s': u.second,
+    'dec_center_d': u.degree,
+    'dec_center_m': u.minute,
+    'dec_center_s': u.second,
+    'fieldarea': (u.degree * u.degree),
+    'fieldw': u.degree,
+    'fieldh': u.degree,
+    'decmin': u.degree,
+    'decmax': u.degree,
+    'ramin': u.degree,
+    'ramax': u.degree,
+    'ra_min_merc': u.degree,
+    'ra_max_merc': u.degree,
+    'dec_min_merc': u.degree,
+    'dec_max_merc': u.degree,
+    'merc_diff': u.degree,
+}
+
+
+# Solves tried in turn by `get_progressive_pointing_error`, from fastest to slowest
+POINTING_SOLVE_TIERS = [
+    {'downsample': 8, 'radius': 2},
+    {'downsample': 4, 'radius': 5},
+    {'downsample': 2, 'radius': 15},
+]
+
 
 def get_pointing_error(filename, verbose=False):
 
@@ -36,6 +87,63 @@ def get_pointing_error(filename, verbose=False):
         print("Solving field")
     get_solve_field(filename, ra=ra.value, dec=dec.value, radius=15)
 
+    return _get_pointing_error(filename, coord, verbose=verbose)
+
+
+def get_progressive_pointing_error(filename, tiers=None, timeout=30, verbose=False):
+    """ Get the pointing error with the fastest solve that works
+
+    Each tier is a solve around the mount coordinates in the header. The first
+    tiers are heavily downsampled and only search a small radius, which is
+    enough when the mount is close to where it thinks it is. The next tier is
+    only tried if the previous one fails.
+
+    Args:
+        filename (str): Name of FITS file to solve
+        tiers (list, optional): Dicts of `downsample` and `radius` (degrees) for
+            each solve, defaults to `POINTING_SOLVE_TIERS`
+        timeout (int, optional): Timeout for each solve in seconds, defaults to 30
+        verbose (bool, optional): Show output, defaults to False
+
+    Returns:
+        tuple: The pointing coordinates, the `PointingError` and the index of
+            the tier that solved the image
+
+    Raises:
+        error.SolveError: If none of the tiers could solve the image
+    """
+    if tiers is None:
+        tiers = POINTING_SOLVE_TIERS
+
+    headers = fits.getheader(filename)
+    ra = headers['RA-MNT'] * u.degree
+    dec = headers['DEC-MNT'] * u.degree
+    coord = SkyCoord(ra, dec)
+
+    solved_fname = filename.replace('.fits', '.solved')
+
+    for tier, solve_opts in enumerate(tiers):
+        if verbose:
+            print("Solving field, tier {}: {}".format(tier, solve_opts))
+
+        try:
+            get_solve_field(filename, ra=ra.value, dec=dec.value, timeout=timeout,
+                            verbose=verbose, **solve_opts)
+        except error.SolveError:
+            pass
+
+        if os.path.exists(solved_fname):
+            break
+    else:
+        raise error.SolveError("Could not solve {} with any of {} tiers".format(filename, len(tiers)))
+
+    pointing_coord, pointing_error = _get_pointing_error(filename, coord, verbose=verbose)
+
+    return pointing_coord, pointing_error, tier
+
+
+def _get_pointing_error(filename, coord, verbose=False):
+    """ Pointing coordinates of a solved file and their offset from `coord` """
     # Get solved coordinates
     if verbose:
         print("Getting WCS info")
@@ -128,6 +236,8 @@ def solve_field(fname, timeout=15, solve_opts=[], **kwargs):
         timeout(int, optional):     Timeout for the solve-field command,
                                     defaults to 60 seconds.
         solve_opts(list, optional): List of options for solve-field.
+        downsample(int, optional):  Downsample factor for source extraction,
+                                    defaults to 4.
         verbose(bool, optional):    Show output, defaults to False.
     """
     verbose = kwargs.get('verbose', False)
@@ -154,7 +264,7 @@ def solve_field(fname, timeout=15, solve_opts=[], **kwargs):
             '--match', 'none',
             '--corr', 'none',
             '--wcs', 'none',
-            '--downsample', '4',
+            '--downsample', str(kwargs.get('downsample', 4)),
         ]
         if kwargs.get('clobber', True):
             options.append('--overwrite')
@@ -192,7 +302,7 @@ def solve_field(fname, timeout=15, solve_opts=[], **kwargs):
     return proc
 
 
-def get_solve_field(fname, replace=True, remove_extras=True, **kwargs):
+def get_solve_field(fname, replace=True, remove_extras=True, use_cache=True, **kwargs):
     """Convenience function to wait for `solve_field` to finish.
 
     This function merely passes the `fname` of the image to be solved along to `solve_field`,
@@ -200,11 +310,18 @@ def get_solve_field(fname, replace=True, remove_extras=True, **kwargs):
     to complete, populates a dictonary with the EXIF informaiton and returns. This is often
     more useful than the raw `solve_field` function
 
+    Solutions for FITS files are kept in a `SolveCache` keyed by the pixel data and the
+    solve hints, so an image that has been solved before (under any name) has its WCS
+    written back from the cache instead of being solved again.
+
     Args:
         fname ({str}): Name of file to be solved, either a FITS or CR2
         replace (bool, optional): Replace fname the solved file
         remove_extras (bool, optional): Remove the files generated by solver
-        **kwargs ({dict}): Options to pass to `solve_field`
+        use_cache (bool, optional): Look up and store the solution in the solve cache,
+            default True
+        **kwargs ({dict}): Options to pass to `solve_field`. `cache_file` can be given
+            to use a cache other than the default one.
 
     Returns:
         dict: Keyword information from the solved field
@@ -226,6 +343,23 @@ def get_solve_field(fname, replace=True, remove_extras=True, **kwargs):
     # Set a default radius of 15
     kwargs.setdefault('radius', 15)
 
+    cache = None
+    solve_key = None
+    if use_cache and fname.endswith('.fits'):
+        try:
+            cache = get_solve_cache(kwargs.get('cache_file'))
+            solve_key = get_solve_key(fname, **kwargs)
+            cached = cache.get(solve_key)
+        except Exception as e:
+            warn("Can't use solve cache: {}".format(e))
+            cache = None
+        else:
+            if cached is not None:
+                if verbose:
+                    print("Using cached solution for {}".format(fname))
+
+                return _apply_cached_solve(fname, *cached, replace=replace)
+
     proc = solve_field(fname, **kwargs)
     try:
         output, errs = proc.communicate(timeout=kwargs.get('timeout', 30))
@@ -276,24 +410,55 @@ def get_solve_field(fname, replace=True, remove_extras=True, **kwargs):
             if verbose:
                 print("Can't read fits header for {}".format(fname))
 
+    if cache is not None and 'solved_fits_file' in out_dict:
+        try:
+            cache.put(solve_key,
+                      fits.getheader(out_dict['solved_fits_file']),
+                      info={'fname': fname, 'solved_at': current_time().isot})
+        except Exception as e:
+            warn("Can't store solution in solve cache: {}".format(e))
+
     return out_dict
 
 
-def make_pretty_image(fname, timeout=15, **kwargs):  # pragma: no cover
-    """ Make a pretty image
+def _apply_cached_solve(fname, wcs_header, info, replace=True):
+    """ Write a cached solution into `fname` as if `solve_field` had just solved it """
+    out_dict = {}
+
+    if replace:
+        solved_fname = fname
+    else:
+        solved_fname = fname.replace('.fits', '.new')
+        shutil.copyfile(fname, solved_fname)
+
+    with fits.open(solved_fname, 'update') as hdu_list:
+        hdu_list[0].header.update(wcs_header)
 
-    This calls out to an external script which will try to extract the JPG
-    directly from the CR2 file, otherwise will do an actual conversion
+    # Same marker astrometry.net leaves so the `skip_solved` check works
+    with open(fname.replace('.fits', '.solved'), 'wb') as f:
+        f.write(b'\x01')
+
+    out_dict['solved_fits_file'] = solved_fname
+    out_dict['solve_cache'] = info
+    out_dict.update(fits.getheader(solved_fname))
+
+    return out_dict
+
+
+def make_pretty_image(fname, timeout=15, **kwargs):
+    """ Make a pretty image
 
-    Notes:
-        See `$POCS/scripts/cr2_to_jpg.sh`
+    The JPG and its thumbnails are made in-process, see `pocs.utils.pretty.make_pretty_images`.
+    The pixel data is read from a FITS file or decoded from a CR2. If the images are already
+    newer than `fname` they are not made again.
 
     Arguments:
-        fname {str} -- Name of CR2 file
-        **kwargs {dict} -- Additional arguments to be passed to external script
+        fname {str} -- Name of CR2 or FITS file
+        **kwargs {dict} -- `title`, `sizes` and `verbose`. With `primary` the `latest.jpg`
+            link in the images directory is updated.
 
     Keyword Arguments:
-        timeout {number} -- Process timeout (default: {15})
+        timeout {number} -- Not used, kept for compatibility (default: {15})
 
     Returns:
         str -- Filename of image that was created
@@ -304,32 +469,42 @@ def make_pretty_image(fname, timeout=15, **kwargs):  # pragma: no cover
 
     verbose = kwargs.get('verbose', False)
 
-    title = '{} {}'.format(kwargs.get('title', ''), current_time().isot)
+    jpg_fname = get_pretty_fname(fname)
+    link = get_latest_link() if kwargs.get('primary', False) else None
 
-    solve_field = "{}/scripts/cr2_to_jpg.sh".format(os.getenv('POCS'))
-    cmd = [solve_field, fname, title]
+    if os.path.exists(jpg_fname) and os.path.getmtime(jpg_fname) >= os.path.getmtime(fname):
+        if verbose:
+            print("Pretty image is up to date: {}".format(jpg_fname))
+    else:
+        if fname.endswith('.cr2'):
+            data = read_cr2(fname)
+        else:
+            data = fits.getdata(fname)
 
-    if kwargs.get('primary', False):
-        cmd.append('link')
+        title = '{} {}'.format(kwargs.get('title', ''), current_time().isot)
 
-    if verbose:
-        print(cmd)
+        pretty.make_pretty_images(data, jpg_fname,
+                                  sizes=kwargs.get('sizes', pretty.PRETTY_SIZES),
+                                  title=title)
+
+    if link is not None:
+        pretty.update_link(jpg_fname, link)
+
+    return jpg_fname
 
-    try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
-                                stderr=subprocess.DEVNULL)
-        if verbose:
-            print(proc)
-    except OSError as e:
-        raise error.InvalidCommand("Can't send command to gphoto2."
-                                   " {} \t {}".format(e, cmd))
-    except ValueError as e:
-        raise error.InvalidCommand("Bad parameters to gphoto2."
-                                   " {} \t {}".format(e, cmd))
-    except Exception as e:
-        raise error.PanError("Timeout on plate solving: {}".format(e))
 
-    return fname.replace('cr2', 'jpg')
+def get_pretty_fname(fname):
+    """ Name of the pretty image for a CR2 or FITS file """
+    for ext in ['.cr2', '.fits.fz', '.fits']:
+        if fname.endswith(ext):
+            return fname[:-len(ext)] + '.jpg'
+
+    return fname + '.jpg'
+
+
+def get_latest_link():
+    """ Name of the link to the latest pretty image """
+    return '{}/images/latest.jpg'.format(os.getenv('PANDIR', default='/var/panoptes'))
 
 
 def crop_data(data, box_width=200, center=None, verbose=False):
@@ -369,9 +544,282 @@ def crop_data(data, box_width=200, center=None, verbose=False):
     return center
 
 
+def bin_data(data, binning=2, dtype=None, average=False):
+    """ Bin the data in square blocks
+
+    The blocks are combined with a single reshape and sum so no intermediate
+    copies are made.
+
+    Args:
+        data(np.array):     The original data, e.g. an image. Each dimension must be
+                            a multiple of `binning`.
+        binning(int):       Size of the blocks to combine, defaults to 2 (one RGGB set).
+        dtype(np.dtype):    Type of the output (and of the accumulator used for the sum),
+                            defaults to the numpy default for `data`.
+        average(bool):      Return the mean of each block instead of the sum, defaults
+                            to False. Requires a floating point `dtype`.
+
+    Returns:
+        np.array:           The binned data
+    """
+    ny, nx = data.shape
+    assert ny % binning == 0 and nx % binning == 0, \
+        "Data shape {} is not a multiple of the binning {}".format(data.shape, binning)
+
+    blocks = data.reshape(ny // binning, binning, nx // binning, binning)
+    binned = blocks.sum(axis=(1, 3), dtype=dtype)
+
+    if average:
+        binned /= binning ** 2
+
+    return binned
+
+
+def get_rggb_channels(data):
+    """ Views of the separate color channels of the Bayer array
+
+    The views share memory with `data`, so they are cheap to create but any
+    change to them also changes `data`.
+
+    Args:
+        data(np.array):     The raw RGGB data
+
+    Returns:
+        OrderedDict:        The `R`, `G1`, `G2` and `B` channels
+    """
+    return OrderedDict([
+        ('R', data[0::2, 0::2]),
+        ('G1', data[0::2, 1::2]),
+        ('G2', data[1::2, 0::2]),
+        ('B', data[1::2, 1::2]),
+    ])
+
+
 def get_wcsinfo(fits_fname, verbose=False):
     """Returns the WCS information for a FITS file.
-    Uses the `wcsinfo` astrometry.net utility script to get the WCS information from a plate-solved file
+
+    Computes the values reported by the astrometry.net `wcsinfo` command (see
+    `run_wcsinfo`) directly from the header with `astropy.wcs`, including the SIP
+    distortion terms, using the same keys and units. Results are kept for each file
+    (by modification time) so repeated calls on the same frame only read it once.
+
+    Args:
+        fits_fname (str): Name of a FITS file that contains a WCS
+        verbose (bool, optional): Verbose, default False
+
+    Returns:
+        dict: WCS information, only `wcs_file` if the file has no celestial WCS
+    """
+    assert os.path.exists(fits_fname), warn("No file exists at: {}".format(fits_fname))
+
+    stat = os.stat(fits_fname)
+    cache_key = (os.path.abspath(fits_fname), stat.st_mtime, stat.st_size)
+
+    try:
+        wcs_info = _wcsinfo_cache.pop(cache_key)
+    except KeyError:
+        if verbose:
+            print("Reading WCS from {}".format(fits_fname))
+
+        wcs_info = _compute_wcsinfo(fits.getheader(fits_fname))
+
+    _wcsinfo_cache[cache_key] = wcs_info
+    while len(_wcsinfo_cache) > _wcsinfo_cache_size:
+        _wcsinfo_cache.popitem(last=False)
+
+    wcs_info = dict(wcs_info)
+    wcs_info['wcs_file'] = fits_fname
+
+    return wcs_info
+
+
+def _compute_wcsinfo(header):
+    """ Compute the `wcsinfo` values for a FITS header
+
+    Pixel coordinates are 1-based as in the FITS standard and `wcsinfo`.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', wcs.FITSFixedWarning)
+        w = wcs.WCS(header, naxis=2)
+
+    if not w.has_celestial:
+        return {}
+
+    imagew = float(header.get('IMAGEW', header.get('NAXIS1', 0)))
+    imageh = float(header.get('IMAGEH', header.get('NAXIS2', 0)))
+
+    crpix = w.wcs.crpix
+    crval = w.wcs.crval
+    cd = w.pixel_scale_matrix
+
+    det = np.linalg.det(cd)
+
+    info = OrderedDict()
+    info['crpix0'], info['crpix1'] = crpix
+    info['crval0'], info['crval1'] = crval
+    info['ra_tangent'], info['dec_tangent'] = crval
+    info['pixx_tangent'], info['pixy_tangent'] = crpix
+    info['imagew'] = imagew
+    info['imageh'] = imageh
+    info['cd11'], info['cd12'] = cd[0]
+    info['cd21'], info['cd22'] = cd[1]
+    info['det'] = det
+    info['parity'] = 1 if det >= 0 else -1
+    info['pixscale'] = 3600 * np.sqrt(np.abs(det))
+    info['orientation'] = _cd_orientation(cd)
+
+    # Center of the image
+    center_x = 0.5 + 0.5 * imagew
+    center_y = 0.5 + 0.5 * imageh
+
+    ra, dec = w.all_pix2world([center_x, center_x + 1, center_x],
+                              [center_y, center_y, center_y + 1], 1)
+    ra_center = ra[0] % 360
+    dec_center = dec[0]
+
+    info['ra_center'] = ra_center
+    info['dec_center'] = dec_center
+
+    # Orientation of the (distorted) pixel grid at the center
+    xi, eta, _ = _gnomonic(ra, dec, ra_center, dec_center)
+    local_cd = np.array([[xi[1] - xi[0], xi[2] - xi[0]],
+                         [eta[1] - eta[0], eta[2] - eta[0]]])
+    info['orientation_center'] = _cd_orientation(local_cd)
+
+    # Sexagesimal center, same rounding as astrometry.net's ra2hms/dec2dms
+    hours = ra_center / 15
+    info['ra_center_h'] = np.floor(hours)
+    minutes = (hours - info['ra_center_h']) * 60
+    info['ra_center_m'] = np.floor(minutes)
+    info['ra_center_s'] = (minutes - info['ra_center_m']) * 60
+
+    sign = 1 if dec_center >= 0 else -1
+    info['dec_center_sign'] = sign
+    info['dec_center_d'] = np.floor(sign * dec_center)
+    minutes = (sign * dec_center - info['dec_center_d']) * 60
+    info['dec_center_m'] = np.floor(minutes)
+    info['dec_center_s'] = (minutes - info['dec_center_m']) * 60
+
+    info['ra_center_merc'] = _ra2mercx(ra_center)
+    info['dec_center_merc'] = _dec2mercy(dec_center)
+
+    # Field size measured through the middle of the image, in degrees
+    min_x, max_x = 0.5, imagew + 0.5
+    min_y, max_y = 0.5, imageh + 0.5
+    ra, dec = w.all_pix2world([min_x, center_x, max_x, center_x, center_x],
+                              [center_y, center_y, center_y, min_y, max_y], 1)
+    fieldw = _angle_between(ra[0], dec[0], ra[1], dec[1]) + _angle_between(ra[1], dec[1], ra[2], dec[2])
+    fieldh = _angle_between(ra[3], dec[3], ra[1], dec[1]) + _angle_between(ra[1], dec[1], ra[4], dec[4])
+
+    info['fieldarea'] = fieldw * fieldh
+    info['fieldw'] = fieldw
+    info['fieldh'] = fieldh
+
+    # RA/Dec bounds from walking the edge of the image in 10 pixel steps
+    num_w = int(np.ceil(imagew / 10))
+    num_h = int(np.ceil(imageh / 10))
+    edge_x = np.concatenate([min_x + 10 * np.arange(num_w),
+                             np.full(num_h, max_x),
+                             max_x - 10 * np.arange(num_w),
+                             np.full(num_h, min_x)]).clip(min_x, max_x)
+    edge_y = np.concatenate([np.full(num_w, min_y),
+                             min_y + 10 * np.arange(num_h),
+                             np.full(num_w, max_y),
+                             max_y - 10 * np.arange(num_h)]).clip(min_y, max_y)
+
+    ra, dec = w.all_pix2world(edge_x, edge_y, 1)
+
+    # Keep RA continuous across 0/360
+    ra = np.where(ra - ra_center > 180, ra - 360, ra)
+    ra = np.where(ra_center - ra > 180, ra + 360, ra)
+
+    ramin = min(ra.min(), ra_center)
+    ramax = max(ra.max(), ra_center)
+    decmin = min(dec.min(), dec_center)
+    decmax = max(dec.max(), dec_center)
+
+    for pole in [90, -90]:
+        if _is_inside_image(w, 0, pole, imagew, imageh):
+            ramin, ramax = 0, 360
+            if pole > 0:
+                decmax = pole
+            else:
+                decmin = pole
+
+    info['decmin'] = decmin
+    info['decmax'] = decmax
+    info['ramin'] = ramin
+    info['ramax'] = ramax
+
+    info['ra_min_merc'] = _ra2mercx(ramin)
+    info['ra_max_merc'] = _ra2mercx(ramax)
+    info['dec_min_merc'] = _dec2mercy(decmin)
+    info['dec_max_merc'] = _dec2mercy(decmax)
+    info['merc_diff'] = max(info['ra_max_merc'] - info['ra_min_merc'],
+                            info['dec_max_merc'] - info['dec_min_merc'])
+
+    return {k: float(v) * WCSINFO_UNITS.get(k, 1) for k, v in info.items()}
+
+
+def _cd_orientation(cd):
+    """ Orientation (degrees East of North) of a CD matrix, as in astrometry.net """
+    parity = 1 if np.linalg.det(cd) >= 0 else -1
+    T = parity * cd[0][0] + cd[1][1]
+    A = parity * cd[1][0] - cd[0][1]
+
+    return -np.degrees(np.arctan2(A, T))
+
+
+def _gnomonic(ra, dec, ra0, dec0):
+    """ Project RA/Dec onto the tangent plane at ra0/dec0, in degrees """
+    ra, dec, ra0, dec0 = [np.radians(np.asarray(a, dtype=float)) for a in (ra, dec, ra0, dec0)]
+
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+
+    return np.degrees(xi), np.degrees(eta), cos_c
+
+
+def _angle_between(ra1, dec1, ra2, dec2):
+    """ Angular distance in degrees """
+    ra1, dec1, ra2, dec2 = np.radians([ra1, dec1, ra2, dec2])
+
+    hav = np.sin((dec2 - dec1) / 2)**2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2)**2
+
+    return np.degrees(2 * np.arcsin(np.sqrt(hav)))
+
+
+def _is_inside_image(w, ra, dec, imagew, imageh):
+    # Points on the far side of the tangent plane don't project
+    _, _, cos_c = _gnomonic(ra, dec, w.wcs.crval[0], w.wcs.crval[1])
+    if cos_c <= 0:
+        return False
+
+    # Like astrometry.net, use the inverse SIP terms rather than iterating
+    x, y = w.wcs_world2pix([ra], [dec], 1)
+    if w.sip is not None and w.sip.ap is not None:
+        x, y = w.sip_foc2pix(x - w.wcs.crpix[0], y - w.wcs.crpix[1], 1)
+
+    return bool(1 <= x[0] <= imagew and 1 <= y[0] <= imageh)
+
+
+def _ra2mercx(ra):
+    return (ra / 360.) % 1.0
+
+
+def _dec2mercy(dec):
+    return 0.5 + np.arcsinh(np.tan(np.radians(dec))) / (2 * np.pi)
+
+
+_wcsinfo_cache = OrderedDict()
+_wcsinfo_cache_size = 128
+
+
+def run_wcsinfo(fits_fname, verbose=False):
+    """Returns the WCS information for a FITS file from the `wcsinfo` command.
+    Uses the `wcsinfo` astrometry.net utility script to get the WCS information from a plate-solved file.
+    `get_wcsinfo` computes the same values without starting a process.
     Parameters
     ----------
     fits_fname : {str}
@@ -401,42 +849,6 @@ def get_wcsinfo(fits_fname, verbose=False):
         proc.kill()
         output, errs = proc.communicate()
 
-    unit_lookup = {
-        'crpix0': u.pixel,
-        'crpix1': u.pixel,
-        'crval0': u.degree,
-        'crval1': u.degree,
-        'cd11': (u.deg / u.pixel),
-        'cd12': (u.deg / u.pixel),
-        'cd21': (u.deg / u.pixel),
-        'cd22': (u.deg / u.pixel),
-        'imagew': u.pixel,
-        'imageh': u.pixel,
-        'pixscale': (u.arcsec / u.pixel),
-        'orientation': u.degree,
-        'ra_center': u.degree,
-        'dec_center': u.degree,
-        'orientation_center': u.degree,
-        'ra_center_h': u.hourangle,
-        'ra_center_m': u.minute,
-        'ra_center_s': u.second,
-        'dec_center_d': u.degree,
-        'dec_center_m': u.minute,
-        'dec_center_s': u.second,
-        'fieldarea': (u.degree * u.degree),
-        'fieldw': u.degree,
-        'fieldh': u.degree,
-        'decmin': u.degree,
-        'decmax': u.degree,
-        'ramin': u.degree,
-        'ramax': u.degree,
-        'ra_min_merc': u.degree,
-        'ra_max_merc': u.degree,
-        'dec_min_merc': u.degree,
-        'dec_max_merc': u.degree,
-        'merc_diff': u.degree,
-    }
-
     wcs_info = {}
     for line in output.split('\n'):
         try:
@@ -446,7 +858,7 @@ def get_wcsinfo(fits_fname, verbose=False):
             except:
                 pass
 
-            wcs_info[k] = float(v) * unit_lookup.get(k, 1)
+            wcs_info[k] = float(v) * WCSINFO_UNITS.get(k, 1)
         except ValueError:
             pass
             # print("Error on line: {}".format(line))
@@ -456,10 +868,12 @@ def get_wcsinfo(fits_fname, verbose=False):
     return wcs_info
 
 
-def fpack(fits_fname, unpack=False, verbose=False):
+def fpack(fits_fname, unpack=False, timeout=30, verbose=False):
     """ Compress/Decompress a FITS file
 
-    Uses `fpack` (or `funpack` if `unpack=True`) to compress a FITS file
+    Uses `fpack` (or `funpack` if `unpack=True`) to compress a FITS file. To avoid
+    writing the file twice, FITS files made with `cr2_to_fits` can instead be
+    compressed as they are written with `compress=True`.
 
     Parameters
     ----------
@@ -467,12 +881,14 @@ def fpack(fits_fname, unpack=False, verbose=False):
         Name of a FITS file that contains a WCS.
     unpack : {bool}, optional
         file should decompressed instead of compressed (default is False)
+    timeout : {int}, optional
+        Seconds to wait for `fpack` before giving up (the default is 30)
     verbose : {bool}, optional
         Verbose (the default is False)
     Returns
     -------
     str
-        Filename of compressed/decompressed file
+        Filename of compressed/decompressed file, or `fits_fname` if `fpack` timed out
     """
     assert os.path.exists(fits_fname), warn("No file exists at: {}".format(fits_fname))
 
@@ -492,13 +908,55 @@ def fpack(fits_fname, unpack=False, verbose=False):
 
     proc = subprocess.Popen(run_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
     try:
-        output, errs = proc.communicate(timeout=5)
+        output, errs = proc.communicate(timeout=timeout)
     except subprocess.TimeoutExpired:
         proc.kill()
         output, errs = proc.communicate()
 
+        warn("Timeout running {} on {}".format(os.path.basename(fpack), fits_fname))
+
+        # The input is only removed once the output is complete
+        if os.path.exists(fits_fname) and os.path.exists(out_file):
+            os.remove(out_file)
+
+        return fits_fname
+
     return out_file
 
+
+def write_fits(hdu, fits_fname, compress=False, tile_size=None, quantize_level=16, clobber=False):
+    """ Write an image to a FITS file, optionally tile compressed
+
+    With `compress=True` the file is written in the same layout `fpack` uses: an
+    empty primary HDU followed by a RICE_1 compressed image extension, which
+    `funpack` (or `fits.open`) can read. Tiles default to one row of the image, as
+    with `fpack`. Integer data is compressed losslessly, `quantize_level` only
+    applies to floating point data.
+
+    Args:
+        hdu (astropy.io.fits.PrimaryHDU): Image data and header to write
+        fits_fname (str): Name of file to write, usually ending in `.fits.fz` if compressed
+        compress (bool, optional): Write a compressed image, default False
+        tile_size (tuple, optional): Size of compression tiles as (width, height),
+            default is row by row
+        quantize_level (float, optional): Quantization level for floating point data,
+            default 16 (same as `fpack`)
+        clobber (bool, optional): Overwrite an existing file, default False
+    """
+    if compress:
+        hdu_list = fits.HDUList([
+            fits.PrimaryHDU(),
+            fits.CompImageHDU(data=hdu.data,
+                              header=hdu.header,
+                              compression_type='RICE_1',
+                              tile_size=tile_size,
+                              quantize_level=quantize_level),
+        ])
+    else:
+        hdu_list = fits.HDUList([hdu])
+
+    hdu_list.writeto(fits_fname, output_verify='silentfix', clobber=clobber)
+
 # ---------------------------------------------------------------------
 # IO Functions
 # ---------------------------------------------------------------------
@@ -511,14 +969,21 @@ def cr2_to_fits(
         headers={},
         fits_headers={},
         remove_cr2=False,
+        stream=True,
+        timings=None,
+        compress=False,
+        tile_size=None,
+        quantize_level=16,
+        on_data=None,
         **kwargs):  # pragma: no cover
     """ Convert a CR2 file to FITS
 
-    This is a convenience function that first converts the CR2 to PGM via `cr2_to_pgm`. Also adds keyword headers
-    to the FITS file.
+    This is a convenience function that reads the raw data via `read_cr2`, which streams the
+    `dcraw` output directly into memory. Also adds keyword headers to the FITS file.
 
     Note:
-        The intermediate PGM file is automatically removed
+        If `stream=False` the CR2 is first converted to an intermediate PGM file via `cr2_to_pgm`,
+        which is automatically removed
 
     Arguments:
         cr2_fname {str} -- Name of CR2 file to be converted
@@ -531,23 +996,50 @@ def cr2_to_fits(
         headers {dict} -- Header data that is filtered and added to the FITS header.
         fits_headers {dict} -- Header data that is added to the FITS header without filtering.
         remove_cr2 {bool} -- A bool indicating if the CR2 should be removed (default: {False})
+        stream {bool} -- Read the `dcraw` output directly instead of going through a PGM
+            file (default: {True})
+        timings {dict} -- If given, populated with the time in seconds spent in each stage of
+            the conversion (`dcraw`, `decode`, `exif`, `write`) (default: {None})
+        compress {bool} -- Write a RICE_1 tile compressed file (as made by `fpack`) instead of
+            compressing afterwards, see `write_fits`. The default `fits_fname` then ends in
+            `.fits.fz` (default: {False})
+        tile_size {tuple} -- Compression tile size as (width, height), row by row if None
+            (default: {None})
+        quantize_level {float} -- Quantization level for floating point data (default: {16})
+        on_data {callable} -- Called with the decoded data and the FITS header once the file has
+            been written, so the data can be used without reading it again, e.g. for
+            `pocs.utils.pretty.make_pretty_images` (default: {None})
 
     """
 
     verbose = kwargs.get('verbose', False)
 
     if fits_fname is None:
-        fits_fname = cr2_fname.replace('.cr2', '.fits')
+        fits_fname = cr2_fname.replace('.cr2', '.fits.fz' if compress else '.fits')
+
+    if timings is None:
+        timings = dict()
 
     if not os.path.exists(fits_fname) or clobber:
-        if verbose:
-            print("Converting CR2 to PGM: {}".format(cr2_fname))
+        t0 = time.time()
+        if stream:
+            if verbose:
+                print("Streaming CR2 data from dcraw: {}".format(cr2_fname))
+
+            # Read the dcraw output directly into an array
+            pgm = read_cr2(cr2_fname, timings=timings, **kwargs)
+        else:
+            if verbose:
+                print("Converting CR2 to PGM: {}".format(cr2_fname))
 
-        # Convert the CR2 to a PGM file then delete PGM
-        pgm = read_pgm(cr2_to_pgm(cr2_fname), remove_after=True)
+            # Convert the CR2 to a PGM file then delete PGM
+            pgm = read_pgm(cr2_to_pgm(cr2_fname), remove_after=True)
+        timings['decode'] = time.time() - t0
 
         # Add the EXIF information from the CR2 file
+        t0 = time.time()
         exif = read_exif(cr2_fname)
+        timings['exif'] = time.time() - t0
 
         # Set the PGM as the primary data for the FITS file
         hdu = fits.PrimaryHDU(pgm)
@@ -606,13 +1098,26 @@ def cr2_to_fits(
             if verbose:
                 print("Saving fits file to: {}".format(fits_fname))
 
-            hdu.writeto(fits_fname, output_verify='silentfix', clobber=clobber)
+            t0 = time.time()
+            write_fits(hdu, fits_fname,
+                       compress=compress,
+                       tile_size=tile_size,
+                       quantize_level=quantize_level,
+                       clobber=clobber)
+            timings['write'] = time.time() - t0
         except Exception as e:
             warn("Problem writing FITS file: {}".format(e))
         else:
             if remove_cr2:
                 os.unlink(cr2_fname)
 
+            if on_data is not None:
+                on_data(hdu.data, hdu.header)
+
+        if verbose:
+            print("Conversion timings: {}".format(
+                ', '.join('{}: {:.03f}s'.format(k, v) for k, v in timings.items())))
+
     return fits_fname
 
 
@@ -675,10 +1180,87 @@ def cr2_to_pgm(cr2_fname, pgm_fname=None, dcraw='dcraw', clobber=True, **kwargs)
     return pgm_fname
 
 
+def read_cr2(cr2_fname, dcraw='dcraw', byteorder='>', timings=None, **kwargs):  # pragma: no cover
+    """ Read the raw data from a CR2 file
+
+    Runs `dcraw` in the same mode as `cr2_to_pgm` but has it write the PGM to stdout (`-c`),
+    which is then read directly into a preallocated array. This avoids writing the
+    intermediate PGM file to disk and reading it back in.
+
+    Note:
+        See `read_pgm` for notes on the byte order
+
+    Arguments:
+        cr2_fname {str} -- Name of CR2 file to read
+        **kwargs {dict} -- Additional keywords
+
+    Keyword Arguments:
+        dcraw {str} -- Path to installed `dcraw` (default: {'dcraw'})
+        byteorder {str} -- Byte order of the `dcraw` output (default: {'>'})
+        timings {dict} -- If given, the time spent waiting on `dcraw` is stored
+            under `dcraw` (default: {None})
+
+    Returns:
+        numpy.array -- The raw data from the CR2
+
+    """
+    assert shutil.which(dcraw) is not None, "could not execute dcraw in path: {}".format(dcraw)
+    assert os.path.exists(cr2_fname), "cr2 file does not exist at {}".format(cr2_fname)
+
+    verbose = kwargs.get('verbose', False)
+
+    cmd_list = [dcraw, '-t', '0', '-D', '-4', '-c', cr2_fname]
+    if verbose:
+        print("dcraw command: \n {}".format(cmd_list))
+
+    t0 = time.time()
+    try:
+        proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise error.InvalidSystemCommand(msg="File: {} \n err: {}".format(cr2_fname, e))
+
+    data = None
+    nbytes = nread = 0
+    try:
+        # PGM header is "P5\n<width> <height>\n<max value>\n"
+        img_type = proc.stdout.readline().strip()
+        img_size = proc.stdout.readline().split()
+        proc.stdout.readline()
+
+        if img_type == b'P5' and len(img_size) == 2:
+            width, height = [int(x) for x in img_size]
+
+            data = np.empty((height, width), dtype=byteorder + 'u2')
+
+            # Fill the array straight from the pipe
+            buf = memoryview(data.view(np.uint8).reshape(-1))
+            nbytes = buf.nbytes
+            while nread < nbytes:
+                n = proc.stdout.readinto(buf[nread:])
+                if not n:
+                    break
+                nread += n
+    finally:
+        proc.stdout.close()
+        errs = proc.stderr.read()
+        proc.stderr.close()
+        proc.wait()
+
+    if timings is not None:
+        timings['dcraw'] = time.time() - t0
+
+    if proc.returncode != 0 or data is None or nread < nbytes:
+        raise error.InvalidSystemCommand(msg="File: {} \n err: {}".format(
+            cr2_fname, errs.decode('utf-8', errors='replace')))
+
+    return np.flipud(data)
+
+
 def read_exif(fname, exiftool='exiftool'):  # pragma: no cover
     """ Read the EXIF information
 
-    Gets the EXIF information using exiftool
+    Gets the EXIF information using a shared, long-running exiftool process
+    (see `pocs.utils.exiftool.ExifTool`)
 
     Note:
         Assumes the `exiftool` is installed
@@ -694,19 +1276,27 @@ def read_exif(fname, exiftool='exiftool'):  # pragma: no cover
 
     """
     assert os.path.exists(fname), warn("File does not exist: {}".format(fname))
-    exif = {}
 
-    try:
-        # Build the command for this file
-        command = '{} -j {}'.format(exiftool, fname)
-        cmd_list = command.split()
+    return read_exif_batch([fname], exiftool=exiftool)[0]
+
+
+def read_exif_batch(fnames, exiftool='exiftool'):  # pragma: no cover
+    """ Read the EXIF information for many files at once
+
+    All of the files are read with a single request to the shared exiftool process.
+
+    Args:
+        fnames {list} -- Names of files (CR2) to read
+
+    Keyword Args:
+        exiftool {str} -- Location of exiftool (default: {'/usr/bin/exiftool'})
 
-        # Run the command
-        exif = loads(subprocess.check_output(cmd_list).decode('utf-8'))
-    except subprocess.CalledProcessError as err:
-        raise error.InvalidSystemCommand(msg="File: {} \n err: {}".format(fname, err))
+    Returns:
+        list -- Dictonary of EXIF information for each file, in the same order as `fnames`.
+            Files that could not be read have an empty dict.
 
-    return exif[0]
+    """
+    return get_exiftool(exiftool).get_metadata(list(fnames))
 
 
 def read_pgm(fname, byteorder='>', remove_after=False):  # pragma: no cover
@@ -0,0 +1,297 @@
+import glob
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+from pocs.utils import error
+
+# Bytes used for each frame time in the times file
+TIME_DTYPE = np.dtype('<f8')
+
+
+class LightCurveStore(object):
+
+    """ Append-only store of the photometry of each sequence
+
+    Every sequence has its own directory, `base_dir/<field_name>/<camera_uid>/<sequence_id>/`,
+    that holds:
+
+        meta.json           Number of stars, star ids and the type of each column
+        times.dat           Time of each frame (e.g. MJD) as little-endian float64
+        <column>.<n>.dat    Values of a column for block `n` of `chunk_frames` frames
+
+    Each block is a raw `num_stars` x `chunk_frames` array, star-major, so the light
+    curve of a star is a single contiguous row in each block (one read for a sequence
+    of up to `chunk_frames` frames). Blocks are memory-mapped and created full size
+    (sparse) so appending a frame only writes one value per star and column, whatever
+    the length of the sequence.
+
+    The times file is written last, so a frame only counts once all its columns are
+    on disk and an interrupted append is simply overwritten by the next one.
+
+    Args:
+        base_dir (str, optional): Directory for the store, defaults to `$PANDIR/lightcurves`
+        chunk_frames (int, optional): Frames in each block, default 512
+    """
+
+    def __init__(self, base_dir=None, chunk_frames=512):
+        if base_dir is None:
+            base_dir = os.path.join(os.getenv('PANDIR', '/var/panoptes'), 'lightcurves')
+
+        assert chunk_frames > 0, "chunk_frames must be positive"
+
+        self.base_dir = base_dir
+        self.chunk_frames = chunk_frames
+
+        self._sequences = dict()
+        self._lock = threading.Lock()
+
+    def get_path(self, field_name, camera_uid, sequence_id):
+        """ Directory holding a sequence """
+        parts = [re.sub(r'[^\w.+-]', '_', str(part)) for part in (field_name, camera_uid, sequence_id)]
+        return os.path.join(self.base_dir, *parts)
+
+    def append(self, field_name, camera_uid, sequence_id, time, table, columns=None, star_ids=None):
+        """ Add the photometry of a frame
+
+        The first frame of a sequence sets the number of stars and the columns that are
+        kept, every later frame must have the same stars in the same order.
+
+        Args:
+            field_name (str): Name of the field
+            camera_uid (str): Camera uid
+            sequence_id (str): Sequence id
+            time (float): Time of the frame, e.g. the MJD of the middle of the exposure
+            table (astropy.table.Table): Photometry for the frame, one row per star, e.g. from
+                `pocs.utils.photometry.aperture_photometry`
+            columns (list, optional): Columns to keep, defaults to all the numeric columns
+            star_ids (list, optional): Ids for the stars, only used for the first frame
+
+        Returns:
+            int: Index of the frame in the sequence
+        """
+        sequence = self._get_sequence(field_name, camera_uid, sequence_id)
+
+        with sequence.lock:
+            if not sequence.exists:
+                if columns is None:
+                    columns = [name for name in table.colnames if table[name].dtype.kind in 'iufb']
+                sequence.create(len(table), {name: table[name].dtype for name in columns}, star_ids)
+
+            return sequence.append(time, table)
+
+    def read(self, field_name, camera_uid, sequence_id, star=None, columns=None):
+        """ Read light curves
+
+        Args:
+            field_name (str): Name of the field
+            camera_uid (str): Camera uid
+            sequence_id (str): Sequence id
+            star (int, optional): Index of a single star, defaults to all stars
+            columns (list, optional): Columns to read, defaults to all of them
+
+        Returns:
+            tuple: Array of frame times and a dict of arrays for each column, with one value
+                per frame for a single `star` or `num_stars` x `num_frames` otherwise
+        """
+        sequence = self._get_sequence(field_name, camera_uid, sequence_id)
+        if not sequence.exists:
+            raise error.PanError("No light curves for {}".format(sequence.path))
+
+        return sequence.read(star=star, columns=columns)
+
+    def get_info(self, field_name, camera_uid, sequence_id):
+        """ Number of stars and frames, star ids and columns of a sequence """
+        sequence = self._get_sequence(field_name, camera_uid, sequence_id)
+        if not sequence.exists:
+            raise error.PanError("No light curves for {}".format(sequence.path))
+
+        return {
+            'num_stars': sequence.num_stars,
+            'num_frames': sequence.num_frames,
+            'star_ids': sequence.star_ids,
+            'columns': list(sequence.columns.keys()),
+        }
+
+    def list_sequences(self, field_name='*', camera_uid='*'):
+        """ Sequences in the store
+
+        Returns:
+            list: (field_name, camera_uid, sequence_id) for each sequence
+        """
+        pattern = os.path.join(self.base_dir, field_name, camera_uid, '*', 'meta.json')
+        sequences = list()
+        for meta_fname in sorted(glob.glob(pattern)):
+            sequence_dir = os.path.dirname(meta_fname)
+            camera_dir = os.path.dirname(sequence_dir)
+            sequences.append((os.path.basename(os.path.dirname(camera_dir)),
+                              os.path.basename(camera_dir),
+                              os.path.basename(sequence_dir)))
+
+        return sequences
+
+    def close(self):
+        """ Close the memory-mapped blocks of all sequences """
+        with self._lock:
+            for sequence in self._sequences.values():
+                sequence.close()
+            self._sequences.clear()
+
+    def _get_sequence(self, field_name, camera_uid, sequence_id):
+        path = self.get_path(field_name, camera_uid, sequence_id)
+
+        with self._lock:
+            if path not in self._sequences:
+                self._sequences[path] = _Sequence(path, self.chunk_frames)
+
+            sequence = self._sequences[path]
+
+        # May have been started by another process since
+        if not sequence.exists:
+            with sequence.lock:
+                sequence._load_meta()
+
+        return sequence
+
+
+class _Sequence(object):
+
+    """ Files for a single sequence, see `LightCurveStore` """
+
+    def __init__(self, path, chunk_frames):
+        self.path = path
+        self.lock = threading.RLock()
+
+        self.num_stars = None
+        self.star_ids = None
+        self.columns = None
+        self.chunk_frames = chunk_frames
+
+        self._blocks = dict()
+
+        self._load_meta()
+
+    @property
+    def exists(self):
+        return self.columns is not None
+
+    @property
+    def times_fname(self):
+        return os.path.join(self.path, 'times.dat')
+
+    @property
+    def num_frames(self):
+        try:
+            return os.path.getsize(self.times_fname) // TIME_DTYPE.itemsize
+        except OSError:
+            return 0
+
+    def create(self, num_stars, columns, star_ids=None):
+        if star_ids is not None:
+            assert len(star_ids) == num_stars, "Need an id for every star"
+            star_ids = [str(star_id) for star_id in star_ids]
+
+        self.num_stars = num_stars
+        self.star_ids = star_ids
+        self.columns = {name: np.dtype(dtype).newbyteorder('<').str for name, dtype in columns.items()}
+
+        os.makedirs(self.path, exist_ok=True)
+
+        meta = {
+            'num_stars': self.num_stars,
+            'star_ids': self.star_ids,
+            'columns': self.columns,
+            'chunk_frames': self.chunk_frames,
+        }
+
+        meta_fname = os.path.join(self.path, 'meta.json')
+        with open(meta_fname + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        os.replace(meta_fname + '.tmp', meta_fname)
+
+        open(self.times_fname, 'ab').close()
+
+    def append(self, time, table):
+        if len(table) != self.num_stars:
+            raise error.PanError("Frame has {} stars, sequence has {}".format(len(table), self.num_stars))
+
+        missing = set(self.columns) - set(table.colnames)
+        if missing:
+            raise error.PanError("Frame is missing columns: {}".format(', '.join(sorted(missing))))
+
+        frame = self.num_frames
+        chunk, index = divmod(frame, self.chunk_frames)
+
+        for name in self.columns:
+            self._get_block(name, chunk)[:, index] = np.asarray(table[name])
+
+        # Only counts as added once the time is written
+        with open(self.times_fname, 'r+b') as f:
+            f.seek(frame * TIME_DTYPE.itemsize)
+            f.write(np.array([time], dtype=TIME_DTYPE).tobytes())
+
+        return frame
+
+    def read(self, star=None, columns=None):
+        if columns is None:
+            columns = list(self.columns.keys())
+
+        unknown = set(columns) - set(self.columns)
+        if unknown:
+            raise error.PanError("Unknown columns: {}".format(', '.join(sorted(unknown))))
+
+        if star is not None and not 0 <= star < self.num_stars:
+            raise error.PanError("No star {} in sequence of {} stars".format(star, self.num_stars))
+
+        num_frames = self.num_frames
+        times = np.fromfile(self.times_fname, dtype=TIME_DTYPE, count=num_frames)
+
+        values = dict()
+        for name in columns:
+            parts = list()
+            for chunk in range((num_frames + self.chunk_frames - 1) // self.chunk_frames):
+                used = min(num_frames - chunk * self.chunk_frames, self.chunk_frames)
+                block = self._get_block(name, chunk)
+
+                if star is None:
+                    parts.append(np.array(block[:, :used]))
+                else:
+                    parts.append(np.array(block[star, :used]))
+
+            if parts:
+                values[name] = np.concatenate(parts, axis=-1)
+            elif star is None:
+                values[name] = np.empty((self.num_stars, 0), dtype=self.columns[name])
+            else:
+                values[name] = np.empty(0, dtype=self.columns[name])
+
+        return times, values
+
+    def close(self):
+        self._blocks.clear()
+
+    def _get_block(self, name, chunk):
+        key = (name, chunk)
+        if key not in self._blocks:
+            fname = os.path.join(self.path, '{}.{}.dat'.format(name, chunk))
+            mode = 'r+' if os.path.exists(fname) else 'w+'
+
+            self._blocks[key] = np.memmap(fname, dtype=self.columns[name], mode=mode,
+                                          shape=(self.num_stars, self.chunk_frames))
+
+        return self._blocks[key]
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        self.num_stars = meta['num_stars']
+        self.star_ids = meta['star_ids']
+        self.columns = meta['columns']
+        self.chunk_frames = meta['chunk_frames']
@@ -0,0 +1,211 @@
+import warnings
+
+import numpy as np
+
+from astropy.table import Table
+
+from pocs.utils import error
+
+# Bayer channels with their (row, column) offset in each 2x2 cell
+CHANNELS = [('R', 0, 0), ('G1', 0, 1), ('G2', 1, 0), ('B', 1, 1)]
+
+# Flags for the photometry of each star
+FLAG_EDGE = 1  # Aperture runs off the frame (or the position isn't known)
+FLAG_BACKGROUND = 2  # Too few pixels in the annulus for the background
+
+
+def get_aperture_weights(dx, dy, offsets, radius, subsample=5):
+    """ Fraction of each pixel inside circular apertures
+
+    Each pixel is split into `subsample` x `subsample` points and the weight is the
+    fraction of them inside the aperture. Done for every star at once.
+
+    Args:
+        dx (numpy.ndarray): Fractional x position of each star relative to the center
+            pixel of its stamp
+        dy (numpy.ndarray): Fractional y position of each star
+        offsets (numpy.ndarray): Pixel offsets of the stamp from its center pixel
+        radius (float): Aperture radius in pixels
+        subsample (int, optional): Number of points along each side of a pixel, default 5
+
+    Returns:
+        numpy.ndarray: N x size x size float32 weights
+    """
+    sub = (np.arange(subsample) + 0.5) / subsample - 0.5
+
+    # Distance along each axis from the star to each sub-pixel point: N x size x subsample
+    x = offsets[None, :, None] + sub[None, None, :] - dx[:, None, None]
+    y = offsets[None, :, None] + sub[None, None, :] - dy[:, None, None]
+
+    inside = (x[:, None, :, None, :]**2 + y[:, :, None, :, None]**2) <= radius**2
+
+    return inside.mean(axis=(3, 4), dtype=np.float32)
+
+
+def aperture_photometry(data, positions, radius=6., annulus=(10., 15.), subsample=5, gain=1.,
+                        chunk_size=500):
+    """ Aperture photometry for many stars on the separate Bayer channels
+
+    For each star and channel the flux in a circular aperture is measured with
+    sub-pixel weights and the background is the median of an annulus around it.
+    Everything is done with array operations on blocks of `chunk_size` stars at a
+    time, so thousands of stars take a few seconds.
+
+    Sizes are given in pixels of the full (Bayer) frame. Each channel has half the
+    resolution, so an aperture with a `radius` of 6 covers a radius of 3 pixels in each
+    channel.
+
+    Args:
+        data (numpy.ndarray): Raw (or calibrated) RGGB frame
+        positions (numpy.ndarray): N x 2 array of 0-based (x, y) positions on the frame
+        radius (float, optional): Aperture radius, default 6
+        annulus (tuple, optional): Inner and outer radius of the background annulus,
+            default (10, 15)
+        subsample (int, optional): Sub-pixel sampling of the aperture edge, default 5
+        gain (float, optional): Gain in e-/ADU used for the errors, default 1
+        chunk_size (int, optional): Number of stars done at once, default 500
+
+    Returns:
+        astropy.table.Table: `x`, `y`, `flags` and for each channel (e.g. `R`) the
+            background subtracted `flux_R`, its error `flux_err_R` and the background
+            per pixel `bkg_R`, along with the `flux` and `flux_err` summed over channels
+    """
+    positions = np.atleast_2d(np.asarray(positions, dtype=float))
+    assert positions.ndim == 2 and positions.shape[1] == 2, "Positions must be N x 2"
+
+    r_in, r_out = annulus
+    assert radius < r_in < r_out, "Annulus must be outside the aperture"
+
+    data = np.asarray(data)
+    num_stars = len(positions)
+
+    table = Table()
+    table['x'] = positions[:, 0]
+    table['y'] = positions[:, 1]
+    flags = np.zeros(num_stars, dtype=np.uint8)
+
+    # Stars without a position (e.g. off the WCS) are measured at the origin and blanked
+    unknown = ~np.isfinite(positions).all(axis=1)
+    if unknown.any():
+        positions = positions.copy()
+        positions[unknown] = 0
+
+    total_flux = np.zeros(num_stars)
+    total_var = np.zeros(num_stars)
+
+    for name, row, col in CHANNELS:
+        plane = data[row::2, col::2]
+
+        flux = np.empty(num_stars)
+        flux_err = np.empty(num_stars)
+        background = np.empty(num_stars)
+
+        for start in range(0, num_stars, chunk_size):
+            block = slice(start, start + chunk_size)
+
+            # Position on the channel plane, where pixel i is at 2 * i + offset on the frame
+            x = (positions[block, 0] - col) / 2
+            y = (positions[block, 1] - row) / 2
+
+            flux[block], flux_err[block], background[block], block_flags = _channel_photometry(
+                plane, x, y, radius / 2, r_in / 2, r_out / 2, subsample=subsample, gain=gain)
+            flags[block] |= block_flags
+
+        flux[unknown] = np.nan
+        flux_err[unknown] = np.nan
+        background[unknown] = np.nan
+
+        table['flux_{}'.format(name)] = flux
+        table['flux_err_{}'.format(name)] = flux_err
+        table['bkg_{}'.format(name)] = background
+
+        total_flux += flux
+        total_var += flux_err**2
+
+    flags[unknown] |= FLAG_EDGE
+
+    table['flux'] = total_flux
+    table['flux_err'] = np.sqrt(total_var)
+    table['flags'] = flags
+
+    return table
+
+
+def _channel_photometry(plane, x, y, radius, r_in, r_out, subsample=5, gain=1.):
+    """ Photometry on a single channel plane, positions and sizes in plane pixels """
+    height, width = plane.shape
+
+    half = int(np.ceil(r_out + 0.5))
+    offsets = np.arange(-half, half + 1)
+
+    x0 = np.round(x).astype(int)
+    y0 = np.round(y).astype(int)
+
+    # Stamps around each star, pixels off the plane are masked out
+    cols = x0[:, None] + offsets[None, :]
+    rows = y0[:, None] + offsets[None, :]
+    rows_on_plane = (rows >= 0) & (rows < height)
+    cols_on_plane = (cols >= 0) & (cols < width)
+    on_plane = rows_on_plane[:, :, None] & cols_on_plane[:, None, :]
+
+    stamps = plane[rows.clip(0, height - 1)[:, :, None],
+                   cols.clip(0, width - 1)[:, None, :]].astype(np.float32)
+
+    dx = x - x0
+    dy = y - y0
+
+    weights = get_aperture_weights(dx, dy, offsets, radius, subsample=subsample)
+
+    flags = np.zeros(len(x), dtype=np.uint8)
+    flags[np.any((weights > 0) & ~on_plane, axis=(1, 2))] |= FLAG_EDGE
+    weights[~on_plane] = 0
+
+    # Background from the pixels whose centers are in the annulus
+    distance = np.hypot(offsets[None, None, :] - dx[:, None, None],
+                        offsets[None, :, None] - dy[:, None, None])
+    in_annulus = (distance >= r_in) & (distance <= r_out) & on_plane
+
+    sky = np.where(in_annulus, stamps, np.nan)
+    num_sky = in_annulus.sum(axis=(1, 2))
+
+    # Stamps without any background pixels give all-NaN warnings, they are flagged below
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        background = np.nanmedian(sky.reshape(len(x), -1), axis=1)
+        sky_std = 1.4826 * np.nanmedian(np.abs(sky - background[:, None, None]).reshape(len(x), -1), axis=1)
+
+    no_sky = num_sky < 5
+    flags[no_sky] |= FLAG_BACKGROUND
+    background[no_sky] = 0
+    sky_std[no_sky] = 0
+
+    area = weights.sum(axis=(1, 2))
+    flux = (weights * stamps).sum(axis=(1, 2)) - area * background
+
+    # Poisson noise of the star, noise of the background in the aperture and the
+    # uncertainty of the background level
+    star_variance = flux.clip(min=0) / gain
+    sky_variance = area * sky_std**2
+    level_variance = np.pi / 2 * area**2 * sky_std**2 / np.maximum(num_sky, 1)
+
+    variance = star_variance + sky_variance + level_variance
+
+    return flux, np.sqrt(variance), background, flags
+
+
+def get_positions(wcs, coords):
+    """ Pixel positions of sky coordinates
+
+    Args:
+        wcs (astropy.wcs.WCS): WCS for the frame
+        coords (astropy.coordinates.SkyCoord): Positions of the stars
+
+    Returns:
+        numpy.ndarray: N x 2 array of 0-based (x, y) positions
+    """
+    if wcs is None:
+        raise error.PanError("Need a WCS to get positions from coordinates")
+
+    x, y = wcs.all_world2pix(np.atleast_1d(coords.ra.degree), np.atleast_1d(coords.dec.degree), 0)
+
+    return np.column_stack([x, y])
@@ -0,0 +1,166 @@
+import os
+
+from collections import OrderedDict
+
+import numpy as np
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Widths in pixels of the pretty images, the first is the main image
+PRETTY_SIZES = (1280, 640, 160)
+
+
+def get_rgb(data):
+    """ Color image from the raw RGGB data
+
+    Each RGGB set of pixels becomes one RGB pixel, with the two greens averaged.
+
+    Args:
+        data (numpy.ndarray): The raw RGGB data
+
+    Returns:
+        numpy.ndarray: Array of shape (ny / 2, nx / 2, 3) of float32
+    """
+    ny, nx = data.shape
+    data = data[:ny - ny % 2, :nx - nx % 2]
+
+    rgb = np.empty((ny // 2, nx // 2, 3), dtype=np.float32)
+    rgb[..., 0] = data[0::2, 0::2]
+    np.add(data[0::2, 1::2], data[1::2, 0::2], out=rgb[..., 1], dtype=np.float32)
+    rgb[..., 1] /= 2
+    rgb[..., 2] = data[1::2, 1::2]
+
+    return rgb
+
+
+def get_stretch_limits(image, low=0.5, high=99.8, sample=4):
+    """ Values that become black and white in the pretty image
+
+    Args:
+        image (numpy.ndarray): Image, e.g. from `get_rgb`
+        low (float, optional): Percentile that becomes black, default 0.5
+        high (float, optional): Percentile that becomes white, default 99.8
+        sample (int, optional): Step between the pixels used for the percentiles, default 4
+
+    Returns:
+        tuple: The black and white levels
+    """
+    vmin, vmax = np.percentile(image[::sample, ::sample], [low, high])
+
+    return vmin, vmax
+
+
+def stretch(image, vmin, vmax):
+    """ Stretch the image to 8 bits
+
+    All channels get the same asinh stretch between `vmin` and `vmax`.
+
+    Args:
+        image (numpy.ndarray): Image, e.g. from `get_rgb`
+        vmin (float): Level that becomes black
+        vmax (float): Level that becomes white
+
+    Returns:
+        numpy.ndarray: The stretched image as uint8
+    """
+    scale = max(vmax - vmin, 1e-6)
+
+    stretched = np.clip((image - vmin) / scale, 0, 1)
+    stretched = np.arcsinh(10 * stretched) / np.arcsinh(10)
+
+    return (stretched * 255).astype(np.uint8)
+
+
+def downsample(image, width):
+    """ Bin the image so it is at most `width` pixels wide
+
+    The binning factor is a whole number and the edges that don't fill a bin are dropped.
+
+    Args:
+        image (numpy.ndarray): Image of shape (ny, nx) or (ny, nx, channels)
+        width (int): Maximum width of the result
+
+    Returns:
+        numpy.ndarray: The binned image, float32
+    """
+    ny, nx = image.shape[:2]
+    binning = max(1, int(np.ceil(nx / width)))
+
+    if binning == 1:
+        return image.astype(np.float32, copy=False)
+
+    ny, nx = ny - ny % binning, nx - nx % binning
+    blocks = image[:ny, :nx].reshape((ny // binning, binning, nx // binning, binning) + image.shape[2:])
+
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def make_pretty_images(data, fname, sizes=PRETTY_SIZES, title=None, link=None):
+    """ Make pretty images at several sizes from the raw RGGB data
+
+    The data is combined to color and binned once for the largest size and each
+    smaller size is binned from the one before it, so the full frame is only
+    gone through once. The first size is written to `fname`, the others to
+    `<name>_<width>.<ext>`. Files are written under a temporary name and renamed,
+    so a reader never sees a partial image.
+
+    Args:
+        data (numpy.ndarray): The raw RGGB data, e.g. as decoded from the CR2
+        fname (str): Name of the main image, the extension gives the format (e.g. jpg, png)
+        sizes (tuple, optional): Maximum widths of the images, defaults to `PRETTY_SIZES`
+        title (str, optional): Text drawn at the bottom of each image
+        link (str, optional): Symlink that is pointed at the main image, e.g. the `latest` image
+
+    Returns:
+        OrderedDict: Filename of the image for each size
+    """
+    base, ext = os.path.splitext(fname)
+
+    # The stretch is worked out once, at the largest size
+    binned = downsample(get_rgb(data), sizes[0])
+    vmin, vmax = get_stretch_limits(binned)
+
+    outputs = OrderedDict()
+    for i, width in enumerate(sizes):
+        if i > 0:
+            binned = downsample(binned, width)
+
+        out_fname = fname if i == 0 else '{}_{}{}'.format(base, width, ext)
+        _save_image(stretch(binned, vmin, vmax), out_fname, title=title)
+
+        outputs[width] = out_fname
+
+    if link is not None:
+        update_link(fname, link)
+
+    return outputs
+
+
+def update_link(fname, link):
+    """ Atomically point the symlink `link` at `fname` """
+    tmp_link = '{}.{}.tmp'.format(link, os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+
+    os.symlink(os.path.abspath(fname), tmp_link)
+    os.replace(tmp_link, link)
+
+
+def _save_image(image, fname, title=None, dpi=100):
+    height, width = image.shape[:2]
+
+    # Draw on a figure the size of the image so there is no resampling
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    fig.figimage(image, origin='lower')
+
+    if title:
+        fig.text(0.5, 0.01, title, color='red', ha='center', va='bottom',
+                 fontsize=max(6, min(24, width // 50)))
+
+    fmt = os.path.splitext(fname)[1].lstrip('.').lower()
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+
+    fig.savefig(tmp_fname, dpi=dpi, format=fmt)
+    os.replace(tmp_fname, fname)
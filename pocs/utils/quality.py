@@ -0,0 +1,234 @@
+import glob
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from astropy.io import fits
+
+from pocs.utils import sources as source_utils
+from pocs.utils.images import bin_data
+
+
+def get_source_shapes(data, sources, box_width=15, background=0., iters=10):
+    """ Size and shape of sources from adaptive second moments
+
+    The moments of each source are measured with a round Gaussian weight whose size is
+    matched to the source, which keeps the noise in the wings from swamping the
+    measurement. For a Gaussian source the weighted moments along each axis are then
+    corrected exactly for the weight. All sources are done at once.
+
+    Args:
+        data (numpy.ndarray): Image data
+        sources (astropy.table.Table): Sources with `x` and `y` columns, see
+            `pocs.utils.sources.detect_sources`
+        box_width (int, optional): Width of the box around each source in pixels, default 15
+        background (float, optional): Background level to subtract, default 0
+        iters (int, optional): Number of iterations matching the weight, default 10
+
+    Returns:
+        dict: Arrays of the `fwhm` (pixels, geometric mean of the two axes), `ellipticity`
+            (1 - minor / major axis) and position angle `theta` (degrees, counter-clockwise
+            from the x axis) of each source. Sources that couldn't be measured are NaN.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    height, width = data.shape
+    half = box_width // 2
+    offsets = np.arange(-half, half + 1)
+
+    x = np.asarray(sources['x'], dtype=float)
+    y = np.asarray(sources['y'], dtype=float)
+
+    x0 = np.round(x).astype(int).clip(half, width - half - 1)
+    y0 = np.round(y).astype(int).clip(half, height - half - 1)
+
+    stamps = data[y0[:, None, None] + offsets[None, :, None],
+                  x0[:, None, None] + offsets[None, None, :]] - background
+
+    dx = (x0 - x)[:, None, None] + offsets[None, None, :]
+    dy = (y0 - y)[:, None, None] + offsets[None, :, None]
+    r2 = dx**2 + dy**2
+
+    # Start with a weight of a few pixels and match it to the size of each source
+    s2 = np.full(len(x), 2.)
+    for _ in range(iters):
+        weight_s2 = s2
+        weighted = stamps * np.exp(-r2 / (2 * weight_s2[:, None, None]))
+        norm = weighted.sum(axis=(1, 2))
+        norm[norm <= 0] = np.nan
+
+        mxx = (weighted * dx**2).sum(axis=(1, 2)) / norm
+        myy = (weighted * dy**2).sum(axis=(1, 2)) / norm
+        mxy = (weighted * dx * dy).sum(axis=(1, 2)) / norm
+
+        # For a round Gaussian the weighted second moment is half its variance when the
+        # weight matches it
+        s2 = (mxx + myy).clip(0.25, (half / 2.)**2)
+        s2[~np.isfinite(s2)] = 2.
+
+    # Moments along the principal axes, corrected for the weight
+    mean = (mxx + myy) / 2
+    diff = np.sqrt(((mxx - myy) / 2)**2 + mxy**2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        major = mean + diff
+        minor = mean - diff
+
+        var_major = major * weight_s2 / (weight_s2 - major)
+        var_minor = minor * weight_s2 / (weight_s2 - minor)
+
+        bad = ~((var_minor > 0) & (var_major > 0) & (major < weight_s2))
+        var_major[bad] = np.nan
+        var_minor[bad] = np.nan
+
+        fwhm = 2.3548 * (var_major * var_minor)**0.25
+        ellipticity = 1 - np.sqrt(var_minor / var_major)
+
+    theta = np.degrees(0.5 * np.arctan2(2 * mxy, mxx - myy))
+
+    return {
+        'fwhm': fwhm,
+        'ellipticity': ellipticity,
+        'theta': theta,
+    }
+
+
+def get_image_quality(data, num_sources=200, threshold=5., box_width=15):
+    """ Quality measures for an image
+
+    Args:
+        data (numpy.ndarray): Image data, usually the luminance plane
+        num_sources (int, optional): Number of the brightest sources to measure, default 200
+        threshold (float, optional): Detection threshold in units of the noise, default 5
+        box_width (int, optional): Width of the box used to measure each source, default 15
+
+    Returns:
+        dict: `background` level and `noise`, number of stars found `num_stars` (at most
+            `num_sources`), and the median `fwhm` (pixels), `ellipticity` and `theta`
+            (degrees) of the stars
+    """
+    background, noise = source_utils.get_background(data)
+
+    found = source_utils.detect_sources(data,
+                                        num_sources=num_sources,
+                                        threshold=threshold,
+                                        background=(background, noise))
+
+    quality = {
+        'background': background,
+        'noise': noise,
+        'num_stars': len(found),
+        'fwhm': np.nan,
+        'ellipticity': np.nan,
+        'theta': np.nan,
+    }
+
+    if len(found):
+        shapes = get_source_shapes(data, found, box_width=box_width, background=background)
+
+        good = np.isfinite(shapes['fwhm'])
+        if good.any():
+            quality['fwhm'] = float(np.median(shapes['fwhm'][good]))
+            quality['ellipticity'] = float(np.median(shapes['ellipticity'][good]))
+
+            # Angles wrap at 180 degrees, so take the median of the doubled angle
+            theta = np.radians(2 * shapes['theta'][good])
+            quality['theta'] = float(np.degrees(np.arctan2(np.median(np.sin(theta)),
+                                                           np.median(np.cos(theta)))) / 2)
+
+    return quality
+
+
+def measure_image(fits_fname, binning=2, **kwargs):
+    """ Quality measures for a FITS file
+
+    The measures are made on the luminance plane, made by binning the Bayer data (see
+    `pocs.utils.images.bin_data`). The FWHM is given in pixels of the full frame.
+
+    Args:
+        fits_fname (str): Name of FITS file, which may be compressed
+        binning (int, optional): Binning for the luminance plane, default 2
+        **kwargs: Options for `get_image_quality`
+
+    Returns:
+        dict: See `get_image_quality`, along with the `file` and the `elapsed` seconds
+    """
+    start_time = time.time()
+
+    with fits.open(fits_fname) as hdu_list:
+        hdu = hdu_list[0] if hdu_list[0].data is not None else hdu_list[1]
+        data = hdu.data
+
+        if binning > 1:
+            data = bin_data(data, binning, np.float32, average=True)
+
+        quality = get_image_quality(data, **kwargs)
+
+    quality['fwhm'] *= binning
+    quality['file'] = fits_fname
+    quality['elapsed'] = time.time() - start_time
+
+    return quality
+
+
+def check_quality(quality, min_stars=10, max_fwhm=None, max_ellipticity=0.5):
+    """ Problems that make a frame not worth plate-solving
+
+    Args:
+        quality (dict): Measures from `measure_image` or `get_image_quality`
+        min_stars (int, optional): Fewest stars for a usable frame (e.g. clouds), default 10
+        max_fwhm (float, optional): Largest median FWHM in pixels (e.g. out of focus),
+            default None to not check
+        max_ellipticity (float, optional): Largest median ellipticity (e.g. trailing),
+            default 0.5
+
+    Returns:
+        list: Descriptions of the problems, empty for a good frame
+    """
+    problems = list()
+
+    if quality['num_stars'] < min_stars:
+        problems.append("only {} stars".format(quality['num_stars']))
+
+    if quality['num_stars'] and not np.isfinite(quality['fwhm']):
+        problems.append("star sizes couldn't be measured")
+
+    if max_fwhm is not None and quality['fwhm'] > max_fwhm:
+        problems.append("FWHM {:.02f} pixels".format(quality['fwhm']))
+
+    if max_ellipticity is not None and quality['ellipticity'] > max_ellipticity:
+        problems.append("ellipticity {:.02f}".format(quality['ellipticity']))
+
+    return problems
+
+
+def measure_directory(directory, pattern='*.fits*', workers=None, **kwargs):
+    """ Quality measures for all the FITS files in a directory
+
+    Files are measured on a pool of `workers` processes.
+
+    Args:
+        directory (str): Directory of FITS files
+        pattern (str, optional): Pattern for the files, default '*.fits*'
+        workers (int, optional): Number of processes, defaults to the number of cores
+        **kwargs: Options for `measure_image`
+
+    Returns:
+        list: Results of `measure_image` for each file in name order, with an `error`
+            entry (and no measures) for files that couldn't be read
+    """
+    fnames = sorted(glob.glob(os.path.join(directory, pattern)))
+
+    results = list()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(measure_image, fname, **kwargs) for fname in fnames]
+
+        for fname, future in zip(fnames, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'file': fname, 'error': str(e)})
+
+    return results
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from astropy.io import fits
+
+# Header cards written by astrometry.net that describe the solution
+WCS_KEYWORDS = re.compile(r'^(WCSAXES|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|CDELT\d|CD\d_\d|PC\d_\d|'
+                          r'LONPOLE|LATPOLE|EQUINOX|RADESYS|IMAGEW|IMAGEH|'
+                          r'A_ORDER|B_ORDER|AP_ORDER|BP_ORDER|A_\d+_\d+|B_\d+_\d+|AP_\d+_\d+|BP_\d+_\d+)$')
+
+# Hint options that change the result of a solve
+HINT_KEYWORDS = ['ra', 'dec', 'radius', 'solve_opts']
+
+
+class SolveCache(object):
+
+    """ Persistent cache of plate solve results
+
+    Results are stored in a SQLite database, keyed by a hash of the pixel data and the
+    hints given to the solver (see `get_solve_key`), so a frame is only solved once no
+    matter what the file is called or where it lives. Each entry holds the WCS header
+    cards from the solved file along with a dict of solve metadata.
+
+    Once the cache holds more than `max_entries` results the least recently used ones
+    are removed.
+
+    A new connection is made for every call so the cache can be used from several
+    threads and processes (e.g. the workers of a `SolverPool`) at once.
+
+    Args:
+        db_file (str, optional): Path to the database, defaults to
+            `$PANDIR/cache/solve_cache.sqlite`
+        max_entries (int, optional): Number of results to keep, defaults to 10000
+    """
+
+    def __init__(self, db_file=None, max_entries=10000):
+        if db_file is None:
+            db_file = os.path.join(os.getenv('PANDIR', '/var/panoptes'), 'cache', 'solve_cache.sqlite')
+
+        assert max_entries > 0, "max_entries must be positive"
+
+        self.db_file = db_file
+        self.max_entries = max_entries
+
+        db_dir = os.path.dirname(self.db_file)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS solves (
+                                key TEXT PRIMARY KEY,
+                                header TEXT NOT NULL,
+                                info TEXT NOT NULL,
+                                created REAL NOT NULL,
+                                accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS solves_accessed ON solves (accessed)")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM solves").fetchone()[0]
+
+    def __contains__(self, key):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM solves WHERE key=?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        """ Look up a solve result
+
+        Args:
+            key (str): Key from `get_solve_key`
+
+        Returns:
+            tuple: The WCS cards as an `astropy.io.fits.Header` and the dict of solve
+                metadata, or None if `key` isn't in the cache
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT header, info FROM solves WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            conn.execute("UPDATE solves SET accessed=? WHERE key=?", (time.time(), key))
+
+        return fits.Header.fromstring(row[0]), json.loads(row[1])
+
+    def put(self, key, header, info=None):
+        """ Store a solve result
+
+        Args:
+            key (str): Key from `get_solve_key`
+            header (astropy.io.fits.Header): Header of the solved file, only the WCS cards
+                are kept
+            info (dict, optional): Metadata for the solve, must be JSON serializable
+        """
+        wcs_header = get_wcs_cards(header)
+        now = time.time()
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO solves VALUES (?, ?, ?, ?, ?)",
+                         (key, wcs_header.tostring(), json.dumps(info or {}), now, now))
+            self._evict(conn)
+
+    def remove(self, key):
+        """ Remove a solve result """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM solves WHERE key=?", (key,))
+
+    def clear(self):
+        """ Remove all solve results """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM solves")
+
+    def _evict(self, conn):
+        conn.execute("""DELETE FROM solves WHERE key NOT IN
+                            (SELECT key FROM solves ORDER BY accessed DESC LIMIT ?)""",
+                     (self.max_entries,))
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def get_solve_key(fname, **kwargs):
+    """ Get the cache key for solving a FITS file
+
+    The key is a SHA1 of the raw (unscaled) pixel data, so it does not change when
+    the header is rewritten, along with the hints from `HINT_KEYWORDS` found in `kwargs`.
+
+    Args:
+        fname (str): Name of FITS file
+        **kwargs: Options being passed to the solver
+
+    Returns:
+        str: Hex digest to use as the cache key
+    """
+    with fits.open(fname, do_not_scale_image_data=True) as hdu_list:
+        hdu = hdu_list[0] if hdu_list[0].data is not None else hdu_list[1]
+        data = np.ascontiguousarray(hdu.data)
+
+        sha = hashlib.sha1(data.reshape(-1).view(np.uint8))
+        sha.update(str((data.dtype.str, data.shape)).encode('utf-8'))
+
+    hints = list()
+    for keyword in HINT_KEYWORDS:
+        value = kwargs.get(keyword)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = round(float(value), 6)
+        elif isinstance(value, (list, tuple)):
+            value = list(value)
+        hints.append((keyword, value))
+
+    sha.update(json.dumps(hints).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def get_wcs_cards(header):
+    """ Get the cards from `header` that make up the plate solution """
+    return fits.Header([card for card in header.cards if WCS_KEYWORDS.match(card.keyword)])
+
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+def get_solve_cache(db_file=None, max_entries=10000):
+    """ Get the shared `SolveCache` for `db_file`, creating it if needed """
+    with _caches_lock:
+        if db_file not in _caches:
+            _caches[db_file] = SolveCache(db_file=db_file, max_entries=max_entries)
+
+        return _caches[db_file]
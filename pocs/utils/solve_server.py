@@ -0,0 +1,302 @@
+import glob
+import json
+import mmap
+import os
+import queue
+import threading
+import zmq
+
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+
+from pocs.utils import error
+from pocs.utils.images import get_solve_field
+
+DEFAULT_ADDRESS = 'ipc:///tmp/pocs_solver'
+
+
+class SolveFieldBackend(object):
+
+    """ Solve with astrometry.net, keeping the index files warm in the page cache
+
+    The index files are memory-mapped and read once when the backend starts,
+    and stay mapped for as long as it runs. Each solve is still a `solve-field`
+    run (see `pocs.utils.images.get_solve_field`) that opens and reads the index
+    files itself, but those reads are usually served from the page cache
+    rather than the disk. Nothing is locked in memory, so the kernel can still
+    evict the pages when memory is short.
+
+    Args:
+        index_dir (str, optional): Folder with the `index-*.fits` files, defaults
+            to `$PANDIR/astrometry/data` (see `pocs.utils.data`)
+    """
+
+    def __init__(self, index_dir=None):
+        if index_dir is None:
+            index_dir = "{}/astrometry/data".format(os.getenv('PANDIR'))
+
+        self.index_dir = index_dir
+        self._maps = dict()
+
+    @property
+    def index_files(self):
+        """ Names of the index files that are mapped """
+        return sorted(self._maps)
+
+    def start(self):
+        """ Map the index files and read them so they are in the page cache """
+        for fname in sorted(glob.glob('{}/index-*.fits'.format(self.index_dir))):
+            if fname in self._maps:
+                continue
+
+            with open(fname, 'rb') as f:
+                index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            # Touch every page so the data is loaded now rather than on the first solve
+            for i in range(0, len(index_map), mmap.PAGESIZE):
+                index_map[i]
+
+            self._maps[fname] = index_map
+
+    def stop(self):
+        """ Unmap the index files """
+        for index_map in self._maps.values():
+            index_map.close()
+
+        self._maps.clear()
+
+    def solve(self, fname, **kwargs):
+        return get_solve_field(fname, **kwargs)
+
+
+class FakeSolverBackend(object):
+
+    """ Backend that pretends to solve, for testing without astrometry.net
+
+    Each solve writes the `.solved` marker next to the file and, if given, the
+    `wcs` header cards into it, then returns the header like `get_solve_field`.
+    Files whose names are in `fail` raise `SolveError` instead.
+
+    Args:
+        wcs (dict, optional): Header cards written into each solved file
+        fail (list, optional): Names of files that can't be solved
+    """
+
+    def __init__(self, wcs=None, fail=None):
+        self.wcs = wcs or dict()
+        self.fail = set(fail or [])
+        self.calls = list()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def solve(self, fname, **kwargs):
+        self.calls.append((fname, kwargs))
+
+        if fname in self.fail:
+            raise error.SolveError('File not solved')
+
+        if self.wcs:
+            with fits.open(fname, 'update') as hdu_list:
+                hdu_list[0].header.update(self.wcs)
+
+        with open(fname.replace('.fits', '.solved'), 'wb') as f:
+            f.write(b'\x01')
+
+        out_dict = {'solved_fits_file': fname}
+        out_dict.update(fits.getheader(fname))
+
+        return out_dict
+
+
+class SolverServer(object):
+
+    """ Long-lived plate solving service
+
+    Requests are JSON messages on a ZMQ socket (see `SolverClient`), so the
+    `backend` and whatever it keeps in memory are shared by every solve. Up to
+    `max_workers` solves run at once.
+
+    Requests are `{"command": "solve", "fname": ..., "kwargs": {...}}` or
+    `{"command": "ping"}`. Replies are `{"result": ...}`, or `{"error": ...,
+    "message": ...}` with the name of the exception if the solve failed.
+
+    Args:
+        address (str, optional): ZMQ address to bind to, defaults to `DEFAULT_ADDRESS`
+        backend (optional): Object with `start`, `stop` and `solve(fname, **kwargs)`,
+            defaults to a `SolveFieldBackend`
+        max_workers (int, optional): Number of solves to run at once, defaults to
+            the number of cores
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, backend=None, max_workers=None):
+        if backend is None:
+            backend = SolveFieldBackend()
+
+        self.address = address
+        self.backend = backend
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+        self._replies = queue.Queue()
+        self._running = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def is_running(self):
+        return self._running.is_set()
+
+    def run(self):
+        """ Serve requests until `stop` is called """
+        context = zmq.Context()
+        socket = context.socket(zmq.ROUTER)
+        socket.bind(self.address)
+
+        self.backend.start()
+        self._stopped.clear()
+        self._running.set()
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while self._running.is_set():
+                if socket.poll(50):
+                    identity, empty, payload = socket.recv_multipart()
+                    self._handle(executor, identity, payload)
+
+                while not self._replies.empty():
+                    identity, reply = self._replies.get()
+                    socket.send_multipart([identity, b'', _dumps(reply)])
+        finally:
+            executor.shutdown(wait=False)
+            self.backend.stop()
+            socket.close(linger=0)
+            context.term()
+            self._stopped.set()
+
+    def start(self):
+        """ Run the server on a background thread
+
+        Returns:
+            threading.Thread: The server thread
+        """
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        self._running.wait(timeout=10)
+
+        return thread
+
+    def stop(self, wait=True):
+        """ Stop serving requests """
+        self._running.clear()
+        if wait:
+            self._stopped.wait(timeout=10)
+
+    def _handle(self, executor, identity, payload):
+        try:
+            request = json.loads(payload.decode('utf-8'))
+            command = request.get('command')
+        except Exception as e:
+            self._replies.put((identity, {'error': 'InvalidCommand', 'message': str(e)}))
+            return
+
+        if command == 'ping':
+            self._replies.put((identity, {'result': 'pong'}))
+        elif command == 'solve':
+            executor.submit(self._solve, identity, request['fname'], request.get('kwargs', {}))
+        else:
+            self._replies.put((identity, {'error': 'InvalidCommand',
+                                          'message': 'Unknown command: {}'.format(command)}))
+
+    def _solve(self, identity, fname, kwargs):
+        try:
+            reply = {'result': self.backend.solve(fname, **kwargs)}
+        except Exception as e:
+            reply = {'error': e.__class__.__name__, 'message': getattr(e, 'msg', str(e))}
+
+        self._replies.put((identity, reply))
+
+
+class SolverClient(object):
+
+    """ Client for a `SolverServer`
+
+    `get_solve_field` takes the same arguments as `pocs.utils.images.get_solve_field`,
+    so it can be used wherever that is, e.g. as the `solve_func` of a `SolverPool`.
+    Clients can be pickled, each process opens its own connection.
+
+    Args:
+        address (str, optional): ZMQ address of the server, defaults to `DEFAULT_ADDRESS`
+        timeout (float, optional): Seconds to wait for a reply on top of the solve
+            `timeout`, defaults to 10
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=10):
+        self.address = address
+        self.timeout = timeout
+
+        self._context = None
+        self._socket = None
+
+    def __getstate__(self):
+        return {'address': self.address, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def ping(self, timeout=None):
+        """ Check that the server is running
+
+        Returns:
+            bool: True if the server replied within `timeout` seconds
+        """
+        try:
+            return self._request({'command': 'ping'}, timeout or self.timeout) == 'pong'
+        except error.Timeout:
+            return False
+
+    def get_solve_field(self, fname, **kwargs):
+        """ Solve `fname` on the server, see `pocs.utils.images.get_solve_field`
+
+        Raises:
+            error.SolveError: If the file could not be solved
+            error.Timeout: If the server did not reply in time
+        """
+        request = {'command': 'solve', 'fname': os.path.abspath(fname), 'kwargs': kwargs}
+
+        return self._request(request, kwargs.get('timeout', 30) + self.timeout)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close(linger=0)
+            self._socket = None
+
+    def _request(self, request, timeout):
+        if self._socket is None:
+            if self._context is None:
+                self._context = zmq.Context.instance()
+            self._socket = self._context.socket(zmq.REQ)
+            self._socket.connect(self.address)
+
+        self._socket.send(_dumps(request))
+
+        if not self._socket.poll(timeout * 1000):
+            # A REQ socket can't send again until it gets a reply, so start over
+            self.close()
+            raise error.Timeout("No reply from solver at {}".format(self.address))
+
+        reply = json.loads(self._socket.recv().decode('utf-8'))
+
+        if 'error' in reply:
+            if reply['error'] == 'SolveError':
+                raise error.SolveError(reply['message'])
+            raise error.PanError("{}: {}".format(reply['error'], reply['message']))
+
+        return reply['result']
+
+
+def _dumps(message):
+    # Header values such as COMMENT cards aren't JSON types, send them as strings
+    return json.dumps(message, default=str).encode('utf-8')
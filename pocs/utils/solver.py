@@ -0,0 +1,128 @@
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from pocs.utils.images import get_solve_field
+
+
+class SolverPool(object):
+
+    """ Run plate solves on a pool of worker processes
+
+    Solve jobs are queued with `submit`, which returns immediately with a
+    `concurrent.futures.Future` for the result of `get_solve_field`. At most
+    `max_workers` solves run at once, the rest wait in the queue. Jobs that
+    have not started can be cancelled with `Future.cancel` (or `cancel_all`).
+
+    Submitting a file that is already queued or being solved returns the
+    existing future rather than solving it twice.
+
+    Args:
+        max_workers (int, optional): Number of solves to run at once, defaults
+            to the number of cores
+        solve_func (callable, optional): Function used to do the solving,
+            defaults to `pocs.utils.images.get_solve_field`
+    """
+
+    def __init__(self, max_workers=None, solve_func=get_solve_field):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        self.max_workers = max_workers
+        self.solve_func = solve_func
+
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def jobs(self):
+        """ Futures for the jobs that are queued or running, by filename """
+        with self._lock:
+            self._remove_finished()
+            return OrderedDict(self._jobs)
+
+    def submit(self, fname, ra=None, dec=None, radius=15, timeout=30, **kwargs):
+        """ Add a solve job to the queue
+
+        Args:
+            fname (str): Name of FITS file to solve
+            ra (float, optional): RA hint in degrees
+            dec (float, optional): Dec hint in degrees
+            radius (float, optional): Search radius around the hint in degrees,
+                defaults to 15
+            timeout (int, optional): Seconds before the solve is killed, defaults to 30
+            **kwargs: Other options for `get_solve_field`
+
+        Returns:
+            concurrent.futures.Future: Future for the result of the solve
+        """
+        if ra is not None:
+            kwargs['ra'] = ra
+        if dec is not None:
+            kwargs['dec'] = dec
+
+        kwargs['radius'] = radius
+        kwargs['timeout'] = timeout
+
+        with self._lock:
+            self._remove_finished()
+
+            if fname in self._jobs:
+                return self._jobs[fname]
+
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+            future = self._executor.submit(self.solve_func, fname, **kwargs)
+            self._jobs[fname] = future
+
+        return future
+
+    def solve(self, fname, wait=None, **kwargs):
+        """ Submit a solve job and wait for the result
+
+        Args:
+            fname (str): Name of FITS file to solve
+            wait (int, optional): Seconds to wait for the result, defaults to
+                waiting until it is done
+            **kwargs: Options for `submit`
+
+        Returns:
+            dict: The result of the solve
+
+        Raises:
+            concurrent.futures.TimeoutError: If the result is not ready within `wait`
+        """
+        return self.submit(fname, **kwargs).result(timeout=wait)
+
+    def cancel_all(self):
+        """ Cancel all jobs that have not started yet
+
+        Returns:
+            int: Number of jobs cancelled
+        """
+        with self._lock:
+            num_cancelled = sum(future.cancel() for future in self._jobs.values())
+            self._remove_finished()
+
+        return num_cancelled
+
+    def shutdown(self, wait=True):
+        """ Cancel queued jobs and stop the worker processes
+
+        Args:
+            wait (bool, optional): Wait for running jobs to finish, defaults to True
+        """
+        self.cancel_all()
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _remove_finished(self):
+        for fname in [f for f, future in self._jobs.items() if future.done()]:
+            del self._jobs[fname]
@@ -0,0 +1,296 @@
+import numpy as np
+
+from astropy import units as u
+from astropy.table import Table
+
+from pocs.utils import error
+
+
+def get_background(data, step=4):
+    """ Estimate the background level and noise of an image
+
+    Uses the median and the median absolute deviation of every `step`-th pixel,
+    which is plenty for the large frames from the cameras.
+
+    Args:
+        data (numpy.ndarray): Image data
+        step (int, optional): Sample every `step` pixels in each direction, default 4
+
+    Returns:
+        tuple: Background level and noise (standard deviation)
+    """
+    sample = np.asarray(data)[::step, ::step]
+    if sample.size < 100:
+        sample = np.asarray(data)
+
+    sample = sample.astype(np.float32).ravel()
+
+    background = np.median(sample)
+    noise = 1.4826 * np.median(np.abs(sample - background))
+
+    if noise == 0:
+        noise = sample.std() or 1.
+
+    return float(background), float(noise)
+
+
+def detect_sources(data, num_sources=50, threshold=5., box_width=9, background=None):
+    """ Find the brightest point sources in an image
+
+    Sources are local maxima more than `threshold` times the noise above the background.
+    Only the brightest peak within a box of `box_width` pixels is kept and its position is
+    the Gaussian-weighted centroid of the background-subtracted box. Everything is done with array
+    operations on the whole frame, so detection on a luminance frame takes well under
+    a second.
+
+    Args:
+        data (numpy.ndarray): Image data, usually the luminance plane (see `Image.luminance`)
+        num_sources (int, optional): Maximum number of sources to return, default 50
+        threshold (float, optional): Detection threshold in units of the noise, default 5
+        box_width (int, optional): Width in pixels of the box used for the centroid, default 9
+        background (tuple, optional): Background level and noise, see `get_background`
+
+    Returns:
+        astropy.table.Table: Sources with `x`, `y`, `flux` and `peak` columns, brightest first.
+            Positions are 0-based pixel coordinates.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    assert data.ndim == 2, "Data must be 2-D"
+
+    half = box_width // 2
+
+    if background is None:
+        background = get_background(data)
+    level, noise = background
+
+    # Local maxima: compare each pixel to its 8 neighbours. Neighbours that come first in
+    # raster order must be strictly lower so plateaus only give a single peak.
+    core = data[1:-1, 1:-1]
+    height, width = data.shape
+
+    peaks = core > level + threshold * noise
+    for dy, dx in [(-1, -1), (-1, 0), (-1, 1), (0, -1)]:
+        peaks &= core > data[1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+    for dy, dx in [(0, 1), (1, -1), (1, 0), (1, 1)]:
+        peaks &= core >= data[1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+
+    y, x = np.nonzero(peaks)
+    y += 1
+    x += 1
+
+    # Room for the centroid box
+    keep = (x >= half) & (x < width - half) & (y >= half) & (y < height - half)
+    x = x[keep]
+    y = y[keep]
+
+    peak = data[y, x]
+    order = np.argsort(peak)[::-1]
+
+    # Drop fainter peaks that fall in the box of a brighter one (e.g. saturated or
+    # double stars). Only the brightest candidates are considered.
+    selected = list()
+    for i in order[:20 * num_sources]:
+        if selected:
+            close = (np.abs(x[selected] - x[i]) <= half) & (np.abs(y[selected] - y[i]) <= half)
+            if close.any():
+                continue
+
+        selected.append(i)
+        if len(selected) == num_sources:
+            break
+
+    x = x[selected]
+    y = y[selected]
+    peak = peak[selected]
+
+    # Centroid all boxes at once
+    offsets = np.arange(-half, half + 1)
+    stamps = data[y[:, None, None] + offsets[None, :, None],
+                  x[:, None, None] + offsets[None, None, :]] - level
+
+    flux = stamps.clip(min=0).sum(axis=(1, 2))
+    flux[flux == 0] = 1.
+
+    x_centroid = x + (stamps.clip(min=0) * offsets[None, None, :]).sum(axis=(1, 2)) / flux
+    y_centroid = y + (stamps.clip(min=0) * offsets[None, :, None]).sum(axis=(1, 2)) / flux
+
+    # Plain moments are pulled towards the peak pixel and are noisy in the wings, so
+    # refine with a Gaussian-weighted ("windowed") centroid
+    sigma = box_width / 6.
+    for _ in range(5):
+        dx = (x[:, None, None] + offsets[None, None, :]) - x_centroid[:, None, None]
+        dy = (y[:, None, None] + offsets[None, :, None]) - y_centroid[:, None, None]
+
+        weighted = stamps * np.exp(-(dx**2 + dy**2) / (2 * sigma**2))
+        total = weighted.sum(axis=(1, 2))
+        total[total <= 0] = np.inf
+
+        x_centroid = x_centroid + 2 * (weighted * dx).sum(axis=(1, 2)) / total
+        y_centroid = y_centroid + 2 * (weighted * dy).sum(axis=(1, 2)) / total
+
+    # Keep positions that wandered off (e.g. in crowded boxes) at the peak
+    lost = (np.abs(x_centroid - x) > half) | (np.abs(y_centroid - y) > half)
+    x_centroid[lost] = x[lost]
+    y_centroid[lost] = y[lost]
+
+    return Table([x_centroid, y_centroid, flux, peak - level], names=['x', 'y', 'flux', 'peak'])
+
+
+def match_sources(sources, ref_sources, tolerance=3., max_shift=None):
+    """ Match sources to those found in a reference image
+
+    The shift between the images is found by voting: the offsets between every pair of
+    sources are binned and the most common one is taken. Sources are then paired with
+    their nearest reference source after removing that shift, keeping only pairs that
+    are mutual nearest neighbours within `tolerance` pixels.
+
+    Small rotations (up to about `tolerance` pixels at the edge of the source list)
+    are handled, larger ones need a looser `tolerance`.
+
+    Args:
+        sources (astropy.table.Table): Sources from `detect_sources`
+        ref_sources (astropy.table.Table): Sources from the reference image
+        tolerance (float, optional): Matching distance in pixels, default 3
+        max_shift (float, optional): Ignore shifts larger than this many pixels
+
+    Returns:
+        tuple: Arrays of indices into `sources` and `ref_sources` for the matched pairs
+    """
+    xy = np.column_stack([sources['x'], sources['y']])
+    ref_xy = np.column_stack([ref_sources['x'], ref_sources['y']])
+
+    if len(xy) == 0 or len(ref_xy) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    # Vote on the shift between every pair of sources
+    pair_offsets = (xy[:, None, :] - ref_xy[None, :, :]).reshape(-1, 2)
+    if max_shift is not None:
+        pair_offsets = pair_offsets[np.hypot(*pair_offsets.T) <= max_shift]
+
+    if len(pair_offsets) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    bins = np.floor(pair_offsets / (2 * tolerance)).astype(int)
+    bins -= bins.min(axis=0)
+    bin_index = bins[:, 0] * (bins[:, 1].max() + 1) + bins[:, 1]
+
+    _, inverse, counts = np.unique(bin_index, return_inverse=True, return_counts=True)
+    best = pair_offsets[inverse == np.argmax(counts)].mean(axis=0)
+
+    # The best shift may straddle two bins, so refine it with all the nearby pairs
+    nearby = np.hypot(*(pair_offsets - best).T) <= 2 * tolerance
+    shift = np.median(pair_offsets[nearby], axis=0)
+
+    # Mutual nearest neighbours once the shift is removed
+    distance = np.hypot(*(xy[:, None, :] - shift - ref_xy[None, :, :]).transpose(2, 0, 1))
+    nearest_ref = distance.argmin(axis=1)
+    nearest = distance.argmin(axis=0)
+
+    idx = np.arange(len(xy))
+    matched = (nearest[nearest_ref] == idx) & (distance[idx, nearest_ref] <= tolerance)
+
+    return idx[matched], nearest_ref[matched]
+
+
+def fit_shift_rotation(xy, ref_xy, center=(0, 0)):
+    """ Fit a shift and rotation between matched positions
+
+    Finds the rotation matrix `R` and translation `t` minimizing the distance between
+    `xy` and `R . ref_xy + t`.
+
+    Args:
+        xy (numpy.ndarray): N x 2 positions in the image
+        ref_xy (numpy.ndarray): N x 2 matching positions in the reference image
+        center (tuple, optional): Point at which to report the shift, e.g. the center
+            of the image, default (0, 0)
+
+    Returns:
+        dict: `X` and `Y` shift of `center` (pixels), rotation `angle` (degrees),
+            `rms` of the residuals (pixels), `matrix` and `translation` of the transform
+    """
+    xy = np.asarray(xy, dtype=float)
+    ref_xy = np.asarray(ref_xy, dtype=float)
+
+    assert len(xy) == len(ref_xy), "Positions must be matched"
+    if len(xy) < 2:
+        raise error.PanError("Need at least two matched sources to fit rotation")
+
+    mean = xy.mean(axis=0)
+    ref_mean = ref_xy.mean(axis=0)
+
+    cov = (ref_xy - ref_mean).T.dot(xy - mean)
+    angle = np.arctan2(cov[0, 1] - cov[1, 0], cov[0, 0] + cov[1, 1])
+
+    matrix = np.array([[np.cos(angle), -np.sin(angle)],
+                       [np.sin(angle), np.cos(angle)]])
+    translation = mean - matrix.dot(ref_mean)
+
+    residuals = xy - (ref_xy.dot(matrix.T) + translation)
+    center = np.asarray(center, dtype=float)
+    shift = matrix.dot(center) + translation - center
+
+    return {
+        'X': shift[0] * u.pixel,
+        'Y': shift[1] * u.pixel,
+        'angle': (angle * u.radian).to(u.degree),
+        'rms': np.sqrt((residuals**2).sum(axis=1).mean()) * u.pixel,
+        'matrix': matrix,
+        'translation': translation,
+    }
+
+
+def to_reference(xy, fit):
+    """ Map image positions to the reference image with the transform from `fit_shift_rotation` """
+    xy = np.atleast_2d(np.asarray(xy, dtype=float))
+
+    return (xy - fit['translation']).dot(fit['matrix'])
+
+
+def compute_centroid_offset(data, ref_sources, num_sources=50, tolerance=3., min_matches=5,
+                            center=None, max_shift=None, **kwargs):
+    """ Get the shift and rotation of an image relative to a reference from star centroids
+
+    This is a much faster alternative to plate-solving every frame when only the drift
+    from a reference frame is needed.
+
+    Args:
+        data (numpy.ndarray): Image data, usually the luminance plane
+        ref_sources (astropy.table.Table): Sources found in the reference image
+        num_sources (int, optional): Number of sources to detect, default 50
+        tolerance (float, optional): Matching distance in pixels, default 3
+        min_matches (int, optional): Minimum number of matched sources, default 5
+        center (tuple, optional): Point at which to report the shift, defaults to the
+            center of `data`
+        max_shift (float, optional): Largest shift to consider in pixels
+        **kwargs: Passed to `detect_sources`
+
+    Returns:
+        dict: See `fit_shift_rotation`, also with the number of `matches`
+
+    Raises:
+        pocs.utils.error.PanError: If too few sources could be matched
+    """
+    if center is None:
+        center = ((data.shape[1] - 1) / 2, (data.shape[0] - 1) / 2)
+
+    sources = detect_sources(data, num_sources=num_sources, **kwargs)
+
+    idx, ref_idx = match_sources(sources, ref_sources, tolerance=tolerance, max_shift=max_shift)
+    if len(idx) < min_matches:
+        raise error.PanError("Only matched {} sources, need {}".format(len(idx), min_matches))
+
+    xy = np.column_stack([sources['x'][idx], sources['y'][idx]])
+    ref_xy = np.column_stack([ref_sources['x'][ref_idx], ref_sources['y'][ref_idx]])
+
+    fit = fit_shift_rotation(xy, ref_xy, center=center)
+
+    # Refit without any pairs that don't follow the transform
+    residuals = np.hypot(*(xy - (ref_xy.dot(fit['matrix'].T) + fit['translation'])).T)
+    good = residuals <= max(3 * np.median(residuals), 0.5)
+    if good.sum() >= min_matches and not good.all():
+        fit = fit_shift_rotation(xy[good], ref_xy[good], center=center)
+        fit['matches'] = int(good.sum())
+    else:
+        fit['matches'] = len(idx)
+
+    return fit
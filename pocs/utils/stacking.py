@@ -0,0 +1,256 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from astropy.io import fits
+from scipy import ndimage
+
+from pocs.utils import error
+from pocs.utils import sources
+from pocs.utils.images import bin_data
+from pocs.utils.images import get_rggb_channels
+
+# Offset (row, column) of the R, G1, G2 and B pixels on the 2x2 binned luminance grid
+CHANNEL_OFFSETS = [(dy * 0.5 - 0.25, dx * 0.5 - 0.25) for dy in range(2) for dx in range(2)]
+
+# Header cards that describe the raw data (or the extension it came from) rather than the co-add
+RAW_KEYWORDS = ['BZERO', 'BSCALE', 'BLANK', 'DATAMIN', 'DATAMAX', 'XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME']
+
+
+class SequenceStack(object):
+
+    """ Running co-add of the frames in a sequence
+
+    Frames are added one at a time with `add`. Each frame is registered to the first
+    one (the reference) from the shift and rotation of its stars (see
+    `pocs.utils.sources.compute_centroid_offset`), resampled onto the reference grid
+    and folded into a running mean and variance (Welford's method). The R, G1, G2 and
+    B pixels are resampled separately so the Bayer pattern is kept.
+
+    The running mean, sum of squared differences and count for each pixel live in
+    memory-mapped float32 (uint16 for the count) files in `buffer_dir` rather than in
+    memory, so only the frame being added has to be held in memory.
+
+    With `sigma` set a pixel is left out of the co-add when it is more than `sigma`
+    standard deviations from the running mean, once `min_frames` frames have gone
+    into that pixel. This removes satellite trails, cosmic rays and the like.
+
+    Args:
+        sigma (float, optional): Clipping limit in standard deviations, default None
+            for no clipping
+        min_frames (int, optional): Frames needed in a pixel before it is clipped, default 5
+        num_sources (int, optional): Number of stars used for registering, default 50
+        max_shift (float, optional): Largest shift between frames to consider, in pixels
+            of the binned (luminance) image
+        buffer_dir (str, optional): Directory for the memory-mapped buffers, a temporary
+            directory is used (and removed by `close`) by default
+        library (pocs.utils.calibration.CalibrationLibrary, optional): Calibrate each frame
+            with the masters from `library` before it is added
+    """
+
+    def __init__(self, sigma=None, min_frames=5, num_sources=50, max_shift=None, buffer_dir=None,
+                 library=None):
+        assert min_frames >= 2, "Need at least two frames to clip"
+
+        self.sigma = sigma
+        self.min_frames = min_frames
+        self.num_sources = num_sources
+        self.max_shift = max_shift
+        self.library = library
+
+        self.frames = list()
+        self.header = None
+        self.shape = None
+        self.rejected = 0
+
+        self._ref_sources = None
+        self._mean = None
+        self._m2 = None
+        self._count = None
+
+        self._remove_buffer_dir = buffer_dir is None
+        self.buffer_dir = buffer_dir or tempfile.mkdtemp(prefix='pocs_stack_')
+        os.makedirs(self.buffer_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, fits_fname):
+        """ Register a frame and add it to the co-add
+
+        Args:
+            fits_fname (str): Name of the FITS file, which may be compressed
+
+        Returns:
+            dict: Offset of the frame from the reference, see `sources.fit_shift_rotation`,
+                which is empty for the reference itself
+
+        Raises:
+            pocs.utils.error.PanError: If the frame doesn't match the reference or can't
+                be registered to it. The co-add is not changed.
+        """
+        with fits.open(fits_fname) as hdu_list:
+            hdu = hdu_list[0] if hdu_list[0].data is not None else hdu_list[1]
+            header = hdu.header.copy()
+            data = hdu.data.astype(np.float32)
+
+        if self.shape is not None and data.shape != self.shape:
+            raise error.PanError("{} has shape {}, expected {}".format(fits_fname, data.shape, self.shape))
+
+        if self.library is not None:
+            self.library.calibrate(data, header, out=data)
+
+        luminance = bin_data(data, 2, np.float32, average=True)
+
+        if self._ref_sources is None:
+            self._ref_sources = sources.detect_sources(luminance, num_sources=self.num_sources)
+            self._setup(data.shape, header)
+            offset = dict()
+        else:
+            offset = sources.compute_centroid_offset(luminance, self._ref_sources,
+                                                     num_sources=self.num_sources,
+                                                     max_shift=self.max_shift)
+        del luminance
+
+        for channel, plane in enumerate(get_rggb_channels(data).values()):
+            self._accumulate(channel, self._resample(plane, offset, channel))
+
+        self.frames.append(fits_fname)
+
+        return offset
+
+    def get_data(self):
+        """ Get the co-add
+
+        Returns:
+            tuple: Mean, variance and number of frames in each pixel as full size (Bayer)
+                arrays. Pixels without any frames are NaN.
+        """
+        assert self.shape is not None, "No frames have been added"
+
+        mean = np.empty(self.shape, dtype=np.float32)
+        variance = np.empty(self.shape, dtype=np.float32)
+        count = np.empty(self.shape, dtype=np.uint16)
+
+        channels = zip(get_rggb_channels(mean).values(),
+                       get_rggb_channels(variance).values(),
+                       get_rggb_channels(count).values())
+
+        for channel, (channel_mean, channel_variance, channel_count) in enumerate(channels):
+            n = self._count[channel]
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                channel_mean[:] = np.where(n > 0, self._mean[channel], np.nan)
+                channel_variance[:] = np.where(n > 1, self._m2[channel] / (n - 1.), np.nan)
+            channel_count[:] = n
+
+        return mean, variance, count
+
+    def write(self, fits_fname, clobber=True):
+        """ Write the co-add to a FITS file
+
+        The primary HDU holds the mean with the header of the reference frame (so a WCS
+        for the reference also applies to the co-add). The `VARIANCE` and `NCOMBINE`
+        extensions hold the variance of the frames and the number of frames in each pixel.
+
+        Args:
+            fits_fname (str): Name of the file
+            clobber (bool, optional): Overwrite an existing file, default True
+
+        Returns:
+            str: Name of the file
+        """
+        mean, variance, count = self.get_data()
+
+        header = self.header.copy()
+        for keyword in RAW_KEYWORDS:
+            header.remove(keyword, ignore_missing=True, remove_all=True)
+
+        header.set('IMAGETYP', 'coadd', 'Co-add of a sequence')
+        header.set('NCOMBINE', len(self.frames), 'Number of frames in co-add')
+        header.set('STACKSIG', self.sigma or 0., 'Clipping limit (sigma), 0 for none')
+        header.set('NREJECT', self.rejected, 'Number of clipped pixels')
+
+        hdu_list = fits.HDUList([
+            fits.PrimaryHDU(mean, header=header),
+            fits.ImageHDU(variance, name='VARIANCE'),
+            fits.ImageHDU(count, name='NCOMBINE'),
+        ])
+        hdu_list.writeto(fits_fname, clobber=clobber)
+
+        return fits_fname
+
+    def close(self):
+        """ Release the buffers, removing them if they are in a temporary directory """
+        self._mean = None
+        self._m2 = None
+        self._count = None
+
+        if self._remove_buffer_dir:
+            shutil.rmtree(self.buffer_dir, ignore_errors=True)
+
+    def _setup(self, shape, header):
+        assert shape[0] % 2 == 0 and shape[1] % 2 == 0, "Bayer data must have even dimensions"
+
+        self.shape = shape
+        self.header = header
+
+        plane_shape = (4, shape[0] // 2, shape[1] // 2)
+
+        self._mean = np.memmap(os.path.join(self.buffer_dir, 'mean.dat'),
+                               dtype=np.float32, mode='w+', shape=plane_shape)
+        self._m2 = np.memmap(os.path.join(self.buffer_dir, 'm2.dat'),
+                             dtype=np.float32, mode='w+', shape=plane_shape)
+        self._count = np.memmap(os.path.join(self.buffer_dir, 'count.dat'),
+                                dtype=np.uint16, mode='w+', shape=plane_shape)
+
+    def _resample(self, plane, offset, channel):
+        """ Resample a Bayer channel onto the reference grid, NaN outside the frame """
+        if not offset:
+            return plane
+
+        # The fit maps reference positions (x, y) on the luminance grid to positions in
+        # the frame. Convert it to (row, column) on the grid of this channel.
+        matrix = offset['matrix'][::-1, ::-1]
+        translation = offset['translation'][::-1]
+
+        channel_offset = np.array(CHANNEL_OFFSETS[channel])
+        translation = translation + matrix.dot(channel_offset) - channel_offset
+
+        return ndimage.affine_transform(plane, matrix, offset=translation, order=1,
+                                        mode='constant', cval=np.nan)
+
+    def _accumulate(self, channel, plane):
+        mean = self._mean[channel]
+        m2 = self._m2[channel]
+        count = self._count[channel]
+
+        good = np.isfinite(plane)
+
+        if self.sigma is not None and count.max() >= self.min_frames:
+            clip = good & (count >= self.min_frames)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = m2 / (count - 1.)
+
+                # The spread from a handful of frames is very noisy, so don't let it drop
+                # below the typical spread of the background. The median of the sample
+                # variance from k + 1 frames is about (1 - 2 / 9k)**3 of the true variance.
+                k = max(np.median(count[::4, ::4]) - 1., 1.)
+                background = np.nanmedian(variance[::4, ::4]) / (1 - 2 / (9 * k))**3
+                variance = np.maximum(variance, background)
+
+                # Allow for the uncertainty of the running mean too
+                limit = self.sigma**2 * variance * (1 + 1. / count)
+                clip &= (plane - mean)**2 > limit
+
+            self.rejected += int(clip.sum())
+            good &= ~clip
+
+        count += good
+
+        delta = np.where(good, plane - mean, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean += np.where(good, delta / count, 0)
+        m2 += np.where(good, delta * (plane - mean), 0)
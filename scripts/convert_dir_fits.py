@@ -2,31 +2,242 @@
 
 import argparse
 import glob
+import json
+import os
+import time
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+from astropy.io import fits
 from astropy.utils import console
 
-from panoptes.utils import images
+from pocs.utils import images
+
+
+def get_fits_name(cr2_fname, output_dir=None, compress=False):
+    """ Name of the FITS file made from `cr2_fname` """
+    fits_fname = cr2_fname.replace('.cr2', '.fits.fz' if compress else '.fits')
+
+    if output_dir is not None:
+        fits_fname = os.path.join(output_dir, os.path.basename(fits_fname))
+
+    return fits_fname
+
+
+def is_up_to_date(cr2_fname, fits_fname, entry=None):
+    """ If `fits_fname` exists and is newer than `cr2_fname`
+
+    Args:
+        cr2_fname (str): Name of CR2 file
+        fits_fname (str): Name of FITS file made from it
+        entry (dict, optional): Manifest entry for `cr2_fname`, if given it must
+            record a finished conversion of the current CR2 to `fits_fname`
+    """
+    if not os.path.exists(fits_fname):
+        return False
+
+    cr2_mtime = os.path.getmtime(cr2_fname)
+
+    if entry is not None:
+        if entry.get('status') != 'done' or entry.get('fits_file') != fits_fname:
+            return False
+        if entry.get('cr2_mtime') != cr2_mtime:
+            return False
+
+    return os.path.getmtime(fits_fname) >= cr2_mtime
+
+
+def load_manifest(manifest_fname):
+    """ Load the manifest of a previous run, empty if there isn't one """
+    try:
+        with open(manifest_fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_manifest(manifest_fname, manifest):
+    """ Write the manifest, replacing the old one only once it is complete """
+    tmp_fname = '{}.tmp'.format(manifest_fname)
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.replace(tmp_fname, manifest_fname)
+
+
+def convert_file(cr2_fname, fits_fname, compress=False, solve=False, timeout=60, **kwargs):
+    """ Convert a single CR2 file, optionally plate-solving and compressing it
+
+    This is run in the worker processes. Solving needs an uncompressed file so if
+    both `solve` and `compress` are set the FITS file is solved first and then
+    rewritten compressed.
+
+    Returns:
+        dict: Manifest entry for the file
+    """
+    timings = dict()
+    solved = False
+
+    if solve:
+        plain_fname = fits_fname.replace('.fits.fz', '.fits')
+    else:
+        plain_fname = fits_fname
+
+    images.cr2_to_fits(cr2_fname,
+                       fits_fname=plain_fname,
+                       clobber=True,
+                       compress=compress and not solve,
+                       timings=timings,
+                       **kwargs)
+
+    if not os.path.exists(plain_fname):
+        raise RuntimeError("Conversion failed")
+
+    if solve:
+        t0 = time.time()
+
+        header = fits.getheader(plain_fname)
+        hints = dict()
+        if isinstance(header.get('RA-MNT'), float) and isinstance(header.get('DEC-MNT'), float):
+            hints['ra'] = header['RA-MNT']
+            hints['dec'] = header['DEC-MNT']
+
+        try:
+            solve_info = images.get_solve_field(plain_fname, timeout=timeout, **hints)
+            solved = 'solved_fits_file' in solve_info
+        except Exception:
+            solved = False
+
+        timings['solve'] = time.time() - t0
+
+        if compress:
+            t0 = time.time()
+            with fits.open(plain_fname) as hdu_list:
+                images.write_fits(hdu_list[0], fits_fname, compress=True, clobber=True)
+
+            os.remove(plain_fname)
+            timings['compress'] = time.time() - t0
+
+    return {
+        'status': 'done',
+        'fits_file': fits_fname,
+        'cr2_mtime': os.path.getmtime(cr2_fname),
+        'solved': solved,
+        'timings': timings,
+    }
+
+
+def main(directory=None, output_dir=None, workers=None, compress=False, solve=False,
+         manifest=None, clobber=False, timeout=60, verbose=False, **kwargs):
+    """ Convert all the CR2 files in a directory
+
+    Conversions are run on a pool of `workers` processes. Progress is kept in a JSON
+    manifest (by default `convert_manifest.json` in the output directory) so an interrupted run
+    picks up where it stopped. Files with an up-to-date FITS file are skipped unless
+    `clobber` is set.
+
+    Returns:
+        dict: Counts of files converted, skipped and failed, and the time taken
+    """
+    def out(msg):
+        if verbose:
+            console.color_print(msg)
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if manifest is None:
+        manifest = os.path.join(output_dir or directory, 'convert_manifest.json')
+
+    entries = load_manifest(manifest)
+
+    cr2_files = sorted(glob.glob(os.path.join(directory, '*.cr2')))
+
+    todo = list()
+    for cr2_fname in cr2_files:
+        fits_fname = get_fits_name(cr2_fname, output_dir=output_dir, compress=compress)
+
+        entry = entries.get(os.path.basename(cr2_fname))
+        if solve and (entry is None or not entry.get('solved')):
+            # Solving wasn't done (or didn't work) last time
+            up_to_date = False
+        else:
+            up_to_date = is_up_to_date(cr2_fname, fits_fname, entry=entry)
+
+        if clobber or not up_to_date:
+            todo.append((cr2_fname, fits_fname))
+
+    summary = {
+        'total': len(cr2_files),
+        'skipped': len(cr2_files) - len(todo),
+        'converted': 0,
+        'failed': 0,
+    }
+
+    out("Converting {} of {} files in {} ({} up to date)".format(
+        len(todo), len(cr2_files), directory, summary['skipped']))
+
+    start_time = time.time()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(convert_file, cr2_fname, fits_fname,
+                                compress=compress, solve=solve, timeout=timeout, **kwargs): cr2_fname
+                for cr2_fname, fits_fname in todo
+            }
+
+            with console.ProgressBarOrSpinner(len(futures), "CR2 to FITS") as bar:
+                for num, future in enumerate(as_completed(futures)):
+                    cr2_fname = futures[future]
+
+                    try:
+                        entry = future.result()
+                    except Exception as e:
+                        entry = {'status': 'failed', 'error': str(e)}
+                        summary['failed'] += 1
+                        out("Problem converting {}: {}".format(cr2_fname, e))
+                    else:
+                        summary['converted'] += 1
+
+                    entries[os.path.basename(cr2_fname)] = entry
 
+                    # Don't rewrite the manifest for every file on big directories
+                    if num % 25 == 0:
+                        save_manifest(manifest, entries)
 
-parser = argparse.ArgumentParser(description='Convert Canon .cr2 file(s) to a FITS')
-parser.add_argument('--directory', help="Convert all .cr2 files in directory.")
-parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Verbose mode')
+                    bar.update(num + 1)
+    finally:
+        save_manifest(manifest, entries)
 
+    summary['elapsed'] = time.time() - start_time
 
-def out(msg):
-    if args.verbose:
-        console.color_print(msg)
+    if summary['elapsed'] > 0:
+        summary['fps'] = summary['converted'] / summary['elapsed']
+    else:
+        summary['fps'] = 0.
 
+    return summary
 
-args = parser.parse_args()
 
-if args.directory:
-    out("Converting all files in {}".format(args.directory))
-    cr2_files = glob.glob("{}/*.cr2".format(args.directory))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert Canon .cr2 file(s) to FITS')
+    parser.add_argument('--directory', required=True, help="Convert all .cr2 files in directory.")
+    parser.add_argument('--output-dir', default=None, help="Directory for FITS files, defaults to --directory")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes, defaults to number of cores")
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help="Write tile compressed (.fits.fz) files")
+    parser.add_argument('--solve', action='store_true', default=False, help="Plate-solve each file")
+    parser.add_argument('--timeout', type=int, default=60, help="Timeout in seconds for each solve")
+    parser.add_argument('--manifest', default=None,
+                        help="Manifest file used to resume, defaults to convert_manifest.json in output dir")
+    parser.add_argument('--clobber', action='store_true', default=False, help="Convert files that are up to date")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Verbose mode')
 
-    with console.ProgressBarOrSpinner(len(cr2_files), "CR2 to FITS") as bar:
-        for num, cr2 in enumerate(cr2_files):
+    args = parser.parse_args()
 
-            images.get_solve_field(cr2)
+    summary = main(**vars(args))
 
-            bar.update(num)
+    print("Converted {converted} of {total} files ({skipped} up to date, {failed} failed) "
+          "in {elapsed:.1f}s: {fps:.2f} frames/s".format(**summary))
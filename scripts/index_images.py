@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+from pocs.utils.image_index import ImageIndex
+
+
+def main(directory=None, db_file=None, field=None, sequence_id=None, camera=None,
+         start=None, end=None, verbose=False):
+    index = ImageIndex(db_file=db_file)
+
+    t0 = time.time()
+    counts = index.update(directory=directory, verbose=verbose)
+    print("Updated index in {:.02f}s: {}".format(time.time() - t0, counts))
+
+    if any(value is not None for value in [field, sequence_id, camera, start, end]):
+        for fname in index.files(field=field, sequence_id=sequence_id, camera=camera, start=start, end=end):
+            print(fname)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the index of FITS headers and list matching files')
+    parser.add_argument('--directory', default=None, help="Directory to index, defaults to $PANDIR/images")
+    parser.add_argument('--db-file', default=None, help="Index database, defaults to $PANDIR/images/image_index.sqlite")
+    parser.add_argument('--field', default=None, help="List the files of this field")
+    parser.add_argument('--sequence-id', default=None, help="List the files of this sequence")
+    parser.add_argument('--camera', default=None, help="List the files of this camera")
+    parser.add_argument('--start', default=None, help="List the files taken from this time (ISO)")
+    parser.add_argument('--end', default=None, help="List the files taken before this time (ISO)")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Verbose mode')
+
+    args = parser.parse_args()
+
+    main(**vars(args))
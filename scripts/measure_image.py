@@ -1,125 +1,104 @@
+#!/usr/bin/env python
+
+import argparse
+import json
 import os
-from IQMon import Image
-from IQMon import Telescope
-
-
-def measure_image(file,
-                  clobber_logs=False,
-                  graphics=False,
-                  analyze_image=True,
-                  record=True,
-                  zero_point=False,
-                  verbose=False,
-                  ):
-
-    # -------------------------------------------------------------------------
-    # Create Telescope Object
-    # -------------------------------------------------------------------------
-    config_file = os.path.join(os.getenv('POCS'), 'resources', 'conf_files', 'IQMon_config.yaml')
-    tel = Telescope(config_file)
-
-    # -------------------------------------------------------------------------
-    # Perform Actual Image Analysis
-    # -------------------------------------------------------------------------
-    with Image(file, tel) as im:
-        im.make_logger(verbose=verbose, clobber=clobber_logs)
-        im.read_image()
-        im.read_header()
-
-        if analyze_image:
-            if im.tel.ROI:
-                im.crop()
-            im.run_SExtractor()
-            im.determine_FWHM()
-            im.FWHM = im.FWHM_median  # Use median for Panoptes
-
-            is_blank = (im.n_stars_SExtracted < 100)
-            if is_blank:
-                im.logger.warning('Only {} stars found.  Image may be blank.'.format(
-                    im.n_stars_SExtracted))
-
-            if not im.image_WCS and not is_blank:
-                im.solve_astrometry()
-            if im.astrometry_solved:
-                im.determine_pointing_error()
-
-            if graphics and im.FWHM:
-                try:
-                    im.make_PSF_plot()
-                except:
-                    im.logger.warning('Failed to make PSF plot')
-
-        if graphics:
-            p1, p2 = (1.50, 0.50)
-            small_JPEG = im.raw_file_basename + "_fullframe.jpg"
-            im.make_JPEG(small_JPEG, binning=2,
-                         p1=p1, p2=p2,
-                         make_hist=False,
-                         mark_pointing=True,
-                         mark_detected_stars=True,
-                         mark_catalog_stars=True,
-                         mark_saturated=False,
-                         quality=70,
-                         )
-            cropped_JPEG = im.raw_file_basename + "_crop.jpg"
-            im.make_JPEG(cropped_JPEG,
-                         p1=p1, p2=p2,
-                         make_hist=False,
-                         mark_pointing=True,
-                         mark_detected_stars=True,
-                         mark_catalog_stars=False,
-                         mark_saturated=False,
-                         crop=(int(im.nXPix / 2) - 512,
-                               int(im.nYPix / 2) - 512,
-                               int(im.nXPix / 2) + 512,
-                               int(im.nYPix / 2) + 512),
-                         quality=70,
-                         )
-
-        im.clean_up()
-        im.calculate_process_time()
-
-        if record:
-            im.add_mongo_entry()
-
-        im.logger.info('Done.')
-
-
-def main():
-    from argparse import ArgumentParser
-
-    # create a parser object for understanding command-line arguments
-    parser = ArgumentParser(description="Describe the script")
-    # add flags
-    parser.add_argument("-v", "--verbose",
-                        action="store_true", dest="verbose",
-                        default=False, help="Be verbose! (default = False)")
-
-    parser.add_argument("--graphics",
-                        action="store_true", dest="graphics",
-                        default=False, help="Turn off generation of graphics")
-
-    parser.add_argument("-z", "--zp",
-                        action="store_true", dest="zero_point",
-                        default=False, help="Calculate zero point")
-
-    parser.add_argument("-r", "--record",
-                        action="store_true", dest="record",
-                        default=True, help="Store the record results")
-    # add arguments
-    parser.add_argument("filename",
-                        type=str,
-                        help="File Name of Input Image File")
-    args = parser.parse_args()
+import time
+
+from pocs.utils import quality
+
+
+def record_results(results):
+    """ Add the measures to the observations in the database, matched on the file """
+    from pocs.utils.database import PanMongo
+
+    db = PanMongo()
+    for measures in results:
+        if 'error' in measures:
+            continue
+
+        file_path = measures['file']
+        if file_path.endswith('.fz'):
+            file_path = file_path[:-3]
+
+        db.observations.update({'data.file_path': file_path}, {
+            '$set': {
+                'data.quality': {key: value for key, value in measures.items() if key != 'file'},
+            },
+        })
+
+
+def main(filenames=None, directory=None, pattern='*.fits*', workers=None, record=False,
+         min_stars=10, max_fwhm=None, max_ellipticity=0.5, **kwargs):
+    """ Measure the quality of FITS files
+
+    Files are given by name or as all the files matching `pattern` in `directory`,
+    the latter being measured on a pool of `workers` processes.
+
+    Returns:
+        list: Measures for each file (see `pocs.utils.quality.measure_image`), with the
+            `problems` found by `pocs.utils.quality.check_quality`
+    """
+    results = list()
 
-    print(args)
+    if directory is not None:
+        results.extend(quality.measure_directory(directory, pattern=pattern, workers=workers, **kwargs))
 
-    measure_image(args.filename,
-                  graphics=args.graphics,
-                  zero_point=args.zero_point,
-                  record=args.record,
-                  verbose=args.verbose)
+    for fname in filenames or []:
+        try:
+            results.append(quality.measure_image(fname, **kwargs))
+        except Exception as e:
+            results.append({'file': fname, 'error': str(e)})
+
+    for measures in results:
+        if 'error' not in measures:
+            measures['problems'] = quality.check_quality(measures,
+                                                         min_stars=min_stars,
+                                                         max_fwhm=max_fwhm,
+                                                         max_ellipticity=max_ellipticity)
+
+    if record:
+        record_results(results)
+
+    return results
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Measure background, noise, star count, FWHM and ellipticity')
+    parser.add_argument('filenames', nargs='*', help="FITS files to measure")
+    parser.add_argument('--directory', default=None, help="Measure all the FITS files in directory")
+    parser.add_argument('--pattern', default='*.fits*', help="Files to measure in --directory")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes, defaults to number of cores")
+    parser.add_argument('--num-sources', type=int, default=200, help="Number of stars to measure")
+    parser.add_argument('--min-stars', type=int, default=10, help="Fewest stars for a good frame")
+    parser.add_argument('--max-fwhm', type=float, default=None, help="Largest FWHM in pixels for a good frame")
+    parser.add_argument('--max-ellipticity', type=float, default=0.5, help="Largest ellipticity for a good frame")
+    parser.add_argument('-r', '--record', action='store_true', default=False,
+                        help="Add the results to the observations in the database")
+    parser.add_argument('--json', action='store_true', default=False, help="Print the results as JSON")
+
+    args = parser.parse_args()
+    if not args.filenames and args.directory is None:
+        parser.error("Give FITS files or a --directory")
+
+    start_time = time.time()
+
+    print_json = args.json
+    del args.json
+
+    results = main(**vars(args))
+
+    if print_json:
+        print(json.dumps(results, indent=1, sort_keys=True))
+    else:
+        for measures in results:
+            name = os.path.basename(measures['file'])
+            if 'error' in measures:
+                print("{}: {}".format(name, measures['error']))
+                continue
+
+            print("{}: {num_stars} stars, FWHM {fwhm:.02f} px, ellipticity {ellipticity:.02f}, "
+                  "background {background:.1f} +/- {noise:.1f} ({elapsed:.02f}s) {status}".format(
+                      name, status=', '.join(measures['problems']) or 'OK', **measures))
+
+    print("Measured {} files in {:.1f}s".format(len(results), time.time() - start_time))